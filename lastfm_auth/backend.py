@@ -3,28 +3,222 @@ Last.fm support for Django-Social-Auth.
 
 An application must be registered first on Last.fm and the settings LASTFM_API_KEY
 and LASTFM_SECRET must be defined with they corresponding values.
+
+Calls to the Last.fm API share a pool of keep-alive connections which can be
+tuned with the LASTFM_POOL_SIZE, LASTFM_CONNECT_TIMEOUT and LASTFM_READ_TIMEOUT
+settings. The HTTP client in lastfm_auth.client is imported on the first call.
 """
 
+import logging
+import sys
+import threading
+import time
 from hashlib import md5
 from re import sub
 from urllib import urlencode
-from urllib2 import urlopen
 
 from django.conf import settings
-from django.contrib.auth import authenticate
-from django.utils import simplejson
+from django.contrib.auth import authenticate, REDIRECT_FIELD_NAME
+from django.core import signing
 
 from social_auth.backends import BaseAuth, SocialAuthBackend, USERNAME
 
+from lastfm_auth.breaker import circuit_breaker
+from lastfm_auth.cache import LRUCache, profile_cache, response_validators, token_cache
+from lastfm_auth.exceptions import LastfmError, LastfmUpstreamError, \
+    LastfmResponseError, LastfmAPIError, LastfmTokenUsed, RateLimitExceeded, \
+    LastfmOverloaded
+from lastfm_auth.keys import get_key_pool, DEFAULT_COOLDOWN, RATE_LIMIT_EXCEEDED
+from lastfm_auth.metrics import instrumented, stage, incr, histogram
+from lastfm_auth.ratelimit import SingleFlight, admitted, throttle
+from lastfm_auth.retry import with_retries, hedged, retryable
+from lastfm_auth.signing import get_signer
+
 
 LASTFM_API_SERVER = 'https://ws.audioscrobbler.com/2.0/'
 LASTFM_AUTHORIZATION_URL = 'https://www.last.fm/api/auth/'
 
+DEFAULT_BATCH_WORKERS = 4
+# Callback parameter carrying the signed next url of a new session
+REDIRECT_STATE = 'redirect_state'
+REDIRECT_STATE_MAX_AGE = 60 * 60
+
+# Fields of the API responses used by the backend
+SESSION_FIELDS = ('name', 'key', )
+USER_FIELDS = ('id', 'name', 'realname', )
+# Fields stored on LastfmProfile, see lastfm_auth.models
+PROFILE_FIELDS = ('country', 'playcount', 'registered', )
+
+logger = logging.getLogger('lastfm_auth')
+
+
+def connection_pool(url):
+    """Return the shared connection pool for the host of the given url."""
+    from lastfm_auth import client
+    return client.connection_pool(url)
+
+
+def close_pools():
+    """Close and discard all shared connection pools."""
+    if 'lastfm_auth.client' in sys.modules:
+        sys.modules['lastfm_auth.client'].close_pools()
+
+
+def urlopen(url, headers=None):
+    """
+    Open the url using the shared keep-alive connection pool. Network errors
+    and 5xx responses are recorded as failures by the circuit breaker. Other
+    responses, including those over LASTFM_MAX_RESPONSE_SIZE, are successes.
+
+    The pool reads the whole body so a LASTFM_MAX_IN_FLIGHT slot is only held
+    while the request is on the wire, not while waiting for the rate limit.
+    """
+    from urllib2 import HTTPError
+    breaker = circuit_breaker()
+    # Fail fast while the circuit is open without using a rate limit slot
+    breaker.before()
+    try:
+        throttle()
+        with admitted():
+            if headers:
+                response = connection_pool(url).urlopen(url, headers)
+            else:
+                response = connection_pool(url).urlopen(url)
+    except (RateLimitExceeded, LastfmOverloaded):
+        # The call was never made
+        breaker.cancel()
+        raise
+    except HTTPError as e:
+        if e.code >= 500:
+            breaker.failure()
+        else:
+            breaker.success()
+        raise
+    except LastfmResponseError:
+        # Last.fm answered, with a body over the size limit
+        breaker.success()
+        raise
+    except:
+        breaker.failure()
+        raise
+    breaker.success()
+    return response
+
+
+def api_request(url, name, fields=None):
+    """
+    Request the url and return the named member of the JSON response, keeping
+    only the given fields of it if any are given.
+
+    Raises LastfmUpstreamError when the request fails, LastfmAPIError when
+    Last.fm returns an error code and LastfmResponseError for unusable data.
+    """
+    with stage('upstream', call=name):
+        body, response = read_response(url, name)
+        return decode_response(body, name, fields)
+
+
+def conditional_request(url, name, fields, cached=None):
+    """
+    Request the url as api_request, sending the validators of a cached response
+    from ProfileCache.get_response if one is given.
+
+    Returns (data, validators) with the validators of the new response. For a
+    304 Not Modified response the cached data is returned without decoding.
+    """
+    headers = {}
+    if cached is not None:
+        if cached.get('etag'):
+            headers['If-None-Match'] = cached['etag']
+        if cached.get('last_modified'):
+            headers['If-Modified-Since'] = cached['last_modified']
+    with stage('upstream', call=name):
+        body, response = read_response(url, name, headers)
+        validators = response_validators(response.info())
+        if body is None:
+            incr('lastfm_auth.http_cache', result='hit')
+            if validators is not None:
+                # A 304 only has to repeat the headers which changed
+                validators = dict(
+                    (key, value if value is not None else cached.get(key))
+                    for key, value in validators.items()
+                )
+            return cached['data'], validators
+        incr('lastfm_auth.http_cache', result='miss')
+        return decode_response(body, name, fields), validators
+
+
+def read_response(url, name, headers=None):
+    """
+    Request the url and return (body, response). The body is None when the
+    server answers a conditional request with 304 Not Modified.
+    """
+    from urllib2 import HTTPError
+    try:
+        response = urlopen(url, headers) if headers else urlopen(url)
+        body = response.read()
+    except LastfmError:
+        raise
+    except HTTPError as e:
+        if e.code == 304 and headers:
+            return (None, e)
+        body = e.read()
+        try:
+            decode_response(body, name)
+        except LastfmAPIError:
+            raise
+        except LastfmResponseError:
+            pass
+        raise LastfmUpstreamError('Last.fm returned HTTP %s' % e.code)
+    except Exception as e:
+        raise LastfmUpstreamError('Last.fm request failed: %s' % e)
+    histogram('lastfm_auth.upstream.bytes', len(body), call=name)
+    return (body, response)
+
+
+def decode_response(body, name, fields=None):
+    """
+    Return the named member of a Last.fm JSON response body. When fields are
+    given only those keys of the member are kept.
+    """
+    from lastfm_auth.client import json_loads
+    try:
+        data = json_loads(body)
+    except ValueError:
+        raise LastfmResponseError('Invalid JSON from Last.fm')
+    if not isinstance(data, dict):
+        raise LastfmResponseError('Unexpected response from Last.fm')
+    if 'error' in data:
+        raise LastfmAPIError(data['error'], data.get('message', ''))
+    try:
+        member = data[name]
+    except KeyError:
+        raise LastfmResponseError('Missing %s in Last.fm response' % name)
+    if fields is not None and isinstance(member, dict):
+        member = dict((key, member[key]) for key in fields if key in member)
+    return member
+
+
+def profiles_enabled():
+    """Return whether LastfmProfile rows are kept in sync (LASTFM_PROFILES)."""
+    return getattr(settings, 'LASTFM_PROFILES', False)
+
+
+# Concurrent user.getinfo requests for the same username share one call
+_user_data_flight = SingleFlight()
+
+# Authorization urls by (api_key, key count > 1, host, callback path)
+_auth_urls = LRUCache(max_entries=100)
+
+# Usernames with a background profile refresh in progress
+_refreshing = set()
+_refreshing_lock = threading.Lock()
+
 
 class LastfmBackend(SocialAuthBackend):
     """Last.fm authentication backend."""
     name = "lastfm"
-    EXTRA_DATA = [('id', 'id'), ]
+    EXTRA_DATA = [('id', 'id'), ('name', 'name'), ]
 
     def get_user_id(self, details, response):
         """Get unique User id from response"""
@@ -32,7 +226,7 @@ class LastfmBackend(SocialAuthBackend):
 
     def get_user_details(self, response):
         """Return user details from Last.fm account"""
-        full_name = response['realname'].strip()
+        full_name = response.get('realname', '').strip()
         if len(full_name.split(' ')) > 1:
             last_name = full_name.split(' ')[-1].strip()
             first_name = full_name.replace(last_name, '').strip()
@@ -48,6 +242,25 @@ class LastfmBackend(SocialAuthBackend):
         }
         return data
 
+    def authenticate(self, *args, **kwargs):
+        """Authenticate the user, timing Last.fm logins."""
+        if not kwargs.get(self.name):
+            return super(LastfmBackend, self).authenticate(*args, **kwargs)
+        with stage('authenticate'):
+            user = super(LastfmBackend, self).authenticate(*args, **kwargs)
+            social_user = getattr(user, 'social_user', None)
+            if social_user is not None and kwargs.get('response') and profiles_enabled():
+                from lastfm_auth.models import LastfmProfile
+                LastfmProfile.objects.sync(social_user, kwargs['response'])
+            return user
+
+    def fingerprint(self, details, extra_data):
+        """Return a compact fingerprint of the mapped user details and extra data."""
+        from django.utils import simplejson
+        data = simplejson.dumps([details, extra_data], sort_keys=True)
+        return md5(data).hexdigest()[:16]
+
+    @instrumented('extra_data')
     def extra_data(self, user, uid, response, details):
         data = {'access_token': response.get('access_token', '')}
         name = self.name.replace('-', '_').upper()
@@ -62,13 +275,67 @@ class LastfmAuth(BaseAuth):
     SETTINGS_KEY_NAME = 'LASTFM_API_KEY'
     SETTINGS_SECRET_NAME = 'LASTFM_SECRET'
 
+    def __init__(self, request=None, redirect=None):
+        """The request may be omitted to call the API outside of a login."""
+        if request is None:
+            self.request = None
+            self.data = {}
+            self.redirect = redirect
+        else:
+            super(LastfmAuth, self).__init__(request, redirect)
+            self.restore_redirect()
+
+    @instrumented('auth_url')
     def auth_url(self):
-        """Return authorization redirect url."""
-        key = self.api_key()
-        callback = self.request.build_absolute_uri(self.redirect)
-        callback = sub(r'^https', u'http', callback)
-        query = urlencode({'api_key': key, 'cb': callback})
-        return '%s?%s' % (LASTFM_AUTHORIZATION_URL, query)
+        """
+        Return authorization redirect url. Urls are cached by host unless they
+        carry the next url of the login.
+        """
+        pool = self.key_pool()
+        key = pool.choose().key
+        state = self.redirect_state()
+        cache_key = (key, len(pool) > 1, self.request.get_host(), self.redirect)
+        url = None if state else _auth_urls.get(cache_key)
+        if url is None:
+            params = {}
+            if len(pool) > 1:
+                # Tokens can only be exchanged with the key which requested them
+                params['api_key'] = key
+            if state:
+                params[REDIRECT_STATE] = state
+            callback = self.request.build_absolute_uri(self.redirect)
+            callback = sub(r'^https', u'http', callback)
+            if params:
+                callback = '%s%s%s' % (callback, '&' if '?' in callback else '?',
+                                       urlencode(params))
+            query = urlencode({'api_key': key, 'cb': callback})
+            url = '%s?%s' % (LASTFM_AUTHORIZATION_URL, query)
+            if not state:
+                _auth_urls.set(cache_key, url)
+        return url
+
+    def redirect_state(self):
+        """
+        Return the signed next url of a new session which holds nothing else,
+        removing it from the session so the begin request doesn't save one.
+        Returns None otherwise.
+        """
+        session = getattr(self.request, 'session', None)
+        if session is None or session.session_key or session.keys() != [REDIRECT_FIELD_NAME]:
+            return None
+        return signing.dumps(session.pop(REDIRECT_FIELD_NAME), salt=REDIRECT_STATE)
+
+    def restore_redirect(self):
+        """Move the next url from a signed callback parameter to the session."""
+        state = self.data.get(REDIRECT_STATE)
+        session = getattr(self.request, 'session', None)
+        if not state or session is None or REDIRECT_FIELD_NAME in session:
+            return
+        try:
+            session[REDIRECT_FIELD_NAME] = signing.loads(
+                state, salt=REDIRECT_STATE, max_age=REDIRECT_STATE_MAX_AGE)
+        except signing.BadSignature:
+            logger.warning('Invalid %s in Last.fm callback', REDIRECT_STATE)
 
     def auth_complete(self, *args, **kwargs):
         """Return user from authenticate."""
@@ -76,68 +343,317 @@ class LastfmAuth(BaseAuth):
         if not token:
             raise ValueError('No token returned')
 
-        username, access_token = self.access_token(token)
-        data = self.user_data(username)
+        session = self.exchange_token(token)
+        if session is None:
+            # Duplicate callback of a login which has already completed
+            return self.request.user
+        username, access_token = session
+        uid = None
+        if self.defer_profile():
+            uid = profile_cache().get_identity(username)
+        if uid is not None:
+            incr('lastfm_auth.deferred_profile', result='deferred')
+            data = {'id': uid, 'name': username}
+        elif self.combined_fetch():
+            # Profile data from a previous login is used right away so the callback
+            # only waits on auth.getSession. It is refreshed once past half its ttl.
+            data = self.cached_user_data(username, profile_cache().ttl / 2.0)
+        else:
+            data = self.user_data(username)
         if data is not None:
-            data['access_token'] = access_token
+            data = dict(data, access_token=access_token)
 
         kwargs.update({'response': data, self.AUTH_BACKEND.name: True})
-        return authenticate(*args, **kwargs)
+        user = authenticate(*args, **kwargs)
+        if uid is not None and user is not None:
+            self.enrich_later(uid, username)
+        return user
+
+    def enrich_later(self, uid, username):
+        """Submit fetching and storing the full profile to the LASTFM_EXECUTOR."""
+        from lastfm_auth.tasks import get_executor, enrich_profile
+        get_executor().submit(enrich_profile, uid, username)
 
+    def exchange_token(self, token):
+        """
+        Return (username, access_token) for the request token.
+
+        With LASTFM_TOKEN_REPLAY_TTL set a token exchanged within that many
+        seconds isn't sent to Last.fm again. A duplicate callback from the same
+        browser session reuses the result. It returns None when the request's
+        user is already logged in with the token's Last.fm account and
+        otherwise raises LastfmTokenUsed.
+        """
+        tokens = token_cache()
+        if tokens is None:
+            return self.access_token(token)
+        owner = self.session_owner()
+        if tokens.claim(token, owner):
+            try:
+                session = self.access_token(token)
+            except:
+                tokens.release(token)
+                raise
+            tokens.set(token, owner, session)
+            return session
+        entry = tokens.get(token, owner)
+        if entry is None:
+            # The first exchange failed so the token may still be valid
+            return self.access_token(token)
+        if owner is not None and entry['owner'] == owner and 'session' in entry:
+            incr('lastfm_auth.token_replay', result='reused')
+            return entry['session']
+        if 'session' in entry and self.logged_in_as(entry['session'][0]):
+            incr('lastfm_auth.token_replay', result='logged_in')
+            return None
+        incr('lastfm_auth.token_replay', result='rejected')
+        raise LastfmTokenUsed('Last.fm token was already used')
+
+    def logged_in_as(self, username):
+        """Return whether the request's user is linked to the Last.fm username."""
+        user = getattr(self.request, 'user', None)
+        if user is None or not user.is_authenticated():
+            return False
+        accounts = user.social_auth.filter(provider=self.AUTH_BACKEND.name)
+        return any((account.extra_data or {}).get('name') == username for account in accounts)
+
+    def session_owner(self):
+        """Return a hash of the browser's session key or None without one."""
+        session = getattr(self.request, 'session', None)
+        if session is None or not session.session_key:
+            return None
+        return md5(session.session_key).hexdigest()
+
+    @instrumented('access_token')
     def access_token(self, token):
-        """Get the Last.fm session/access token via auth.getSession.""" 
-        data = {
-            'method': 'auth.getSession',
-            'api_key': self.api_key(),
-            'token': token,
-            'api_sig': self.method_signature('auth.getSession', token),
-            'format': 'json',
-        }
-        query = urlencode(data)
-        url = '%s?%s' % (LASTFM_API_SERVER, query)
+        """
+        Get the Last.fm session/access token via auth.getSession.
+        Returns (username, access_token) or raises a LastfmError. This is never
+        retried as the token can only be exchanged once.
+        """
+        api_key = self.login_key()
+        with self.key_pool().track(api_key):
+            url = self.access_token_url(token, api_key)
+            session = api_request(url, 'session', SESSION_FIELDS)
+        return self.parse_session(session)
+
+    def access_token_url(self, token, api_key=None):
+        """Return the signed auth.getSession url for the given request token."""
+        signer = self.signer(api_key or self.login_key())
+        return signer.url('auth.getSession', {'token': token}, signed=True)
+
+    def parse_access_token(self, response):
+        """Return (username, access_token) from an auth.getSession response body."""
+        return self.parse_session(decode_response(response, 'session', SESSION_FIELDS))
+
+    def parse_session(self, session):
         try:
-            response = urlopen(url).read()
-            session = simplejson.loads(response)['session']
-            access_token = session['key']
-            username = session['name']
-        except:
-            access_token = ''
-            username = ''
-        return (username, access_token)
+            return (session['name'], session['key'])
+        except (KeyError, TypeError):
+            raise LastfmResponseError('Invalid session from Last.fm')
 
+    @instrumented('user_data')
     def user_data(self, username):
-        """Request user data."""
-        data = {
-            'method': 'user.getinfo',
-            'api_key': self.api_key(),
-            'user': username,
-            'format': 'json',
-        }
-        query = urlencode(data)
-        url = '%s?%s' % (LASTFM_API_SERVER, query)
+        """Request user data, using the profile cache when it is enabled."""
+        return self.cached_user_data(username)
+
+    def cached_user_data(self, username, refresh_after=None):
+        """
+        Return user data from the profile cache when it is enabled or fetch it.
+        Cached data older than `refresh_after` seconds, by default
+        LASTFM_PROFILE_CACHE_TTL, is returned and refreshed by a worker thread.
+        """
+        if not (username and self.profile_caching()):
+            return self.fetch_user_data(username)
+        cache = profile_cache()
+        data, age = cache.get(username)
+        if data is None:
+            incr('lastfm_auth.profile_cache', result='miss')
+            return self.refresh_user_data(username)
+        if not cache.is_fresh(age, refresh_after):
+            incr('lastfm_auth.profile_cache', result='stale')
+            self.refresh_in_background(username)
+        else:
+            incr('lastfm_auth.profile_cache', result='hit')
+        return data
+
+    def fetch_user_data(self, username):
+        """
+        Request user data from Last.fm via user.getinfo. Concurrent requests for
+        the same username share a single upstream call. Failures are raised
+        again without a request for LASTFM_NEGATIVE_CACHE_TTL seconds.
+        """
+        cache = profile_cache()
+        if not (username and cache.negative_ttl):
+            return _user_data_flight.do(username, self._fetch_user_data, username)
+        error = cache.get_failure(username)
+        if error is not None:
+            incr('lastfm_auth.negative_cache', result='hit', error=error.__class__.__name__)
+            raise error
         try:
-            response = urlopen(url).read()
-            user_data = simplejson.loads(response)['user']
-        except:
-            user_data = None
-        return user_data
+            return _user_data_flight.do(username, self._fetch_user_data, username)
+        except LastfmResponseError as e:
+            # Throttling of an API key and temporary errors say nothing about the username
+            if not (retryable(e) or
+                    isinstance(e, LastfmAPIError) and e.code == RATE_LIMIT_EXCEEDED):
+                incr('lastfm_auth.negative_cache', result='store', error=e.__class__.__name__)
+                cache.set_failure(username, e)
+            raise
+
+    def _fetch_user_data(self, username):
+        cached = None
+        cache = profile_cache()
+        if cache.http_ttl:
+            cached = cache.get_response(username, self.user_fields())
+        if cached is not None and cached['expires'] > time.time():
+            incr('lastfm_auth.http_cache', result='fresh')
+            data = cached['data']
+        else:
+            # user.getinfo is idempotent so it can be retried and hedged
+            data = with_retries(hedged, self._request_user_data, username, cached)
+        if self.defer_profile() and data and data.get('id'):
+            # Remembered so later logins can complete without user.getinfo
+            cache.set_identity(username, data['id'])
+        return data
+
+    def _request_user_data(self, username, cached=None):
+        pool = self.key_pool()
+        api_key = pool.choose()
+        fields = self.user_fields()
+        with pool.track(api_key):
+            url = self.user_data_url(username, api_key)
+            cache = profile_cache()
+            if not cache.http_ttl:
+                return api_request(url, 'user', fields)
+            data, validators = conditional_request(url, 'user', fields, cached)
+        cache.set_response(username, fields, data, validators)
+        return data
+
+    def user_data_url(self, username, api_key=None):
+        """Return the user.getinfo url for the given username."""
+        return self.signer(api_key).url('user.getinfo', {'user': username})
+
+    def parse_user_data(self, response):
+        """Return user data from a user.getinfo response body."""
+        return decode_response(response, 'user', self.user_fields())
+
+    def refresh_user_data(self, username):
+        """Fetch user data and store it in the profile cache."""
+        data = self.fetch_user_data(username)
+        if data is not None:
+            profile_cache().set(username, data)
+        return data
+
+    def batch_user_data(self, usernames, workers=None):
+        """
+        Request user data for many usernames concurrently.
+
+        Yields (username, data, error) tuples as lookups complete, where error
+        is the exception raised for that username or None. Duplicate usernames
+        are looked up once and cached profiles are returned without a request.
+        Usernames are read from the iterable as lookups complete so it can be
+        of any size and errors raised while reading it are raised once the
+        started lookups are yielded. At most `workers` (LASTFM_BATCH_WORKERS)
+        requests run at a time.
+        """
+        if workers is None:
+            workers = getattr(settings, 'LASTFM_BATCH_WORKERS',
+                getattr(settings, 'LASTFM_POOL_SIZE', DEFAULT_BATCH_WORKERS))
 
-    def method_signature(self, method, token):
+        def unique():
+            seen = set()
+            for username in usernames:
+                if username and username not in seen:
+                    seen.add(username)
+                    yield username
+
+        from lastfm_auth.utils import imap_unordered
+        for username, data, exc_info in imap_unordered(self.cached_user_data, unique(), workers):
+            yield (username, data, exc_info[1] if exc_info is not None else None)
+
+    def refresh_in_background(self, username):
+        """Refresh the cached user data in a worker thread."""
+        with _refreshing_lock:
+            if username in _refreshing:
+                return
+            _refreshing.add(username)
+
+        def refresh():
+            try:
+                self.refresh_user_data(username)
+            except LastfmError:
+                logger.warning('Background profile refresh failed', exc_info=True)
+            finally:
+                with _refreshing_lock:
+                    _refreshing.discard(username)
+
+        worker = threading.Thread(target=refresh)
+        worker.daemon = True
+        worker.start()
+
+    @classmethod
+    def user_fields(cls):
+        """
+        Return the user.getinfo fields kept from responses: those used by the
+        backend, LastfmProfile, LASTFM_EXTRA_DATA and LASTFM_USER_FIELDS.
+        """
+        extra = [name for name, alias in getattr(settings, 'LASTFM_EXTRA_DATA', [])]
+        if profiles_enabled():
+            extra.extend(PROFILE_FIELDS)
+        return USER_FIELDS + tuple(extra) + tuple(getattr(settings, 'LASTFM_USER_FIELDS', ()))
+
+    @classmethod
+    def combined_fetch(cls):
+        return getattr(settings, 'LASTFM_COMBINED_FETCH', False)
+
+    @classmethod
+    def defer_profile(cls):
+        return getattr(settings, 'LASTFM_DEFER_PROFILE', False)
+
+    @classmethod
+    def profile_caching(cls):
+        return getattr(settings, 'LASTFM_PROFILE_CACHE', False) or cls.combined_fetch()
+
+    def method_signature(self, method, token=None, **params):
         """Generate method signature for API calls."""
-        data = {
-            'key': self.api_key(),
-            'secret': self.secret_key(),
-            'method': method,
-            'token': token,
-        }
-        key = 'api_key%(key)smethod%(method)stoken%(token)s%(secret)s' % data
-        return md5(key).hexdigest()
+        if token is not None:
+            params['token'] = token
+        return self.signer(self.login_key()).sign(method, params)
+
+    @classmethod
+    def signer(cls, api_key=None):
+        """Return the Signer for an ApiKey, by default the first configured key."""
+        if api_key is None:
+            api_key = cls.key_pool().keys[0]
+        return get_signer(api_key.key, api_key.secret, cls.api_server())
+
+    @classmethod
+    def key_pool(cls):
+        """
+        Return the KeyPool of LASTFM_API_KEYS, a list of (api_key, secret)
+        pairs, or of LASTFM_API_KEY and LASTFM_SECRET when it isn't set.
+        """
+        pairs = getattr(settings, 'LASTFM_API_KEYS', None) or \
+            [(cls.api_key(), cls.secret_key())]
+        return get_key_pool(pairs, getattr(settings, 'LASTFM_KEY_COOLDOWN', DEFAULT_COOLDOWN))
+
+    def login_key(self):
+        """
+        Return the ApiKey this login was started with. auth_url adds it to the
+        callback when more than one key is configured.
+        """
+        pool = self.key_pool()
+        return pool.get(self.data.get('api_key')) or pool.keys[0]
 
     @classmethod
     def enabled(cls):
         """Enable only if settings are defined."""
         return cls.api_key and cls.secret_key
 
+    @classmethod
+    def api_server(cls):
+        return getattr(settings, 'LASTFM_API_SERVER', LASTFM_API_SERVER)
+
     @classmethod
     def api_key(cls):
         return getattr(settings, cls.SETTINGS_KEY_NAME, '')
@@ -0,0 +1,108 @@
+"""
+Circuit breaker for calls to the Last.fm API.
+
+After LASTFM_CIRCUIT_FAILURES consecutive failures the circuit opens and calls
+fail immediately with LastfmUnavailable. Once LASTFM_CIRCUIT_RESET seconds have
+passed a single probe call is let through. If it succeeds the circuit closes
+again, otherwise it stays open for another cool-down.
+"""
+
+import threading
+import time
+
+from django.conf import settings
+
+from lastfm_auth.exceptions import LastfmUnavailable
+
+
+DEFAULT_FAILURES = 5
+DEFAULT_RESET = 30.0
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitBreaker(object):
+    """Thread-safe consecutive failure circuit breaker."""
+
+    def __init__(self, failures=DEFAULT_FAILURES, reset=DEFAULT_RESET):
+        self.failures = failures
+        self.reset = reset
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.rejected = 0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def before(self):
+        """Check a call may be made. Raise LastfmUnavailable when the circuit is open."""
+        if not self.failures:
+            return
+        with self._lock:
+            if self.state == CLOSED:
+                return
+            if self.state == OPEN and time.time() - self.opened_at >= self.reset:
+                self.state = HALF_OPEN
+            if self.state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return
+            self.rejected += 1
+        raise LastfmUnavailable('Last.fm circuit breaker is open')
+
+    def cancel(self):
+        """Forget a call let through by before which was not made."""
+        with self._lock:
+            self._probing = False
+
+    def success(self):
+        """Record a successful call."""
+        with self._lock:
+            self.state = CLOSED
+            self.consecutive_failures = 0
+            self.opened_at = None
+            self._probing = False
+
+    def failure(self):
+        """Record a failed call."""
+        with self._lock:
+            self.consecutive_failures += 1
+            if self.state == HALF_OPEN or (
+                    self.failures and self.consecutive_failures >= self.failures):
+                self.state = OPEN
+                self.opened_at = time.time()
+            self._probing = False
+
+    def stats(self):
+        """Return the current state for monitoring."""
+        with self._lock:
+            return {
+                'state': self.state,
+                'consecutive_failures': self.consecutive_failures,
+                'opened_at': self.opened_at,
+                'rejected': self.rejected,
+            }
+
+
+_breaker = None
+_breaker_key = None
+_breaker_lock = threading.Lock()
+
+
+def circuit_breaker():
+    """Return the shared circuit breaker for Last.fm calls."""
+    global _breaker, _breaker_key
+    failures = getattr(settings, 'LASTFM_CIRCUIT_FAILURES', DEFAULT_FAILURES)
+    reset = getattr(settings, 'LASTFM_CIRCUIT_RESET', DEFAULT_RESET)
+    key = (failures, reset)
+    with _breaker_lock:
+        if _breaker_key != key:
+            _breaker = CircuitBreaker(failures, reset)
+            _breaker_key = key
+        return _breaker
+
+
+def circuit_state():
+    """Return the state of the Last.fm circuit breaker for monitoring."""
+    return circuit_breaker().stats()
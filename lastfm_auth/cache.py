@@ -0,0 +1,353 @@
+"""
+Caching of Last.fm profile data returned by user.getinfo.
+
+Profiles are stored in the Django cache named by LASTFM_PROFILE_CACHE_ALIAS and
+fall back to a bounded in-process LRU when that cache is not configured or is
+unavailable. With LASTFM_HTTP_CACHE_TTL set the validators and max-age of
+user.getinfo responses are kept with the profile so it can be revalidated with
+a conditional request. Request tokens recently exchanged for sessions are kept in the
+Django cache named by LASTFM_TOKEN_REPLAY_ALIAS so duplicate callbacks can be
+answered in any process.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from hashlib import md5
+
+from django.conf import settings
+from django.core.cache import get_cache
+
+from lastfm_auth.exceptions import LastfmResponseError, LastfmAPIError
+
+
+DEFAULT_TTL = 300
+DEFAULT_STALE = 0
+DEFAULT_MAX_ENTRIES = 1000
+DEFAULT_ALIAS = 'default'
+DEFAULT_IDENTITY_TTL = 30 * 24 * 60 * 60
+DEFAULT_NEGATIVE_TTL = 0
+DEFAULT_HTTP_TTL = 0
+DEFAULT_TOKEN_REPLAY_WAIT = 5.0
+TOKEN_REPLAY_POLL = 0.05
+
+
+class LRUCache(object):
+    """Thread-safe in-process LRU cache with per-key expiry."""
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expires, value = self._data.pop(key)
+            except KeyError:
+                return default
+            if expires is not None and expires <= time.time():
+                return default
+            # Re-insert to mark as most recently used
+            self._data[key] = (expires, value)
+            return value
+
+    def set(self, key, value, timeout=None):
+        expires = time.time() + timeout if timeout is not None else None
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (expires, value)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class ProfileCache(object):
+    """
+    Cache of user.getinfo data keyed by Last.fm username.
+
+    Entries are fresh for `ttl` seconds and are then kept for another `stale`
+    seconds during which they may be served while being refreshed. The Last.fm
+    user id of each username is kept separately for `identity_ttl` seconds,
+    failed lookups for `negative_ttl` seconds and responses with their HTTP
+    validators for `http_ttl` seconds.
+    """
+
+    def __init__(self, ttl=DEFAULT_TTL, stale=DEFAULT_STALE,
+                 max_entries=DEFAULT_MAX_ENTRIES, alias=DEFAULT_ALIAS,
+                 identity_ttl=DEFAULT_IDENTITY_TTL, negative_ttl=DEFAULT_NEGATIVE_TTL,
+                 http_ttl=DEFAULT_HTTP_TTL):
+        self.ttl = ttl
+        self.stale = stale
+        self.identity_ttl = identity_ttl
+        self.negative_ttl = negative_ttl
+        self.http_ttl = http_ttl
+        self.local = LRUCache(max_entries)
+        self.backend = get_cache(alias) if alias else None
+
+    def key(self, username):
+        return 'lastfm_auth:profile:%s' % md5(username.encode('utf-8')).hexdigest()
+
+    def _get(self, key):
+        if self.backend is not None:
+            try:
+                return self.backend.get(key)
+            except Exception:
+                pass
+        return self.local.get(key)
+
+    def _set(self, key, value, timeout):
+        if self.backend is not None:
+            try:
+                self.backend.set(key, value, timeout)
+                return
+            except Exception:
+                pass
+        self.local.set(key, value, timeout)
+
+    def _delete(self, key):
+        if self.backend is not None:
+            try:
+                self.backend.delete(key)
+            except Exception:
+                pass
+        self.local.delete(key)
+
+    def get(self, username):
+        """
+        Return (data, age) for the cached profile or (None, None) when there
+        is no usable entry.
+        """
+        entry = self._get(self.key(username))
+        if entry is None:
+            return (None, None)
+        age = time.time() - entry['fetched']
+        if age >= self.ttl + self.stale:
+            return (None, None)
+        return (entry['data'], age)
+
+    def is_fresh(self, age, ttl=None):
+        """Return whether an entry of the given age is younger than ttl, by default self.ttl."""
+        return age is not None and age < (self.ttl if ttl is None else ttl)
+
+    def set(self, username, data):
+        entry = {'data': data, 'fetched': time.time()}
+        self._set(self.key(username), entry, self.ttl + self.stale)
+
+    def delete(self, username):
+        self._delete(self.key(username))
+
+    def identity_key(self, username):
+        return 'lastfm_auth:identity:%s' % md5(username.encode('utf-8')).hexdigest()
+
+    def get_identity(self, username):
+        """Return the remembered Last.fm user id for the username or None."""
+        return self._get(self.identity_key(username))
+
+    def set_identity(self, username, uid):
+        self._set(self.identity_key(username), uid, self.identity_ttl)
+
+    def delete_identity(self, username):
+        self._delete(self.identity_key(username))
+
+    def failure_key(self, username, error_class):
+        return 'lastfm_auth:failure:%s:%s' % (
+            error_class.__name__, md5(username.encode('utf-8')).hexdigest())
+
+    def get_failure(self, username):
+        """Return the error of a recent failed lookup of the username or None."""
+        for error_class in FAILURE_CLASSES:
+            args = self._get(self.failure_key(username, error_class))
+            if args is not None:
+                return error_class(*args)
+        return None
+
+    def set_failure(self, username, error):
+        """
+        Remember a failed lookup for negative_ttl seconds. Each error class
+        has its own entry and errors of other classes are not remembered.
+        """
+        if error.__class__ not in FAILURE_CLASSES:
+            return
+        if isinstance(error, LastfmAPIError):
+            args = (error.code, error.message)
+        else:
+            args = (str(error), )
+        self._set(self.failure_key(username, error.__class__), args, self.negative_ttl)
+
+    def delete_failure(self, username):
+        for error_class in FAILURE_CLASSES:
+            self._delete(self.failure_key(username, error_class))
+
+    def response_key(self, username):
+        return 'lastfm_auth:response:%s' % md5(username.encode('utf-8')).hexdigest()
+
+    def get_response(self, username, fields):
+        """
+        Return the stored user.getinfo response of the username as a dict of
+        data, etag, last_modified, max_age and expires or None. Responses
+        stored with other fields are ignored.
+        """
+        entry = self._get(self.response_key(username))
+        if entry is None or entry['fields'] != tuple(fields):
+            return None
+        return entry
+
+    def set_response(self, username, fields, data, validators):
+        """
+        Store user.getinfo data with the validators of its response for
+        http_ttl seconds. Responses without validators or max-age, or which
+        may not be stored, are removed instead.
+        """
+        if validators is None or not (validators.get('etag') or
+                validators.get('last_modified') or validators.get('max_age')):
+            self.delete_response(username)
+            return
+        max_age = validators.get('max_age') or 0
+        entry = dict(validators, data=data, fields=tuple(fields), max_age=max_age,
+                     expires=time.time() + max_age)
+        self._set(self.response_key(username), entry, max(self.http_ttl, max_age))
+
+    def delete_response(self, username):
+        self._delete(self.response_key(username))
+
+
+def response_validators(headers):
+    """
+    Return the etag, last_modified and max_age of a response from its headers,
+    with None for those it doesn't give, or None if it must not be stored.
+    """
+    directives = [
+        directive.strip().lower()
+        for directive in (headers.getheader('cache-control') or '').split(',')
+    ]
+    if 'no-store' in directives:
+        return None
+    max_age = None
+    if 'no-cache' in directives:
+        max_age = 0
+    else:
+        for directive in directives:
+            if directive.startswith('max-age='):
+                try:
+                    max_age = max(int(directive[len('max-age='):]), 0)
+                except ValueError:
+                    pass
+    return {
+        'etag': headers.getheader('etag'),
+        'last_modified': headers.getheader('last-modified'),
+        'max_age': max_age,
+    }
+
+
+# Errors which are remembered for failed lookups, in the order they are looked up.
+# Upstream errors are transient and are not remembered.
+FAILURE_CLASSES = (LastfmAPIError, LastfmResponseError)
+
+
+_profile_cache = None
+_profile_cache_key = None
+_profile_cache_lock = threading.Lock()
+
+
+def profile_cache():
+    """Return the shared profile cache for the current settings."""
+    global _profile_cache, _profile_cache_key
+    ttl = getattr(settings, 'LASTFM_PROFILE_CACHE_TTL', DEFAULT_TTL)
+    stale = getattr(settings, 'LASTFM_PROFILE_CACHE_STALE', DEFAULT_STALE)
+    max_entries = getattr(settings, 'LASTFM_PROFILE_CACHE_MAX_ENTRIES', DEFAULT_MAX_ENTRIES)
+    alias = getattr(settings, 'LASTFM_PROFILE_CACHE_ALIAS', DEFAULT_ALIAS)
+    identity_ttl = getattr(settings, 'LASTFM_IDENTITY_TTL', DEFAULT_IDENTITY_TTL)
+    negative_ttl = getattr(settings, 'LASTFM_NEGATIVE_CACHE_TTL', DEFAULT_NEGATIVE_TTL)
+    http_ttl = getattr(settings, 'LASTFM_HTTP_CACHE_TTL', DEFAULT_HTTP_TTL)
+    key = (ttl, stale, max_entries, alias, identity_ttl, negative_ttl, http_ttl)
+    with _profile_cache_lock:
+        if _profile_cache is None or _profile_cache_key != key:
+            _profile_cache = ProfileCache(
+                ttl=ttl, stale=stale, max_entries=max_entries, alias=alias,
+                identity_ttl=identity_ttl, negative_ttl=negative_ttl, http_ttl=http_ttl
+            )
+            _profile_cache_key = key
+        return _profile_cache
+
+
+def invalidate_profile(username):
+    """Remove all cached data for the given Last.fm username."""
+    cache = profile_cache()
+    cache.delete(username)
+    cache.delete_identity(username)
+    cache.delete_failure(username)
+    cache.delete_response(username)
+
+
+class TokenCache(object):
+    """
+    Sessions returned by auth.getSession keyed by request token.
+
+    The first callback claims a token before exchanging it. A duplicate
+    callback finds the claim and waits for the result instead of making a
+    second auth.getSession call which would fail. Entries record an owner,
+    the browser session which claimed the token, so results are only shared
+    with that session.
+    """
+
+    def __init__(self, ttl, alias=DEFAULT_ALIAS, wait=DEFAULT_TOKEN_REPLAY_WAIT):
+        self.ttl = ttl
+        self.wait = wait
+        self.backend = get_cache(alias)
+
+    def key(self, token):
+        return 'lastfm_auth:token:%s' % md5(token.encode('utf-8')).hexdigest()
+
+    def claim(self, token, owner):
+        """Claim the token for the owner. Return False if it was already claimed."""
+        return self.backend.add(self.key(token), {'owner': owner}, self.ttl)
+
+    def set(self, token, owner, session):
+        self.backend.set(self.key(token), {'owner': owner, 'session': session}, self.ttl)
+
+    def release(self, token):
+        """Remove the claim on a token which could not be exchanged."""
+        self.backend.delete(self.key(token))
+
+    def get(self, token, owner):
+        """
+        Return the entry for a claimed token, waiting up to `wait` seconds
+        while the owner's exchange is still in progress. Entries of other or
+        unknown owners are returned right away. Returns None if the claim was released.
+        """
+        deadline = time.time() + self.wait
+        while True:
+            entry = self.backend.get(self.key(token))
+            if entry is None or 'session' in entry or owner is None \
+                    or entry['owner'] != owner or time.time() >= deadline:
+                return entry
+            time.sleep(TOKEN_REPLAY_POLL)
+
+
+_token_cache = None
+_token_cache_key = None
+
+
+def token_cache():
+    """Return the shared TokenCache or None when LASTFM_TOKEN_REPLAY_TTL isn't set."""
+    global _token_cache, _token_cache_key
+    ttl = getattr(settings, 'LASTFM_TOKEN_REPLAY_TTL', None)
+    alias = getattr(settings, 'LASTFM_TOKEN_REPLAY_ALIAS', DEFAULT_ALIAS)
+    wait = getattr(settings, 'LASTFM_TOKEN_REPLAY_WAIT', DEFAULT_TOKEN_REPLAY_WAIT)
+    key = (ttl, alias, wait)
+    with _profile_cache_lock:
+        if _token_cache_key != key:
+            _token_cache = TokenCache(ttl, alias, wait) if ttl else None
+            _token_cache_key = key
+        return _token_cache
@@ -0,0 +1,203 @@
+"""
+HTTP client used for Last.fm API calls.
+
+Requests share a pool of keep-alive connections per host. This module is only
+imported by lastfm_auth.backend on the first API call so that processes which
+never talk to Last.fm don't pay for the HTTP and JSON machinery.
+"""
+
+import errno
+import httplib
+import socket
+import threading
+from cStringIO import StringIO
+from Queue import Queue, Empty, Full
+from urllib import addinfourl
+from urllib2 import HTTPError
+from urlparse import urlsplit
+
+from django.conf import settings
+from django.utils import simplejson
+
+try:
+    # Use a faster JSON decoder when one is installed
+    from ujson import loads as json_loads
+except ImportError:
+    json_loads = simplejson.loads
+
+from lastfm_auth.exceptions import LastfmResponseError
+
+
+DEFAULT_POOL_SIZE = 4
+DEFAULT_CONNECT_TIMEOUT = 3.0
+DEFAULT_READ_TIMEOUT = 10.0
+DEFAULT_MAX_RESPONSE_SIZE = 256 * 1024
+READ_CHUNK_SIZE = 8192
+
+
+class ConnectionPool(object):
+    """
+    Thread-safe pool of keep-alive HTTP(S) connections to a single host.
+
+    At most `size` idle connections are kept. Callers beyond that get a
+    fresh connection which is discarded after use rather than blocking.
+    """
+
+    def __init__(self, scheme, host, port=None, size=DEFAULT_POOL_SIZE,
+                 connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout=DEFAULT_READ_TIMEOUT, max_size=DEFAULT_MAX_RESPONSE_SIZE,
+                 connection_class=None):
+        self.scheme = scheme
+        self.host = host
+        self.port = port
+        self.size = size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_size = max_size
+        if connection_class is None:
+            if scheme == 'https':
+                connection_class = httplib.HTTPSConnection
+            else:
+                connection_class = httplib.HTTPConnection
+        self.connection_class = connection_class
+        self._idle = Queue(maxsize=size)
+
+    def _new_connection(self):
+        """Open a new connection using the connect and read timeouts."""
+        conn = self.connection_class(self.host, self.port, timeout=self.connect_timeout)
+        conn.connect()
+        if getattr(conn, 'sock', None) is not None:
+            conn.sock.settimeout(self.read_timeout)
+        return conn
+
+    def _get_connection(self):
+        """Return (connection, reused) taking an idle connection if possible."""
+        try:
+            return (self._idle.get_nowait(), True)
+        except Empty:
+            return (self._new_connection(), False)
+
+    def _put_connection(self, conn):
+        """Return a connection to the pool or close it if the pool is full."""
+        try:
+            self._idle.put_nowait(conn)
+        except Full:
+            conn.close()
+
+    def close(self):
+        """Close all idle connections."""
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except Empty:
+                break
+
+    def _read(self, response):
+        """Read the response body in chunks, enforcing the max size."""
+        length = response.getheader('content-length')
+        if self.max_size and length and length.isdigit() and int(length) > self.max_size:
+            raise LastfmResponseError('Response larger than %s bytes' % self.max_size)
+        chunks = []
+        size = 0
+        while True:
+            chunk = response.read(READ_CHUNK_SIZE)
+            if not chunk:
+                break
+            size += len(chunk)
+            if self.max_size and size > self.max_size:
+                raise LastfmResponseError('Response larger than %s bytes' % self.max_size)
+            chunks.append(chunk)
+        return ''.join(chunks)
+
+    def _send(self, conn, path, headers, reused):
+        """
+        Send a GET request and return the response. Returns None when a reused
+        connection was closed by the server before any response came back.
+        Errors after the request may have been received, like timeouts, are
+        raised so the request is never sent twice.
+        """
+        try:
+            conn.request('GET', path, headers=headers)
+        except socket.error as e:
+            if reused and e.errno in (errno.ECONNRESET, errno.EPIPE):
+                return None
+            raise
+        try:
+            return conn.getresponse()
+        except httplib.BadStatusLine as e:
+            # httplib reports an empty status line as repr('')
+            if reused and e.line in ('', repr('')):
+                return None
+            raise
+
+    def urlopen(self, url, headers=None):
+        """
+        GET the given url with any extra request headers and return a file-like
+        response as urllib2.urlopen would. Non-2xx responses raise HTTPError and
+        bodies over max_size raise LastfmResponseError.
+        """
+        headers = headers or {}
+        parts = urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path = '%s?%s' % (path, parts.query)
+        conn, reused = self._get_connection()
+        try:
+            response = self._send(conn, path, headers, reused)
+            if response is None:
+                # The server dropped the idle keep-alive connection before the
+                # request reached it so send it once more on a fresh one.
+                conn.close()
+                conn = self._new_connection()
+                response = self._send(conn, path, headers, False)
+        except:
+            conn.close()
+            raise
+        try:
+            body = self._read(response)
+        except:
+            conn.close()
+            raise
+        if response.will_close:
+            conn.close()
+        else:
+            self._put_connection(conn)
+        fp = addinfourl(StringIO(body), response.msg, url, response.status)
+        if not 200 <= response.status < 300:
+            raise HTTPError(url, response.status, response.reason, response.msg, fp)
+        return fp
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def connection_pool(url):
+    """Return the shared connection pool for the host of the given url."""
+    parts = urlsplit(url)
+    size = getattr(settings, 'LASTFM_POOL_SIZE', DEFAULT_POOL_SIZE)
+    connect_timeout = getattr(settings, 'LASTFM_CONNECT_TIMEOUT', DEFAULT_CONNECT_TIMEOUT)
+    read_timeout = getattr(settings, 'LASTFM_READ_TIMEOUT', DEFAULT_READ_TIMEOUT)
+    max_size = getattr(settings, 'LASTFM_MAX_RESPONSE_SIZE', DEFAULT_MAX_RESPONSE_SIZE)
+    key = (parts.scheme, parts.hostname, parts.port, size, connect_timeout,
+           read_timeout, max_size)
+    pool = _pools.get(key)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(key)
+            if pool is None:
+                pool = ConnectionPool(
+                    parts.scheme, parts.hostname, parts.port, size=size,
+                    connect_timeout=connect_timeout, read_timeout=read_timeout,
+                    max_size=max_size
+                )
+                _pools[key] = pool
+    return pool
+
+
+def close_pools():
+    """Close and discard all shared connection pools."""
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close()
+        _pools.clear()
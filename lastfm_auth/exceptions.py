@@ -0,0 +1,40 @@
+"""
+Errors raised for failed calls to the Last.fm API.
+"""
+
+
+class LastfmError(Exception):
+    """Base class for Last.fm API errors."""
+
+
+class LastfmUpstreamError(LastfmError):
+    """The request to Last.fm failed or timed out."""
+
+
+class LastfmResponseError(LastfmError):
+    """Last.fm returned a response which could not be used."""
+
+
+class LastfmAPIError(LastfmResponseError):
+    """Last.fm returned an API error code."""
+
+    def __init__(self, code, message=''):
+        super(LastfmAPIError, self).__init__('Last.fm error %s: %s' % (code, message))
+        self.code = code
+        self.message = message
+
+
+class LastfmUnavailable(LastfmError):
+    """Last.fm calls are failing fast because the circuit breaker is open."""
+
+
+class RateLimitExceeded(LastfmError):
+    """No request slot became available before the timeout."""
+
+
+class LastfmOverloaded(LastfmError):
+    """Too many Last.fm calls are in progress in this process."""
+
+
+class LastfmTokenUsed(LastfmError):
+    """The request token was already exchanged during another login."""
@@ -0,0 +1,133 @@
+"""
+Pool of Last.fm API keys.
+
+Last.fm throttles requests per API key. Several key and secret pairs can be
+configured with LASTFM_API_KEYS and each request uses the key with the fewest
+requests in flight, skipping keys which were throttled within the last
+LASTFM_KEY_COOLDOWN seconds. Per key usage is available from
+KeyPool.usage() and recorded with the lastfm_auth.api_key metric.
+"""
+
+import threading
+import time
+
+from lastfm_auth.exceptions import LastfmAPIError
+from lastfm_auth.metrics import incr
+
+
+DEFAULT_COOLDOWN = 30
+
+# Last.fm error code for requests over the rate limit of an API key
+RATE_LIMIT_EXCEEDED = 29
+
+
+class ApiKey(object):
+    """A Last.fm API key and secret with its usage counters."""
+
+    def __init__(self, key, secret):
+        self.key = key
+        self.secret = secret
+        self.in_flight = 0
+        self.requests = 0
+        self.throttled = 0
+        self.throttled_until = 0
+
+    @property
+    def name(self):
+        """Short name of the key used in logs and metrics."""
+        return self.key[:8]
+
+    def __repr__(self):
+        return '<ApiKey %s>' % self.name
+
+
+class KeyPool(object):
+    """Choose between API keys by throttling and requests in flight."""
+
+    def __init__(self, pairs, cooldown=DEFAULT_COOLDOWN):
+        self.keys = [ApiKey(key, secret) for key, secret in pairs]
+        self.cooldown = cooldown
+        self._by_key = dict((api_key.key, api_key) for api_key in self.keys)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def get(self, key):
+        """Return the ApiKey for the given api_key or None if it isn't in the pool."""
+        return self._by_key.get(key)
+
+    def choose(self):
+        """
+        Return the key with the fewest requests in flight which isn't cooling
+        down after being throttled. When all are throttled the key throttled
+        longest ago is used.
+        """
+        if len(self.keys) == 1:
+            return self.keys[0]
+        now = time.time()
+        with self._lock:
+            available = [k for k in self.keys if k.throttled_until <= now]
+            if not available:
+                return min(self.keys, key=lambda k: k.throttled_until)
+            return min(available, key=lambda k: (k.in_flight, k.requests))
+
+    def track(self, api_key):
+        """Return a context manager counting a request made with the key."""
+        return _Request(self, api_key)
+
+    def usage(self):
+        """Return a list of usage counters for each key."""
+        now = time.time()
+        with self._lock:
+            return [{
+                'key': k.name,
+                'requests': k.requests,
+                'in_flight': k.in_flight,
+                'throttled': k.throttled,
+                'available': k.throttled_until <= now,
+            } for k in self.keys]
+
+
+class _Request(object):
+
+    def __init__(self, pool, api_key):
+        self.pool = pool
+        self.api_key = api_key
+
+    def __enter__(self):
+        with self.pool._lock:
+            self.api_key.in_flight += 1
+            self.api_key.requests += 1
+        return self.api_key
+
+    def __exit__(self, exc_type, exc_value, tb):
+        throttled = isinstance(exc_value, LastfmAPIError) and \
+            exc_value.code == RATE_LIMIT_EXCEEDED
+        with self.pool._lock:
+            self.api_key.in_flight -= 1
+            if throttled:
+                self.api_key.throttled += 1
+                self.api_key.throttled_until = time.time() + self.pool.cooldown
+        if throttled:
+            result = 'throttled'
+        elif exc_type is not None:
+            result = 'error'
+        else:
+            result = 'ok'
+        incr('lastfm_auth.api_key', key=self.api_key.name, result=result)
+        return False
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_key_pool(pairs, cooldown=DEFAULT_COOLDOWN):
+    """Return the shared KeyPool for a sequence of (api_key, secret) pairs."""
+    key = (tuple(tuple(pair) for pair in pairs), cooldown)
+    pool = _pools.get(key)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.setdefault(key, KeyPool(pairs, cooldown))
+    return pool
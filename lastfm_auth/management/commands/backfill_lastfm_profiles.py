@@ -0,0 +1,60 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction, IntegrityError
+from django.utils import simplejson
+
+from social_auth.models import UserSocialAuth
+
+from lastfm_auth.backend import LastfmBackend
+from lastfm_auth.models import LastfmProfile, profile_values
+
+
+class Command(BaseCommand):
+    help = 'Create LastfmProfile rows for Last.fm accounts linked before LASTFM_PROFILES.'
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size', default=500,
+            help='Number of rows to load and insert at a time.'),
+    )
+
+    def build(self, pk, user_id, uid, extra_data):
+        """Return an unsaved LastfmProfile for a UserSocialAuth row."""
+        values = profile_values(extra_data)
+        values.setdefault('lastfm_id', uid)
+        values.setdefault('name', '')
+        return LastfmProfile(social_auth_id=pk, user_id=user_id, **values)
+
+    def insert(self, profiles):
+        """Insert a batch of profiles skipping any created by logins meanwhile."""
+        try:
+            with transaction.commit_on_success():
+                LastfmProfile.objects.bulk_create(profiles)
+            return len(profiles)
+        except IntegrityError:
+            existing = set(LastfmProfile.objects.filter(
+                social_auth__in=[p.social_auth_id for p in profiles]
+            ).values_list('social_auth', flat=True))
+            profiles = [p for p in profiles if p.social_auth_id not in existing]
+            with transaction.commit_on_success():
+                LastfmProfile.objects.bulk_create(profiles)
+            return len(profiles)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        if batch_size < 1:
+            raise CommandError('--batch-size must be at least 1.')
+        last_pk = 0
+        created = 0
+        while True:
+            rows = list(UserSocialAuth.objects.filter(
+                provider=LastfmBackend.name, pk__gt=last_pk, lastfm_profile__isnull=True
+            ).order_by('pk').values_list('pk', 'user', 'uid', 'extra_data')[:batch_size])
+            if not rows:
+                break
+            profiles = [
+                self.build(pk, user_id, uid, simplejson.loads(extra_data) if extra_data else {})
+                for pk, user_id, uid, extra_data in rows
+            ]
+            created += self.insert(profiles)
+            last_pk = rows[-1][0]
+        self.stdout.write('Created %s profiles.\n' % created)
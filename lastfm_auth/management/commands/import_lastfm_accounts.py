@@ -0,0 +1,146 @@
+import csv
+import sys
+from itertools import islice
+from optparse import make_option
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction, IntegrityError
+from django.utils import simplejson
+
+from social_auth.backends.pipeline.user import get_username
+from social_auth.models import UserSocialAuth
+
+from lastfm_auth.backend import LastfmBackend, profiles_enabled
+from lastfm_auth.models import LastfmProfile, profile_values
+
+
+class Command(BaseCommand):
+    args = '<file>'
+    help = (
+        'Create users linked to Last.fm accounts from a JSON lines or CSV file '
+        'of user.getinfo profiles. Use - to read from stdin.'
+    )
+    option_list = BaseCommand.option_list + (
+        make_option('--format', dest='format', default=None, choices=('jsonl', 'csv'),
+            help='Format of the file: jsonl or csv. Defaults to the file extension.'),
+        make_option('--batch-size', type='int', dest='batch_size', default=500,
+            help='Number of accounts to insert at a time.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Expected the path of a single file.')
+        batch_size = options['batch_size']
+        if batch_size < 1:
+            raise CommandError('--batch-size must be at least 1.')
+        path = args[0]
+        format = options['format'] or ('csv' if path.endswith('.csv') else 'jsonl')
+        self.backend = LastfmBackend()
+        self.profiles = profiles_enabled()
+        self.counts = {'created': 0, 'existing': 0, 'invalid': 0}
+        f = sys.stdin if path == '-' else open(path, 'rb')
+        try:
+            records = self.read_records(f, format)
+            while True:
+                batch = list(islice(records, batch_size))
+                if not batch:
+                    break
+                try:
+                    self.import_batch(batch)
+                except IntegrityError:
+                    # Accounts linked by logins meanwhile are skipped on the retry
+                    self.import_batch(batch)
+        finally:
+            if f is not sys.stdin:
+                f.close()
+        self.stdout.write(
+            'Created %(created)s accounts, skipped %(existing)s existing and '
+            '%(invalid)s invalid records.\n' % self.counts
+        )
+
+    def read_records(self, f, format):
+        """Yield user.getinfo dicts read from the file, one line at a time."""
+        if format == 'csv':
+            lines = (
+                dict((key, value.decode('utf-8')) for key, value in row.items() if value)
+                for row in csv.DictReader(f)
+            )
+        else:
+            lines = (line for line in f if line.strip())
+        for number, line in enumerate(lines, 1):
+            try:
+                response = simplejson.loads(line) if format == 'jsonl' else line
+            except ValueError:
+                response = None
+            if not isinstance(response, dict) or not response.get('id') or not response.get('name'):
+                self.counts['invalid'] += 1
+                self.stderr.write('Skipped invalid record %s.\n' % number)
+                continue
+            yield dict((key, value) for key, value in response.items() if value is not None)
+
+    def map_record(self, response):
+        """Return (uid, details, extra_data) for a user.getinfo profile."""
+        details = self.backend.get_user_details(response)
+        uid = unicode(self.backend.get_user_id(details, response))
+        extra_data = self.backend.extra_data(None, uid, response, details)
+        return uid, details, extra_data
+
+    def import_batch(self, batch):
+        """Create the users, linked accounts and profiles of a batch of records."""
+        accounts = {}
+        for response in batch:
+            uid, details, extra_data = self.map_record(response)
+            accounts.setdefault(uid, (response, details, extra_data))
+        existing = set(UserSocialAuth.objects.filter(
+            provider=self.backend.name, uid__in=accounts.keys()
+        ).values_list('uid', flat=True))
+        skipped = len(batch) - len(accounts) + len(existing)
+        for uid in existing:
+            del accounts[uid]
+        if not accounts:
+            self.counts['existing'] += skipped
+            return
+        names = [row_details['username'] for row_response, row_details, row_extra in accounts.values()]
+        taken = set(User.objects.filter(username__in=names).values_list('username', flat=True))
+
+        def user_exists(username):
+            return username in taken or (
+                username not in names and User.objects.filter(username=username).exists())
+
+        users = {}
+        for uid, (response, details, extra_data) in accounts.items():
+            username = get_username(details, user_exists=user_exists)['username']
+            taken.add(username)
+            user = User(
+                username=username, email=details.get('email', ''),
+                first_name=details.get('first_name', ''), last_name=details.get('last_name', '')
+            )
+            user.set_unusable_password()
+            users[uid] = user
+        with transaction.commit_on_success():
+            User.objects.bulk_create(users.values())
+            # bulk_create doesn't set primary keys
+            user_ids = dict(User.objects.filter(
+                username__in=[row_user.username for row_user in users.values()]
+            ).values_list('username', 'pk'))
+            UserSocialAuth.objects.bulk_create([
+                UserSocialAuth(
+                    user_id=user_ids[users[row_uid].username], provider=self.backend.name,
+                    uid=row_uid, extra_data=row_extra
+                )
+                for row_uid, (row_response, row_details, row_extra) in accounts.items()
+            ])
+            if self.profiles:
+                social_ids = UserSocialAuth.objects.filter(
+                    provider=self.backend.name, uid__in=accounts.keys()
+                ).values_list('uid', 'pk', 'user')
+                LastfmProfile.objects.bulk_create([
+                    LastfmProfile(
+                        social_auth_id=social_id, user_id=user_id,
+                        **dict({'lastfm_id': row_uid}, **profile_values(accounts[row_uid][0]))
+                    )
+                    for row_uid, social_id, user_id in social_ids
+                ])
+        self.counts['existing'] += skipped
+        self.counts['created'] += len(accounts)
@@ -0,0 +1,98 @@
+import os
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import simplejson
+
+from social_auth.models import UserSocialAuth
+
+from lastfm_auth.backend import LastfmAuth, LastfmBackend
+from lastfm_auth.ratelimit import TokenBucket
+from lastfm_auth.utils import imap_unordered
+
+
+class Command(BaseCommand):
+    help = 'Refresh the Last.fm extra_data stored on UserSocialAuth.'
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size', default=500,
+            help='Number of rows to load and update at a time.'),
+        make_option('--workers', type='int', dest='workers', default=4,
+            help='Number of concurrent user.getinfo requests.'),
+        make_option('--rate', type='float', dest='rate', default=5.0,
+            help='Max user.getinfo requests per second. 0 for no limit.'),
+        make_option('--checkpoint', dest='checkpoint', default=None,
+            help='File used to record progress so the refresh can be resumed.'),
+    )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        if batch_size < 1:
+            raise CommandError('--batch-size must be at least 1.')
+        checkpoint = options['checkpoint']
+        self.auth = LastfmAuth()
+        self.backend = LastfmBackend()
+        self.limiter = TokenBucket(options['rate'], burst=1) if options['rate'] else None
+        self.workers = options['workers']
+        last_pk = self.read_checkpoint(checkpoint)
+        counts = {'checked': 0, 'updated': 0, 'failed': 0}
+        while True:
+            rows = list(UserSocialAuth.objects.filter(
+                provider=LastfmBackend.name, pk__gt=last_pk
+            ).order_by('pk').values_list(
+                'pk', 'uid', 'extra_data', 'user__username'
+            )[:batch_size])
+            if not rows:
+                break
+            rows = [
+                (pk, uid, simplejson.loads(extra_data) if extra_data else {}, username)
+                for pk, uid, extra_data, username in rows
+            ]
+            changes = self.refresh_batch(rows, counts)
+            if changes:
+                with transaction.commit_on_success():
+                    for pk, extra_data in changes:
+                        UserSocialAuth.objects.filter(pk=pk).update(extra_data=extra_data)
+            counts['updated'] += len(changes)
+            last_pk = rows[-1][0]
+            self.write_checkpoint(checkpoint, last_pk)
+        self.stdout.write(
+            'Checked %(checked)s profiles, updated %(updated)s, '
+            'failed %(failed)s.\n' % counts
+        )
+
+    def refresh_batch(self, rows, counts):
+        """Return a list of (pk, extra_data) for rows whose data has changed."""
+        changes = []
+        for row, response, exc_info in imap_unordered(self.fetch, rows, self.workers):
+            counts['checked'] += 1
+            pk, uid, extra_data, username = row
+            if exc_info is not None or response is None or response.get('id') != uid:
+                counts['failed'] += 1
+                continue
+            response = dict(response, access_token=extra_data.get('access_token', ''))
+            data = dict(extra_data)
+            data.update(self.backend.extra_data(None, uid, response, None))
+            if data != extra_data:
+                changes.append((pk, data))
+        return changes
+
+    def fetch(self, row):
+        """Fetch the current user.getinfo data for a row."""
+        pk, uid, extra_data, username = row
+        if self.limiter is not None:
+            self.limiter.acquire()
+        return self.auth.fetch_user_data(extra_data.get('name') or username)
+
+    def read_checkpoint(self, path):
+        """Return the last processed pk recorded in the checkpoint file."""
+        if path and os.path.exists(path):
+            with open(path) as f:
+                return int(f.read().strip() or 0)
+        return 0
+
+    def write_checkpoint(self, path, pk):
+        """Record the last processed pk in the checkpoint file."""
+        if path:
+            with open(path, 'w') as f:
+                f.write('%s' % pk)
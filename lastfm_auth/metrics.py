@@ -0,0 +1,184 @@
+"""
+Instrumentation of the Last.fm login flow.
+
+Set LASTFM_METRICS to the dotted path of a Metrics subclass to record timings
+and outcomes of each stage, upstream latency and payload sizes, error classes
+and profile cache hit rates. With no sink configured the hooks only check a
+module level variable.
+"""
+
+import socket
+import threading
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.importlib import import_module
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Metrics(object):
+    """Interface for metrics sinks. The default implementation does nothing."""
+
+    def incr(self, name, value=1, tags=None):
+        """Increment a counter."""
+
+    def timing(self, name, seconds, tags=None):
+        """Record a duration in seconds."""
+
+    def histogram(self, name, value, tags=None):
+        """Record a value such as a payload size."""
+
+
+class StatsdMetrics(Metrics):
+    """
+    Send metrics to statsd over UDP. Tag values are appended to the metric
+    name in key order since plain statsd has no tags.
+    """
+
+    def __init__(self, host=None, port=None, prefix=None):
+        self.host = host or getattr(settings, 'LASTFM_STATSD_HOST', 'localhost')
+        self.port = port or getattr(settings, 'LASTFM_STATSD_PORT', 8125)
+        self.prefix = prefix or getattr(settings, 'LASTFM_STATSD_PREFIX', '')
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def name(self, name, tags):
+        parts = [self.prefix, name] if self.prefix else [name]
+        if tags:
+            parts.extend(str(tags[key]).replace('.', '_') for key in sorted(tags))
+        return '.'.join(parts)
+
+    def send(self, name, value, kind, tags):
+        data = '%s:%s|%s' % (self.name(name, tags), value, kind)
+        try:
+            self.sock.sendto(data, (self.host, self.port))
+        except socket.error:
+            pass
+
+    def incr(self, name, value=1, tags=None):
+        self.send(name, value, 'c', tags)
+
+    def timing(self, name, seconds, tags=None):
+        self.send(name, int(seconds * 1000), 'ms', tags)
+
+    def histogram(self, name, value, tags=None):
+        self.send(name, value, 'h', tags)
+
+
+class MemoryMetrics(Metrics):
+    """
+    Keep Prometheus style counters and bucketed histograms in memory. Useful
+    for tests or to expose through a monitoring view.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counters = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def key(self, name, tags):
+        return (name, tuple(sorted(tags.items())) if tags else ())
+
+    def incr(self, name, value=1, tags=None):
+        key = self.key(name, tags)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def timing(self, name, seconds, tags=None):
+        self.histogram(name, seconds, tags)
+
+    def histogram(self, name, value, tags=None):
+        key = self.key(name, tags)
+        with self._lock:
+            data = self.histograms.get(key)
+            if data is None:
+                data = self.histograms[key] = {
+                    'count': 0, 'sum': 0, 'buckets': [0] * len(self.buckets)}
+            data['count'] += 1
+            data['sum'] += value
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    data['buckets'][i] += 1
+
+    def count(self, name, **tags):
+        """Return a counter value."""
+        return self.counters.get(self.key(name, tags), 0)
+
+    def observations(self, name, **tags):
+        """Return the number of values recorded for a histogram."""
+        data = self.histograms.get(self.key(name, tags))
+        return data['count'] if data else 0
+
+
+_sink = None
+_sink_path = None
+_sink_lock = threading.Lock()
+
+
+def get_metrics():
+    """Return the configured metrics sink or None."""
+    global _sink, _sink_path
+    path = getattr(settings, 'LASTFM_METRICS', None)
+    if path == _sink_path:
+        return _sink
+    with _sink_lock:
+        if not path:
+            _sink = None
+        elif isinstance(path, Metrics):
+            _sink = path
+        else:
+            module, attr = path.rsplit('.', 1)
+            try:
+                _sink = getattr(import_module(module), attr)()
+            except (ImportError, AttributeError) as e:
+                raise ImproperlyConfigured('Error loading LASTFM_METRICS %s: %s' % (path, e))
+        _sink_path = path
+        return _sink
+
+
+class stage(object):
+    """Time a stage of the login flow and record its outcome."""
+
+    def __init__(self, name, **tags):
+        self.name = name
+        self.tags = tags
+
+    def __enter__(self):
+        self.sink = get_metrics()
+        if self.sink is not None:
+            self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if self.sink is not None:
+            tags = dict(self.tags, outcome=exc_type.__name__ if exc_type else 'ok')
+            self.sink.timing('lastfm_auth.%s' % self.name, time.time() - self.start, tags)
+
+
+def instrumented(name):
+    """Decorator to time a method as a stage of the login flow."""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def incr(name, value=1, **tags):
+    """Increment a counter when a sink is configured."""
+    sink = get_metrics()
+    if sink is not None:
+        sink.incr(name, value, tags)
+
+
+def histogram(name, value, **tags):
+    """Record a value when a sink is configured."""
+    sink = get_metrics()
+    if sink is not None:
+        sink.histogram(name, value, tags)
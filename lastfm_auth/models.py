@@ -1,3 +1,84 @@
+"""
+Denormalized Last.fm profile data.
+
+With LASTFM_PROFILES enabled the backend keeps a LastfmProfile row for each
+linked Last.fm account so users can be queried by Last.fm name, id, country,
+playcount or registration time without decoding UserSocialAuth.extra_data.
+Existing accounts are filled in with the backfill_lastfm_profiles command.
+"""
+
+from datetime import datetime
+
+from django.contrib.auth.models import User
 from django.db import models
 
-# Create your models here.
+from social_auth.models import UserSocialAuth
+
+
+def profile_values(response):
+    """
+    Return the LastfmProfile field values found in a user.getinfo response or
+    stored extra_data. Fields missing from the response are left out.
+    """
+    values = {}
+    if response.get('id'):
+        values['lastfm_id'] = unicode(response['id'])
+    if response.get('name'):
+        values['name'] = response['name']
+    if 'country' in response:
+        values['country'] = response['country'] or ''
+    if 'playcount' in response:
+        try:
+            values['playcount'] = int(response['playcount'])
+        except (TypeError, ValueError):
+            values['playcount'] = None
+    if 'registered' in response:
+        registered = response['registered']
+        if isinstance(registered, dict):
+            registered = registered.get('unixtime')
+        try:
+            values['registered'] = datetime.utcfromtimestamp(int(registered))
+        except (TypeError, ValueError):
+            values['registered'] = None
+    return values
+
+
+class LastfmProfileManager(models.Manager):
+
+    def sync(self, social_user, response):
+        """
+        Create or update the profile of a UserSocialAuth from a user.getinfo
+        response. The row is only written when a value has changed.
+        """
+        values = profile_values(response)
+        values.setdefault('lastfm_id', social_user.uid)
+        try:
+            profile = self.get(social_auth=social_user)
+        except self.model.DoesNotExist:
+            values.setdefault('name', '')
+            return self.create(social_auth=social_user, user_id=social_user.user_id, **values)
+        changes = dict(
+            (name, value) for name, value in values.items()
+            if getattr(profile, name) != value
+        )
+        if changes:
+            self.filter(pk=profile.pk).update(**changes)
+            for name, value in changes.items():
+                setattr(profile, name, value)
+        return profile
+
+
+class LastfmProfile(models.Model):
+    """Last.fm profile of a linked account with indexed lookup columns."""
+    social_auth = models.OneToOneField(UserSocialAuth, related_name='lastfm_profile')
+    user = models.ForeignKey(User, related_name='lastfm_profiles')
+    lastfm_id = models.CharField(max_length=32, unique=True)
+    name = models.CharField(max_length=64, db_index=True)
+    country = models.CharField(max_length=64, blank=True, default='', db_index=True)
+    playcount = models.PositiveIntegerField(null=True, blank=True, db_index=True)
+    registered = models.DateTimeField(null=True, blank=True, db_index=True)
+
+    objects = LastfmProfileManager()
+
+    def __unicode__(self):
+        return self.name
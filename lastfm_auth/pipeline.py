@@ -0,0 +1,55 @@
+"""
+django-social-auth pipeline functions which skip redundant writes.
+
+The Last.fm backend fingerprints the user details and extra data it maps from
+each login. When the fingerprint stored on UserSocialAuth matches, the updates
+of the UserSocialAuth and User rows are skipped. To use them replace the
+default entries in SOCIAL_AUTH_PIPELINE:
+
+    'social_auth.backends.pipeline.social.load_extra_data',
+    'social_auth.backends.pipeline.user.update_user_details',
+
+with:
+
+    'lastfm_auth.pipeline.load_extra_data',
+    'lastfm_auth.pipeline.update_user_details',
+
+Other backends fall through to the default behaviour.
+"""
+
+from social_auth.backends.pipeline import social, user as user_pipeline
+from social_auth.models import UserSocialAuth
+
+from lastfm_auth.metrics import incr
+
+
+FINGERPRINT_KEY = 'fingerprint'
+
+
+def load_extra_data(backend, details, response, social_user, uid, user,
+                    *args, **kwargs):
+    """
+    Store extra data on the UserSocialAuth unless its fingerprint is unchanged
+    in which case `details_unchanged` is passed to the rest of the pipeline.
+    """
+    if not hasattr(backend, 'fingerprint'):
+        return social.load_extra_data(backend, details, response, social_user,
+                                      uid, user, *args, **kwargs)
+    extra_data = backend.extra_data(user, uid, response, details)
+    extra_data[FINGERPRINT_KEY] = backend.fingerprint(details, extra_data)
+    current = social_user.extra_data or {}
+    if current.get(FINGERPRINT_KEY) == extra_data[FINGERPRINT_KEY]:
+        incr('lastfm_auth.writes_avoided', model='usersocialauth')
+        return {'details_unchanged': True}
+    UserSocialAuth.objects.filter(pk=social_user.pk).update(extra_data=extra_data)
+    social_user.extra_data = extra_data
+
+
+def update_user_details(backend, details, response, user, is_new=False,
+                        *args, **kwargs):
+    """Update the user details unless they are known to be unchanged."""
+    if kwargs.get('details_unchanged') and not is_new:
+        incr('lastfm_auth.writes_avoided', model='user')
+        return
+    return user_pipeline.update_user_details(backend, details, response, user,
+                                             is_new, *args, **kwargs)
@@ -0,0 +1,266 @@
+"""
+Client-side rate limiting and request coalescing for Last.fm API calls.
+
+Last.fm throttles requests per API key. Setting LASTFM_RATE_LIMIT limits the
+number of upstream calls per second made by this process or, when
+LASTFM_RATE_LIMIT_CACHE names a Django cache, by all processes sharing it.
+Setting LASTFM_MAX_IN_FLIGHT limits the number of upstream calls in progress
+at once in this process.
+"""
+
+import sys
+import threading
+import time
+from abc import ABCMeta, abstractmethod
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import get_cache
+
+from lastfm_auth.exceptions import RateLimitExceeded, LastfmOverloaded
+from lastfm_auth.metrics import incr
+
+
+DEFAULT_RATE_LIMIT_TIMEOUT = 1.0
+DEFAULT_IN_FLIGHT_TIMEOUT = 0.1
+
+
+class Limiter(object):
+    """Base class for limiters which implement take."""
+    __metaclass__ = ABCMeta
+
+    @abstractmethod
+    def take(self):
+        """Take a slot. Return 0 on success or the seconds until one is available."""
+
+    def acquire(self, timeout=None):
+        """Wait up to `timeout` seconds for a slot. Return whether one was taken."""
+        deadline = time.time() + timeout if timeout is not None else None
+        while True:
+            wait = self.take()
+            if not wait:
+                return True
+            if deadline is not None and time.time() + wait > deadline:
+                return False
+            time.sleep(wait)
+
+
+class TokenBucket(Limiter):
+    """Thread-safe in-process token bucket."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = burst or max(1, self.rate)
+        self.tokens = self.burst
+        self.updated = time.time()
+        self._lock = threading.Lock()
+
+    def take(self):
+        with self._lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+
+class CacheRateLimiter(Limiter):
+    """
+    Rate limiter shared across processes through a Django cache.
+
+    Requests are counted in one second windows using the atomic cache incr so
+    this is an approximation of a token bucket without any burst allowance.
+    """
+
+    def __init__(self, rate, cache, prefix='lastfm_auth:ratelimit'):
+        self.rate = int(rate) or 1
+        self.cache = cache
+        self.prefix = prefix
+
+    def take(self):
+        now = time.time()
+        window = int(now)
+        key = '%s:%s' % (self.prefix, window)
+        self.cache.add(key, 0, 2)
+        try:
+            count = self.cache.incr(key)
+        except ValueError:
+            # Key expired between add and incr
+            self.cache.add(key, 1, 2)
+            count = 1
+        if count <= self.rate:
+            return 0
+        return window + 1 - now
+
+
+class InFlightLimiter(object):
+    """Thread-safe limit on the number of calls in progress at once."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_flight = 0
+        self.waiting = 0
+        self.queued = 0
+        self.rejected = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, timeout=None):
+        """Wait up to `timeout` seconds for a free slot. Return whether one was taken."""
+        with self._cond:
+            if self.in_flight < self.limit:
+                self.in_flight += 1
+                return True
+            taken = timeout and self._wait(time.time() + timeout)
+            if not taken:
+                self.rejected += 1
+        if timeout:
+            incr('lastfm_auth.in_flight', result='queued')
+        if not taken:
+            incr('lastfm_auth.in_flight', result='rejected')
+        return bool(taken)
+
+    def _wait(self, deadline):
+        """Wait for a free slot until the deadline. Called with the lock held."""
+        self.queued += 1
+        self.waiting += 1
+        try:
+            while self.in_flight >= self.limit:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        finally:
+            self.waiting -= 1
+        self.in_flight += 1
+        return True
+
+    def release(self):
+        """Free a slot taken with acquire."""
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify()
+
+    def stats(self):
+        """Return the current counters for monitoring."""
+        with self._cond:
+            return {
+                'limit': self.limit,
+                'in_flight': self.in_flight,
+                'waiting': self.waiting,
+                'queued': self.queued,
+                'rejected': self.rejected,
+            }
+
+
+class SingleFlight(object):
+    """Coalesce concurrent calls with the same key into a single call."""
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func, *args, **kwargs):
+        """
+        Call func unless a call for the same key is in progress in which case
+        wait for and return its result. Exceptions are raised to all callers.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            call.done.wait()
+            if call.exc_info is not None:
+                raise call.exc_info[1]
+            return call.result
+        try:
+            call.result = func(*args, **kwargs)
+        except:
+            call.exc_info = sys.exc_info()
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+
+class _Call(object):
+    """State of an in-progress SingleFlight call."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.exc_info = None
+
+
+_limiter = None
+_limiter_key = None
+_limiter_lock = threading.Lock()
+
+
+def upstream_limiter():
+    """Return the shared limiter for Last.fm calls or None when disabled."""
+    global _limiter, _limiter_key
+    rate = getattr(settings, 'LASTFM_RATE_LIMIT', None)
+    burst = getattr(settings, 'LASTFM_RATE_LIMIT_BURST', None)
+    alias = getattr(settings, 'LASTFM_RATE_LIMIT_CACHE', None)
+    key = (rate, burst, alias)
+    with _limiter_lock:
+        if _limiter_key != key:
+            if not rate:
+                _limiter = None
+            elif alias:
+                _limiter = CacheRateLimiter(rate, get_cache(alias))
+            else:
+                _limiter = TokenBucket(rate, burst)
+            _limiter_key = key
+        return _limiter
+
+
+def throttle():
+    """Wait for a slot for an upstream call or raise RateLimitExceeded."""
+    limiter = upstream_limiter()
+    if limiter is None:
+        return
+    timeout = getattr(settings, 'LASTFM_RATE_LIMIT_TIMEOUT', DEFAULT_RATE_LIMIT_TIMEOUT)
+    if not limiter.acquire(timeout):
+        raise RateLimitExceeded('Last.fm rate limit exceeded')
+
+
+_in_flight = None
+_in_flight_limit = None
+_in_flight_lock = threading.Lock()
+
+
+def in_flight_limiter():
+    """Return the shared in-flight limit for Last.fm calls or None when disabled."""
+    global _in_flight, _in_flight_limit
+    limit = getattr(settings, 'LASTFM_MAX_IN_FLIGHT', None)
+    with _in_flight_lock:
+        if _in_flight_limit != limit:
+            _in_flight = InFlightLimiter(limit) if limit else None
+            _in_flight_limit = limit
+        return _in_flight
+
+
+@contextmanager
+def admitted():
+    """
+    Hold one of the LASTFM_MAX_IN_FLIGHT slots for an upstream call. Raise
+    LastfmOverloaded if none is free within LASTFM_IN_FLIGHT_TIMEOUT seconds.
+    """
+    limiter = in_flight_limiter()
+    if limiter is None:
+        yield
+        return
+    timeout = getattr(settings, 'LASTFM_IN_FLIGHT_TIMEOUT', DEFAULT_IN_FLIGHT_TIMEOUT)
+    if not limiter.acquire(timeout):
+        raise LastfmOverloaded('Too many Last.fm calls in progress')
+    try:
+        yield
+    finally:
+        limiter.release()
@@ -0,0 +1,153 @@
+"""
+Retries and hedged requests for idempotent Last.fm calls.
+
+Only user.getinfo is retried or hedged. auth.getSession exchanges a single use
+token so a second request could fail even though the first one succeeded.
+
+LASTFM_RETRIES failed attempts are retried after a random delay of up to
+LASTFM_RETRY_BACKOFF seconds, doubling for each further attempt. With
+LASTFM_HEDGE_DELAY set a second request is sent when the first hasn't answered
+within that many seconds and the first answer is used. Hedges are paid for by
+a budget of LASTFM_HEDGE_BUDGET extra requests per request so they can't
+multiply the load during an outage.
+"""
+
+import random
+import sys
+import threading
+import time
+from Queue import Queue, Empty
+
+from django.conf import settings
+
+from lastfm_auth.breaker import circuit_breaker, CLOSED
+from lastfm_auth.exceptions import LastfmAPIError, LastfmUpstreamError
+from lastfm_auth.metrics import incr
+
+
+DEFAULT_RETRIES = 0
+DEFAULT_RETRY_BACKOFF = 0.1
+DEFAULT_HEDGE_BUDGET = 0.1
+DEFAULT_HEDGE_BURST = 10
+
+# Last.fm error codes for failures which are worth trying again
+RETRYABLE_CODES = (
+    8, # Operation failed
+    11, # Service offline
+    16, # Temporary error
+)
+
+
+def retryable(error):
+    """Return whether a failed request may succeed when sent again."""
+    if isinstance(error, LastfmAPIError):
+        return error.code in RETRYABLE_CODES
+    return isinstance(error, LastfmUpstreamError)
+
+
+def backoff_delay(attempt, backoff):
+    """Return a random delay before the given retry with exponential backoff."""
+    return random.uniform(0, backoff * (2 ** attempt))
+
+
+def with_retries(func, *args):
+    """Call func, retrying failures up to LASTFM_RETRIES times."""
+    retries = getattr(settings, 'LASTFM_RETRIES', DEFAULT_RETRIES)
+    backoff = getattr(settings, 'LASTFM_RETRY_BACKOFF', DEFAULT_RETRY_BACKOFF)
+    attempt = 0
+    while True:
+        try:
+            return func(*args)
+        except Exception as e:
+            if attempt >= retries or not retryable(e):
+                raise
+            incr('lastfm_auth.retries', error=e.__class__.__name__)
+            time.sleep(backoff_delay(attempt, backoff))
+            attempt += 1
+
+
+class HedgeBudget(object):
+    """
+    Allowance of hedged requests. Each request adds `ratio` of a hedge up to
+    `burst` and each hedge uses one.
+    """
+
+    def __init__(self, ratio=DEFAULT_HEDGE_BUDGET, burst=DEFAULT_HEDGE_BURST):
+        self.ratio = ratio
+        self.burst = burst
+        self.tokens = burst
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self.tokens = min(self.burst, self.tokens + self.ratio)
+
+    def withdraw(self):
+        """Use a hedge from the budget. Return False if none is left."""
+        with self._lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+_budget = None
+_budget_key = None
+_budget_lock = threading.Lock()
+
+
+def hedge_budget():
+    """Return the shared hedge budget for the current settings."""
+    global _budget, _budget_key
+    ratio = getattr(settings, 'LASTFM_HEDGE_BUDGET', DEFAULT_HEDGE_BUDGET)
+    burst = getattr(settings, 'LASTFM_HEDGE_BURST', DEFAULT_HEDGE_BURST)
+    key = (ratio, burst)
+    with _budget_lock:
+        if _budget is None or _budget_key != key:
+            _budget = HedgeBudget(ratio, burst)
+            _budget_key = key
+        return _budget
+
+
+def hedged(func, *args):
+    """
+    Call func, calling it a second time in parallel if the first call hasn't
+    returned after LASTFM_HEDGE_DELAY seconds. The first successful result is
+    returned, otherwise the error of the last call to finish is raised.
+    """
+    delay = getattr(settings, 'LASTFM_HEDGE_DELAY', None)
+    if delay is None:
+        return func(*args)
+    budget = hedge_budget()
+    budget.deposit()
+    results = Queue()
+
+    def call():
+        try:
+            results.put((func(*args), None))
+        except Exception:
+            results.put((None, sys.exc_info()))
+
+    def start():
+        thread = threading.Thread(target=call)
+        thread.daemon = True
+        thread.start()
+
+    start()
+    calls = 1
+    try:
+        result, exc_info = results.get(timeout=delay)
+    except Empty:
+        # Don't add load while the circuit breaker sees failures
+        breaker = circuit_breaker()
+        if breaker.state == CLOSED and not breaker.consecutive_failures \
+                and budget.withdraw():
+            incr('lastfm_auth.hedges')
+            start()
+            calls = 2
+        result, exc_info = results.get()
+    if exc_info is not None and calls == 2:
+        result, exc_info = results.get()
+    if exc_info is not None:
+        raise exc_info[0], exc_info[1], exc_info[2]
+    return result
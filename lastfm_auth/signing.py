@@ -0,0 +1,93 @@
+"""
+Signing and url building for Last.fm API requests.
+
+Last.fm signs a request by sorting its parameters other than format and
+callback by name, concatenating each name and value, appending the secret and
+taking the md5 of the result. See http://www.last.fm/api/authspec#8
+"""
+
+import threading
+from hashlib import md5
+from urllib import quote_plus, urlencode
+
+
+UNSIGNED_PARAMS = ('format', 'callback', 'api_sig', )
+
+
+def _encode(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+def sign_params(params, secret):
+    """Return the api_sig for a dictionary of request parameters."""
+    keys = sorted(k for k in params if k not in UNSIGNED_PARAMS)
+    signed = ''.join('%s%s' % (k, _encode(params[k])) for k in keys)
+    return md5(signed + _encode(secret)).hexdigest()
+
+
+class Signer(object):
+    """
+    Sign requests and build request urls for one API key, secret and server.
+
+    The static part of each method's url and the hash of its leading signed
+    parameters are computed once and reused.
+    """
+
+    def __init__(self, api_key, secret, server):
+        self.api_key = api_key
+        self.secret = _encode(secret)
+        self.server = server
+        self._bases = {}
+        self._prefixes = {}
+
+    def base_url(self, method):
+        """Return the url with the api_key, format and method parameters."""
+        base = self._bases.get(method)
+        if base is None:
+            query = urlencode([('api_key', self.api_key), ('format', 'json'), ('method', method)])
+            base = self._bases[method] = '%s?%s' % (self.server, query)
+        return base
+
+    def _prefix(self, method):
+        """Return an md5 already fed with the api_key and method parameters."""
+        prefix = self._prefixes.get(method)
+        if prefix is None:
+            prefix = self._prefixes[method] = md5(
+                'api_key%smethod%s' % (_encode(self.api_key), _encode(method)))
+        return prefix
+
+    def sign(self, method, params):
+        """Return the api_sig for a method call with the given parameters."""
+        keys = [k for k in params if k not in UNSIGNED_PARAMS]
+        keys.sort()
+        if keys and keys[0] <= 'method':
+            # Parameters sort among the static ones so use the general path
+            full = dict(params, api_key=self.api_key, method=method)
+            return sign_params(full, self.secret)
+        digest = self._prefix(method).copy()
+        digest.update(''.join([k + _encode(params[k]) for k in keys]) + self.secret)
+        return digest.hexdigest()
+
+    def url(self, method, params, signed=False):
+        """Return the request url for a method call, signed if required."""
+        query = ['%s=%s' % (k, quote_plus(_encode(params[k]))) for k in sorted(params)]
+        if signed:
+            query.append('api_sig=' + self.sign(method, params))
+        query.insert(0, self.base_url(method))
+        return '&'.join(query)
+
+
+_signers = {}
+_signers_lock = threading.Lock()
+
+
+def get_signer(api_key, secret, server):
+    """Return the shared Signer for an API key, secret and server."""
+    key = (api_key, secret, server)
+    signer = _signers.get(key)
+    if signer is None:
+        with _signers_lock:
+            signer = _signers.setdefault(key, Signer(api_key, secret, server))
+    return signer
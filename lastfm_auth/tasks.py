@@ -0,0 +1,177 @@
+"""
+Work deferred out of the login request.
+
+With LASTFM_DEFER_PROFILE a returning user's login completes with the session
+data and the Last.fm user id remembered from an earlier login. Fetching the
+full profile and storing it on UserSocialAuth.extra_data and the User is then
+submitted to the executor named by LASTFM_EXECUTOR.
+"""
+
+import logging
+import threading
+from Queue import Queue, Full
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.importlib import import_module
+
+from social_auth.backends import USERNAME
+from social_auth.models import UserSocialAuth
+
+try:
+    from celery.task import task
+except ImportError:
+    task = None
+
+from lastfm_auth.backend import LastfmAuth, LastfmBackend, profiles_enabled
+from lastfm_auth.cache import profile_cache
+from lastfm_auth.exceptions import LastfmError
+from lastfm_auth.metrics import incr
+from lastfm_auth.models import LastfmProfile
+
+
+DEFAULT_EXECUTOR = 'lastfm_auth.tasks.ThreadExecutor'
+DEFAULT_WORKERS = 2
+DEFAULT_QUEUE_SIZE = 1000
+
+logger = logging.getLogger('lastfm_auth')
+
+
+class Executor(object):
+    """Interface for executors. The default implementation runs tasks right away."""
+
+    def submit(self, func, *args):
+        func(*args)
+
+
+class ThreadExecutor(Executor):
+    """
+    Run tasks on a fixed number of daemon threads in this process.
+
+    At most `queue_size` tasks wait to run. Tasks submitted beyond that are
+    dropped and logged.
+    """
+
+    def __init__(self, workers=DEFAULT_WORKERS, queue_size=DEFAULT_QUEUE_SIZE):
+        self.workers = workers
+        self._tasks = Queue(maxsize=queue_size)
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def _start(self):
+        with self._lock:
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            func, args = self._tasks.get()
+            try:
+                func(*args)
+            except Exception:
+                incr('lastfm_auth.tasks', result='failed')
+                logger.exception('Deferred task %s failed', func.__name__)
+            finally:
+                self._tasks.task_done()
+
+    def submit(self, func, *args):
+        if len(self._threads) < self.workers:
+            self._start()
+        try:
+            self._tasks.put_nowait((func, args))
+        except Full:
+            incr('lastfm_auth.tasks', result='dropped')
+            logger.warning('Deferred task queue is full, dropping %s', func.__name__)
+
+    def join(self):
+        """Block until all submitted tasks have run."""
+        self._tasks.join()
+
+
+if task is not None:
+    @task(ignore_result=True)
+    def run_task(path, *args):
+        """Celery task which calls the function at the dotted path."""
+        module, attr = path.rsplit('.', 1)
+        getattr(import_module(module), attr)(*args)
+else:
+    run_task = None
+
+
+class CeleryExecutor(Executor):
+    """Run tasks on Celery workers. Requires celery."""
+
+    def __init__(self):
+        if run_task is None:
+            raise ImproperlyConfigured('CeleryExecutor requires celery')
+
+    def submit(self, func, *args):
+        run_task.delay('%s.%s' % (func.__module__, func.__name__), *args)
+
+
+_executor = None
+_executor_path = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """Return the configured executor."""
+    global _executor, _executor_path
+    path = getattr(settings, 'LASTFM_EXECUTOR', DEFAULT_EXECUTOR)
+    if path == _executor_path:
+        return _executor
+    with _executor_lock:
+        if isinstance(path, Executor):
+            _executor = path
+        else:
+            module, attr = path.rsplit('.', 1)
+            try:
+                _executor = getattr(import_module(module), attr)()
+            except (ImportError, AttributeError) as e:
+                raise ImproperlyConfigured('Error loading LASTFM_EXECUTOR %s: %s' % (path, e))
+        _executor_path = path
+        return _executor
+
+
+def enrich_profile(uid, username):
+    """
+    Fetch the profile for a deferred login and store the extra data and user
+    details which changed. Signal handlers of pre_update are not called.
+    """
+    backend = LastfmBackend()
+    try:
+        data = LastfmAuth().user_data(username)
+    except LastfmError:
+        logger.warning('Profile update failed for %s', username, exc_info=True)
+        return
+    if data is None or data.get('id') != uid:
+        # The username now belongs to another Last.fm account
+        profile_cache().delete_identity(username)
+        logger.warning('Last.fm id of %s no longer matches %s', username, uid)
+        return
+    try:
+        social_user = UserSocialAuth.objects.select_related('user').get(
+            provider=backend.name, uid=uid)
+    except UserSocialAuth.DoesNotExist:
+        return
+    current = social_user.extra_data or {}
+    response = dict(data, access_token=current.get('access_token', ''))
+    extra_data = dict(current)
+    extra_data.update(backend.extra_data(social_user.user, uid, response, None))
+    if extra_data != current:
+        UserSocialAuth.objects.filter(pk=social_user.pk).update(extra_data=extra_data)
+    if profiles_enabled():
+        LastfmProfile.objects.sync(social_user, response)
+    user = social_user.user
+    fields = [field.name for field in User._meta.fields]
+    changes = dict(
+        (name, value) for name, value in backend.get_user_details(response).items()
+        if name in fields and name not in (USERNAME, 'id', 'pk')
+        and value and value != getattr(user, name)
+    )
+    if changes:
+        User.objects.filter(pk=user.pk).update(**changes)
@@ -1,2 +1,20 @@
 from lastfm_auth.tests.backend import AuthStartTestCase, AuthCompleteTestCase
 from lastfm_auth.tests.backend import ContribAuthTestCase, LastfmAPITestCase
+from lastfm_auth.tests.pool import ConnectionPoolTestCase, LazyImportTestCase
+from lastfm_auth.tests.combined import CombinedFetchTestCase
+from lastfm_auth.tests.cache import LRUCacheTestCase, ProfileCacheTestCase, HttpCacheTestCase
+from lastfm_auth.tests.cache import CachedUserDataTestCase, NegativeCacheTestCase
+from lastfm_auth.tests.commands import RefreshProfilesTestCase, ImportAccountsTestCase
+from lastfm_auth.tests.ratelimit import TokenBucketTestCase, CacheRateLimiterTestCase
+from lastfm_auth.tests.ratelimit import SingleFlightTestCase, InFlightLimiterTestCase
+from lastfm_auth.tests.breaker import CircuitBreakerTestCase, UpstreamCircuitTestCase
+from lastfm_auth.tests.metrics import MetricsTestCase
+from lastfm_auth.tests.testserver import FakeServerTestCase
+from lastfm_auth.tests.pipeline import SkipWritesPipelineTestCase
+from lastfm_auth.tests.signing import SignerTestCase
+from lastfm_auth.tests.batch import BatchUserDataTestCase, ImapUnorderedTestCase
+from lastfm_auth.tests.tasks import DeferredProfileTestCase, ThreadExecutorTestCase
+from lastfm_auth.tests.keys import KeyPoolTestCase, MultiKeyLoginTestCase
+from lastfm_auth.tests.retry import RetryTestCase, HedgeTestCase, UpstreamRetryTestCase
+from lastfm_auth.tests.replay import TokenReplayTestCase
+from lastfm_auth.tests.profiles import LastfmProfileTestCase, BackfillProfilesTestCase
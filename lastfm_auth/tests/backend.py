@@ -1,17 +1,21 @@
 from StringIO import StringIO
-from urlparse import urlparse, parse_qs
-from urllib2 import URLError
+from urlparse import urlparse, parse_qs, parse_qsl
+from urllib2 import URLError, HTTPError
 
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.urlresolvers import reverse
 from django.test import TestCase as DjangoTestCase
+from django.test.client import RequestFactory
 from django.utils import simplejson
 
 import mock
 from social_auth.models import UserSocialAuth
 from social_auth import version as VERSION
 
+from lastfm_auth.backend import _auth_urls
+from lastfm_auth.exceptions import LastfmUpstreamError, LastfmResponseError, LastfmAPIError
+
 
 if VERSION[1] == 3:
     DEFAULT_REDIRECT = getattr(settings, 'LOGIN_REDIRECT_URL', '')
@@ -50,11 +54,18 @@ def lastfm_user_response():
     }
 
 
+def lastfm_user_fields():
+    """The fields of lastfm_user_response kept by the backend by default."""
+    response = lastfm_user_response()
+    return dict((key, response[key]) for key in ('id', 'name', 'realname'))
+
+
 class AuthStartTestCase(DjangoTestCase):
     """Test login via Lastfm."""
 
     def setUp(self):
         self.login_url = reverse(BEGIN_URL_NAME, kwargs={'backend': 'lastfm'})
+        _auth_urls.clear()
 
     def test_redirect_url(self):
         """Check redirect to Last.fm."""
@@ -89,6 +100,53 @@ class AuthStartTestCase(DjangoTestCase):
         callback = reverse(COMPLETE_URL_NAME, kwargs={'backend': 'lastfm'})
         self.assertTrue(query_data['cb'][0].startswith('http:'))
 
+    def test_cached_url(self):
+        """The authorization url is built once per host."""
+        from urllib import urlencode
+        with mock.patch('lastfm_auth.backend.urlencode', wraps=urlencode) as encode:
+            first = self.client.get(self.login_url)['Location']
+            self.assertEqual(self.client.get(self.login_url)['Location'], first)
+            self.assertEqual(encode.call_count, 1)
+            other = self.client.get(self.login_url, HTTP_HOST='example.com')['Location']
+            self.assertEqual(encode.call_count, 2)
+        self.assertTrue('example.com' in other)
+
+    def test_anonymous_next(self):
+        """The next url of a new visitor is sent with the callback instead of saved."""
+        response = self.client.get(self.login_url, {'next': '/next/'})
+        self.assertFalse(settings.SESSION_COOKIE_NAME in response.cookies)
+        callback = urlparse(parse_qs(urlparse(response['Location']).query)['cb'][0])
+        data = dict(parse_qsl(callback.query), token='FAKEKEY')
+        self.assertTrue('redirect_state' in data)
+        with mock.patch('lastfm_auth.backend.LastfmAuth.access_token') as access_token:
+            access_token.return_value = ('RJ', 'FAKETOKEN')
+            with mock.patch('lastfm_auth.backend.LastfmAuth.user_data') as user_data:
+                user_data.return_value = lastfm_user_fields()
+                with self.settings(SOCIAL_AUTH_NEW_USER_REDIRECT_URL=None):
+                    response = self.client.get(callback.path, data)
+        self.assertEqual(response['Location'], 'http://testserver/next/')
+
+    def test_session_next(self):
+        """The next url stays in a session which is already saved."""
+        from django.contrib.sessions.backends.db import SessionStore
+        from lastfm_auth.backend import LastfmAuth
+        request = RequestFactory().get(self.login_url)
+        request.session = SessionStore()
+        request.session['other'] = 1
+        request.session.save()
+        request.session['next'] = '/next/'
+        self.assertEqual(LastfmAuth(request, '/complete/').redirect_state(), None)
+        self.assertEqual(request.session['next'], '/next/')
+
+    def test_invalid_state(self):
+        """Tampered next urls are ignored."""
+        from django.contrib.sessions.backends.db import SessionStore
+        from lastfm_auth.backend import LastfmAuth
+        request = RequestFactory().get('/complete/', {'redirect_state': 'http://evil.com/:sig'})
+        request.session = SessionStore()
+        LastfmAuth(request, '/complete/')
+        self.assertFalse('next' in request.session)
+
 
 class AuthCompleteTestCase(DjangoTestCase):
     """Complete login process from Last.fm."""
@@ -149,6 +207,13 @@ class AuthCompleteTestCase(DjangoTestCase):
         response = self.client.get(self.complete_url, data)
         self.assertRedirects(response, LOGIN_ERROR_URL)
 
+    def test_upstream_error(self):
+        """Errors from Last.fm redirect to the login error url."""
+        self.access_token_mock.side_effect = LastfmUpstreamError('Timed out')
+        data = {'token': 'FAKEKEY'}
+        response = self.client.get(self.complete_url, data)
+        self.assertRedirects(response, LOGIN_ERROR_URL)
+
     def test_no_token(self):
         """Failed auth due to no token."""
         response = self.client.get(self.complete_url)
@@ -218,7 +283,8 @@ class LastfmAPITestCase(DjangoTestCase):
         """
         from lastfm_auth.backend import LastfmAuth
         with mock.patch('lastfm_auth.backend.urlopen') as urlopen:
-            urlopen.return_value = StringIO('')
+            return_data = {'session': {'name': 'RJ', 'key': 'KEY'}}
+            urlopen.return_value = StringIO(simplejson.dumps(return_data))
             request = mock.MagicMock()
             redirect = 'http://example.com'
             access_token = LastfmAuth(request, redirect).access_token('REQUESTTOKEN')
@@ -264,9 +330,8 @@ class LastfmAPITestCase(DjangoTestCase):
             urlopen.side_effect = URLError('Fake URL error')
             request = mock.MagicMock()
             redirect = 'http://example.com'
-            username, access_token = LastfmAuth(request, redirect).access_token('REQUESTTOKEN')
-            self.assertFalse(username)
-            self.assertFalse(access_token)
+            auth = LastfmAuth(request, redirect)
+            self.assertRaises(LastfmUpstreamError, auth.access_token, 'REQUESTTOKEN')
 
     def test_access_token_bad_data(self):
         """
@@ -278,9 +343,8 @@ class LastfmAPITestCase(DjangoTestCase):
             urlopen.return_value = StringIO('')
             request = mock.MagicMock()
             redirect = 'http://example.com'
-            username, access_token = LastfmAuth(request, redirect).access_token('REQUESTTOKEN')
-            self.assertFalse(username)
-            self.assertFalse(access_token)
+            auth = LastfmAuth(request, redirect)
+            self.assertRaises(LastfmResponseError, auth.access_token, 'REQUESTTOKEN')
 
     def test_user_data_url(self):
         """
@@ -289,7 +353,7 @@ class LastfmAPITestCase(DjangoTestCase):
         """
         from lastfm_auth.backend import LastfmAuth
         with mock.patch('lastfm_auth.backend.urlopen') as urlopen:
-            urlopen.return_value = StringIO('')
+            urlopen.return_value = StringIO(simplejson.dumps({'user': lastfm_user_response()}))
             request = mock.MagicMock()
             redirect = 'http://example.com'
             user_data = LastfmAuth(request, redirect).user_data('UserName')
@@ -314,7 +378,7 @@ class LastfmAPITestCase(DjangoTestCase):
             request = mock.MagicMock()
             redirect = 'http://example.com'
             user_data = LastfmAuth(request, redirect).user_data('UserName')
-            self.assertEqual(user_data, lastfm_user_response())
+            self.assertEqual(user_data, lastfm_user_fields())
 
     def test_user_data_upstream_failure(self):
         """
@@ -326,8 +390,8 @@ class LastfmAPITestCase(DjangoTestCase):
             urlopen.side_effect = URLError('Fake URL error')
             request = mock.MagicMock()
             redirect = 'http://example.com'
-            user_data = LastfmAuth(request, redirect).user_data('UserName')
-            self.assertEqual(user_data, None)
+            auth = LastfmAuth(request, redirect)
+            self.assertRaises(LastfmUpstreamError, auth.user_data, 'UserName')
 
     def test_user_data_bad_data(self):
         """
@@ -339,5 +403,47 @@ class LastfmAPITestCase(DjangoTestCase):
             urlopen.return_value = StringIO('')
             request = mock.MagicMock()
             redirect = 'http://example.com'
-            user_data = LastfmAuth(request, redirect).user_data('UserName')
-            self.assertEqual(user_data, None)
+            auth = LastfmAuth(request, redirect)
+            self.assertRaises(LastfmResponseError, auth.user_data, 'UserName')
+
+    def test_parse_access_token(self):
+        """
+        Parse an auth.getSession body without making a request so other
+        clients can drive the transport.
+        """
+        from lastfm_auth.backend import LastfmAuth
+        body = simplejson.dumps({'session': {'name': 'RJ', 'key': 'SESSIONKEY'}})
+        auth = LastfmAuth(mock.MagicMock(), 'http://example.com')
+        self.assertEqual(auth.parse_access_token(body), ('RJ', 'SESSIONKEY'))
+        self.assertRaises(LastfmAPIError, auth.parse_access_token, '{"error": 4}')
+
+    def test_parse_user_data(self):
+        """Parse a user.getinfo body without making a request."""
+        from lastfm_auth.backend import LastfmAuth
+        body = simplejson.dumps({'user': lastfm_user_response()})
+        auth = LastfmAuth(mock.MagicMock(), 'http://example.com')
+        self.assertEqual(auth.parse_user_data(body), lastfm_user_fields())
+        self.assertRaises(LastfmResponseError, auth.parse_user_data, '<html>')
+
+    def test_api_error(self):
+        """Error codes returned with an HTTP error are raised as LastfmAPIError."""
+        from lastfm_auth.backend import LastfmAuth
+        with mock.patch('lastfm_auth.backend.urlopen') as urlopen:
+            body = simplejson.dumps({'error': 4, 'message': 'Invalid token'})
+            urlopen.side_effect = HTTPError('http://example.com', 403, 'Forbidden', {}, StringIO(body))
+            auth = LastfmAuth(mock.MagicMock(), 'http://example.com')
+            try:
+                auth.access_token('REQUESTTOKEN')
+            except LastfmAPIError as e:
+                self.assertEqual(e.code, 4)
+            else:
+                self.fail('LastfmAPIError not raised')
+
+    def test_user_data_extra_fields(self):
+        """Fields named in LASTFM_EXTRA_DATA and LASTFM_USER_FIELDS are kept."""
+        from lastfm_auth.backend import LastfmAuth
+        body = simplejson.dumps({'user': lastfm_user_response()})
+        auth = LastfmAuth(mock.MagicMock(), 'http://example.com')
+        with self.settings(LASTFM_EXTRA_DATA=[('country', 'country')], LASTFM_USER_FIELDS=('age', )):
+            user_data = auth.parse_user_data(body)
+        self.assertEqual(user_data, dict(lastfm_user_fields(), country='UK', age=29))
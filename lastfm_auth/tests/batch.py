@@ -0,0 +1,178 @@
+import threading
+
+from django.test import TestCase as DjangoTestCase
+
+import mock
+
+from lastfm_auth.backend import LastfmAuth
+from lastfm_auth.cache import profile_cache
+from lastfm_auth.exceptions import LastfmAPIError
+from lastfm_auth.tests.backend import lastfm_user_response, lastfm_user_fields
+from lastfm_auth.testserver import FakeLastfmServerMixin
+
+
+def lastfm_user(name):
+    return dict(lastfm_user_response(), name=name)
+
+
+class ConcurrentFetch(object):
+    """Stand-in for fetch_user_data which records how many calls overlap."""
+
+    def __init__(self, expected):
+        self.expected = expected
+        self.running = 0
+        self.most = 0
+        self.all_running = threading.Event()
+        self.lock = threading.Lock()
+
+    def __call__(self, username):
+        with self.lock:
+            self.running += 1
+            self.most = max(self.most, self.running)
+            if self.running >= self.expected:
+                self.all_running.set()
+        # Each call waits until the expected number of calls overlap
+        self.all_running.wait(1)
+        with self.lock:
+            self.running -= 1
+        return lastfm_user(username)
+
+
+class BatchUserDataTestCase(FakeLastfmServerMixin, DjangoTestCase):
+    """Look up many Last.fm profiles at once."""
+
+    def setUp(self):
+        users = dict((name, lastfm_user(name)) for name in ('RJ', 'a', 'b', 'c'))
+        self.start_server({'LASTFM_BATCH_WORKERS': 4}, users=users)
+        self.auth = LastfmAuth()
+
+    def lookup(self, usernames, **kwargs):
+        return dict((username, (data, error)) for username, data, error
+            in self.auth.batch_user_data(usernames, **kwargs))
+
+    def test_results(self):
+        """Each username is returned with its data."""
+        results = self.lookup(['RJ', 'a', 'b', 'c'])
+        self.assertEqual(sorted(results), ['RJ', 'a', 'b', 'c'])
+        self.assertEqual(results['RJ'], (lastfm_user_fields(), None))
+        self.assertEqual(results['a'][0]['name'], 'a')
+
+    def test_concurrent(self):
+        """Lookups run concurrently."""
+        fetch = ConcurrentFetch(expected=4)
+        with mock.patch.object(self.auth, 'fetch_user_data', fetch):
+            results = self.lookup(['RJ', 'a', 'b', 'c'])
+        self.assertEqual(len(results), 4)
+        self.assertTrue(fetch.all_running.is_set())
+        self.assertEqual(fetch.most, 4)
+
+    def test_deduplicate(self):
+        """Each username is requested once."""
+        results = list(self.auth.batch_user_data(['RJ', 'a', 'RJ', 'a', 'RJ']))
+        self.assertEqual(len(results), 2)
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_errors(self):
+        """Failed lookups are returned with their error."""
+        results = self.lookup(['RJ', 'missing'])
+        self.assertEqual(results['RJ'], (lastfm_user_fields(), None))
+        data, error = results['missing']
+        self.assertEqual(data, None)
+        self.assertTrue(isinstance(error, LastfmAPIError))
+
+    def test_workers(self):
+        """The number of concurrent requests is bounded."""
+        fetch = ConcurrentFetch(expected=2)
+        with mock.patch.object(self.auth, 'fetch_user_data', fetch):
+            results = self.lookup(['RJ', 'a', 'b', 'c'], workers=1)
+        self.assertEqual(len(results), 4)
+        self.assertEqual(fetch.most, 1)
+
+    def test_cached(self):
+        """Cached profiles are returned without a request."""
+        with self.settings(LASTFM_PROFILE_CACHE=True):
+            profile_cache().set('RJ', lastfm_user_fields())
+            results = self.lookup(['a', 'RJ'])
+            self.assertEqual(results['RJ'], (lastfm_user_fields(), None))
+            self.assertEqual(results['a'][0]['name'], 'a')
+            self.assertEqual([q['user'] for q in self.server.requests], ['a'])
+            # Fetched profiles are cached for the next batch
+            self.server.requests = []
+            self.lookup(['a', 'RJ'])
+            self.assertEqual(self.server.requests, [])
+
+    def test_streamed(self):
+        """Usernames are read as lookups complete."""
+        read = []
+
+        def usernames():
+            for i in range(1000):
+                read.append(i)
+                yield 'user%s' % i
+
+        with mock.patch.object(self.auth, 'fetch_user_data', lastfm_user):
+            results = self.auth.batch_user_data(usernames(), workers=2)
+            results.next()
+            self.assertTrue(len(read) < 20, len(read))
+            results.close()
+
+
+class ImapUnorderedTestCase(DjangoTestCase):
+    """Worker pool behind batch lookups."""
+
+    def setUp(self):
+        self.threads = []
+
+        def thread(**kwargs):
+            thread = threading.Thread(**kwargs)
+            self.threads.append(thread)
+            return thread
+
+        # Record the threads started by the pool
+        patch = mock.patch('lastfm_auth.utils.threading', Event=threading.Event, Thread=thread)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def assertStopped(self):
+        """Check all threads of the pool exit."""
+        self.assertTrue(self.threads)
+        for thread in self.threads:
+            thread.join(5)
+            self.assertFalse(thread.is_alive())
+
+    def test_abandoned(self):
+        """Worker threads exit when the caller stops iterating."""
+        from lastfm_auth.utils import imap_unordered
+        results = imap_unordered(lambda item: item, iter(range(1000)), workers=4)
+        results.next()
+        results.close()
+        self.assertStopped()
+
+    def test_consumer_error(self):
+        """Worker threads exit when the consumer raises."""
+        from lastfm_auth.utils import imap_unordered
+
+        def consume():
+            for result in imap_unordered(lambda item: item, iter(range(1000)), workers=2):
+                raise ValueError('Failed')
+
+        self.assertRaises(ValueError, consume)
+        self.assertStopped()
+
+    def test_items_error(self):
+        """Errors raised by the items are raised after the started calls are yielded."""
+        from lastfm_auth.utils import imap_unordered
+        results = []
+
+        def items():
+            yield 1
+            yield 2
+            raise ValueError('Failed')
+
+        def consume():
+            for item, result, exc_info in imap_unordered(lambda item: item, items(), workers=2):
+                results.append(result)
+
+        self.assertRaises(ValueError, consume)
+        self.assertEqual(sorted(results), [1, 2])
+        self.assertStopped()
@@ -0,0 +1,136 @@
+import socket
+from StringIO import StringIO
+
+from django.test import TestCase as DjangoTestCase
+from django.utils import simplejson
+
+import mock
+
+from lastfm_auth.exceptions import LastfmUnavailable, LastfmUpstreamError
+
+
+class CircuitBreakerTestCase(DjangoTestCase):
+    """Circuit breaker state changes."""
+
+    def setUp(self):
+        from lastfm_auth.breaker import CircuitBreaker
+        self.breaker = CircuitBreaker(failures=2, reset=30)
+
+    def test_open(self):
+        """Consecutive failures open the circuit."""
+        self.breaker.before()
+        self.breaker.failure()
+        self.breaker.before()
+        self.breaker.failure()
+        self.assertEqual(self.breaker.state, 'open')
+        self.assertRaises(LastfmUnavailable, self.breaker.before)
+        self.assertEqual(self.breaker.stats()['rejected'], 1)
+
+    def test_success_resets(self):
+        """A success resets the failure count."""
+        self.breaker.failure()
+        self.breaker.success()
+        self.breaker.failure()
+        self.assertEqual(self.breaker.state, 'closed')
+
+    def test_half_open_probe(self):
+        """After the cool-down a single probe is allowed."""
+        self.breaker.failure()
+        self.breaker.failure()
+        self.breaker.opened_at -= 30
+        self.breaker.before()
+        self.assertEqual(self.breaker.state, 'half-open')
+        self.assertRaises(LastfmUnavailable, self.breaker.before)
+        self.breaker.success()
+        self.assertEqual(self.breaker.state, 'closed')
+        self.breaker.before()
+
+    def test_failed_probe(self):
+        """A failed probe opens the circuit for another cool-down."""
+        self.breaker.failure()
+        self.breaker.failure()
+        self.breaker.opened_at -= 30
+        self.breaker.before()
+        self.breaker.failure()
+        self.assertEqual(self.breaker.state, 'open')
+        self.assertRaises(LastfmUnavailable, self.breaker.before)
+
+    def test_cancelled_probe(self):
+        """A probe which was not made lets another probe through."""
+        self.breaker.failure()
+        self.breaker.failure()
+        self.breaker.opened_at -= 30
+        self.breaker.before()
+        self.breaker.cancel()
+        self.breaker.before()
+        self.assertEqual(self.breaker.state, 'half-open')
+
+    def test_disabled(self):
+        """Setting failures to 0 disables the breaker."""
+        from lastfm_auth.breaker import CircuitBreaker
+        breaker = CircuitBreaker(failures=0)
+        for i in range(10):
+            breaker.failure()
+        breaker.before()
+
+
+class UpstreamCircuitTestCase(DjangoTestCase):
+    """Fast failure of Last.fm calls during an outage."""
+
+    def test_fail_fast(self):
+        """Once open, calls fail without making a request."""
+        from lastfm_auth.backend import LastfmAuth
+        from lastfm_auth.breaker import circuit_state
+        with self.settings(LASTFM_CIRCUIT_FAILURES=2, LASTFM_CIRCUIT_RESET=60):
+            with mock.patch('lastfm_auth.backend.connection_pool') as pool:
+                pool.return_value.urlopen.side_effect = socket.timeout('timed out')
+                auth = LastfmAuth()
+                self.assertRaises(LastfmUpstreamError, auth.user_data, 'RJ')
+                self.assertRaises(LastfmUpstreamError, auth.user_data, 'RJ')
+                self.assertRaises(LastfmUnavailable, auth.access_token, 'TOKEN')
+                self.assertEqual(pool.return_value.urlopen.call_count, 2)
+                self.assertEqual(circuit_state()['state'], 'open')
+
+    def test_oversized_response(self):
+        """Responses over the size limit are not failures."""
+        from lastfm_auth.backend import LastfmAuth
+        from lastfm_auth.breaker import circuit_breaker
+        from lastfm_auth.exceptions import LastfmResponseError
+        with self.settings(LASTFM_CIRCUIT_FAILURES=1, LASTFM_CIRCUIT_RESET=60):
+            circuit_breaker().success()
+            with mock.patch('lastfm_auth.backend.connection_pool') as pool:
+                pool.return_value.urlopen.side_effect = LastfmResponseError(
+                    'Response larger than 10 bytes')
+                self.assertRaises(LastfmResponseError, LastfmAuth().user_data, 'RJ')
+            self.assertEqual(circuit_breaker().state, 'closed')
+            self.assertEqual(circuit_breaker().consecutive_failures, 0)
+
+    def test_open_skips_throttle(self):
+        """An open circuit fails before waiting for the rate limit."""
+        from lastfm_auth.backend import LastfmAuth
+        with self.settings(LASTFM_CIRCUIT_FAILURES=1, LASTFM_CIRCUIT_RESET=60):
+            with mock.patch('lastfm_auth.backend.connection_pool') as pool:
+                pool.return_value.urlopen.side_effect = socket.timeout('timed out')
+                with mock.patch('lastfm_auth.backend.throttle') as throttle:
+                    auth = LastfmAuth()
+                    self.assertRaises(LastfmUpstreamError, auth.access_token, 'TOKEN')
+                    self.assertRaises(LastfmUnavailable, auth.access_token, 'TOKEN')
+                    self.assertEqual(throttle.call_count, 1)
+
+    def test_throttled_probe(self):
+        """A probe rejected by the rate limit doesn't keep the circuit half-open."""
+        from lastfm_auth.backend import LastfmAuth
+        from lastfm_auth.breaker import circuit_breaker
+        from lastfm_auth.exceptions import RateLimitExceeded
+        with self.settings(LASTFM_CIRCUIT_FAILURES=1, LASTFM_CIRCUIT_RESET=60):
+            breaker = circuit_breaker()
+            breaker.failure()
+            breaker.opened_at -= 60
+            with mock.patch('lastfm_auth.backend.throttle') as throttle:
+                throttle.side_effect = RateLimitExceeded('Last.fm rate limit exceeded')
+                self.assertRaises(RateLimitExceeded, LastfmAuth().access_token, 'TOKEN')
+            with mock.patch('lastfm_auth.backend.connection_pool') as pool:
+                pool.return_value.urlopen.return_value = StringIO(
+                    simplejson.dumps({'session': {'name': 'RJ', 'key': 'KEY'}}))
+                self.assertEqual(LastfmAuth().access_token('TOKEN'), ('RJ', 'KEY'))
+            self.assertEqual(breaker.state, 'closed')
@@ -0,0 +1,351 @@
+import threading
+import time
+from StringIO import StringIO
+from urllib2 import URLError
+
+from django.core.cache import cache
+from django.test import TestCase as DjangoTestCase
+from django.utils import simplejson
+
+import mock
+
+from lastfm_auth.tests.backend import lastfm_user_response, lastfm_user_fields
+from lastfm_auth.testserver import FakeLastfmServerMixin
+
+
+def backdate(profiles, username, age):
+    """Store a profile entry fetched `age` seconds ago."""
+    entry = {'data': lastfm_user_response(), 'fetched': time.time() - age}
+    profiles._set(profiles.key(username), entry, 300)
+
+
+class LRUCacheTestCase(DjangoTestCase):
+    """In-process LRU fallback cache."""
+
+    def test_eviction(self):
+        """Least recently used entries are evicted past max entries."""
+        from lastfm_auth.cache import LRUCache
+        lru = LRUCache(max_entries=2)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        lru.get('a')
+        lru.set('c', 3)
+        self.assertEqual(lru.get('a'), 1)
+        self.assertEqual(lru.get('b'), None)
+        self.assertEqual(lru.get('c'), 3)
+        self.assertEqual(len(lru), 2)
+
+    def test_expiry(self):
+        """Expired entries are not returned."""
+        from lastfm_auth.cache import LRUCache
+        lru = LRUCache()
+        lru.set('a', 1, timeout=-1)
+        self.assertEqual(lru.get('a', 'missing'), 'missing')
+
+
+class ProfileCacheTestCase(DjangoTestCase):
+    """Profile cache keyed by Last.fm username."""
+
+    def setUp(self):
+        cache.clear()
+
+    def tearDown(self):
+        cache.clear()
+
+    def test_fresh(self):
+        """New entries are fresh."""
+        from lastfm_auth.cache import ProfileCache
+        profiles = ProfileCache(ttl=60)
+        profiles.set('RJ', lastfm_user_response())
+        data, age = profiles.get('RJ')
+        self.assertEqual(data, lastfm_user_response())
+        self.assertTrue(profiles.is_fresh(age))
+
+    def test_stale(self):
+        """Entries past the TTL are returned as stale within the stale window."""
+        from lastfm_auth.cache import ProfileCache
+        profiles = ProfileCache(ttl=60, stale=60)
+        backdate(profiles, 'RJ', 90)
+        data, age = profiles.get('RJ')
+        self.assertEqual(data, lastfm_user_response())
+        self.assertFalse(profiles.is_fresh(age))
+
+    def test_expired(self):
+        """Entries past the stale window are ignored."""
+        from lastfm_auth.cache import ProfileCache
+        profiles = ProfileCache(ttl=60, stale=60, alias=None)
+        backdate(profiles, 'RJ', 150)
+        self.assertEqual(profiles.get('RJ'), (None, None))
+
+    def test_invalidate(self):
+        """Invalidated profiles are removed."""
+        from lastfm_auth.cache import profile_cache, invalidate_profile
+        profile_cache().set('RJ', lastfm_user_response())
+        invalidate_profile('RJ')
+        self.assertEqual(profile_cache().get('RJ'), (None, None))
+
+    def test_local_fallback(self):
+        """Errors from the Django cache fall back to the local LRU."""
+        from lastfm_auth.cache import ProfileCache
+        profiles = ProfileCache(ttl=60)
+        profiles.backend = mock.Mock()
+        profiles.backend.get.side_effect = Exception('Cache down')
+        profiles.backend.set.side_effect = Exception('Cache down')
+        profiles.set('RJ', lastfm_user_response())
+        data, age = profiles.get('RJ')
+        self.assertEqual(data, lastfm_user_response())
+        self.assertEqual(len(profiles.local), 1)
+
+
+class CachedUserDataTestCase(DjangoTestCase):
+    """LastfmAuth.user_data with the profile cache enabled."""
+
+    def setUp(self):
+        from lastfm_auth.backend import LastfmAuth
+        cache.clear()
+        self.settings_override = self.settings(
+            LASTFM_PROFILE_CACHE=True, LASTFM_PROFILE_CACHE_STALE=60)
+        self.settings_override.enable()
+        self.auth = LastfmAuth(mock.MagicMock(), 'http://example.com')
+        self.urlopen_patch = mock.patch('lastfm_auth.backend.urlopen')
+        self.urlopen = self.urlopen_patch.start()
+        self.urlopen.side_effect = lambda url: StringIO(
+            simplejson.dumps({'user': lastfm_user_response()}))
+
+    def tearDown(self):
+        self.settings_override.disable()
+        self.urlopen_patch.stop()
+        cache.clear()
+
+    def test_cache_hit(self):
+        """Returning users are served from the cache."""
+        self.auth.user_data('RJ')
+        data = self.auth.user_data('RJ')
+        self.assertEqual(data, lastfm_user_fields())
+        self.assertEqual(self.urlopen.call_count, 1)
+
+    def test_failures_not_cached(self):
+        """Failed lookups are not stored."""
+        from lastfm_auth.exceptions import LastfmResponseError
+        self.urlopen.side_effect = lambda url: StringIO('')
+        self.assertRaises(LastfmResponseError, self.auth.user_data, 'RJ')
+        self.assertRaises(LastfmResponseError, self.auth.user_data, 'RJ')
+        self.assertEqual(self.urlopen.call_count, 2)
+
+    def test_stale_while_revalidate(self):
+        """Stale data is returned while it is refreshed in the background."""
+        from lastfm_auth.backend import LastfmAuth
+        from lastfm_auth.cache import profile_cache
+        self.urlopen.side_effect = lambda url: StringIO(
+            simplejson.dumps({'user': {'name': 'RJ', 'id': '1000002'}}))
+        profiles = profile_cache()
+        backdate(profiles, 'RJ', profiles.ttl + 1)
+        refreshed = threading.Event()
+        refresh_user_data = LastfmAuth.refresh_user_data
+
+        def refresh(auth, username):
+            try:
+                return refresh_user_data(auth, username)
+            finally:
+                refreshed.set()
+
+        with mock.patch.object(LastfmAuth, 'refresh_user_data', refresh):
+            data = self.auth.user_data('RJ')
+            self.assertEqual(data, lastfm_user_response())
+            self.assertTrue(refreshed.wait(5))
+        data, age = profiles.get('RJ')
+        self.assertTrue(profiles.is_fresh(age))
+        self.assertEqual(data, {'name': 'RJ', 'id': '1000002'})
+        self.assertEqual(self.urlopen.call_count, 1)
+
+
+class NegativeCacheTestCase(DjangoTestCase):
+    """Failed user.getinfo lookups with LASTFM_NEGATIVE_CACHE_TTL."""
+
+    def setUp(self):
+        from lastfm_auth.backend import LastfmAuth
+        from lastfm_auth.metrics import MemoryMetrics
+        cache.clear()
+        self.metrics = MemoryMetrics()
+        self.settings_override = self.settings(
+            LASTFM_NEGATIVE_CACHE_TTL=30, LASTFM_METRICS=self.metrics)
+        self.settings_override.enable()
+        self.auth = LastfmAuth()
+        self.urlopen_patch = mock.patch('lastfm_auth.backend.urlopen')
+        self.urlopen = self.urlopen_patch.start()
+        self.urlopen.side_effect = lambda url: StringIO(
+            simplejson.dumps({'error': 6, 'message': 'No user with that name'}))
+
+    def tearDown(self):
+        self.settings_override.disable()
+        self.urlopen_patch.stop()
+        cache.clear()
+
+    def test_failure_cached(self):
+        """Repeated failures are raised again without a request."""
+        from lastfm_auth.exceptions import LastfmAPIError
+        for i in range(3):
+            try:
+                self.auth.user_data('missing')
+            except LastfmAPIError as e:
+                self.assertEqual((e.code, e.message), (6, 'No user with that name'))
+            else:
+                self.fail('LastfmAPIError not raised')
+        self.assertEqual(self.urlopen.call_count, 1)
+        self.assertEqual(self.metrics.count(
+            'lastfm_auth.negative_cache', result='hit', error='LastfmAPIError'), 2)
+
+    def test_error_classes(self):
+        """Failures are raised again with their class."""
+        from lastfm_auth.exceptions import LastfmResponseError, LastfmAPIError
+        self.urlopen.side_effect = lambda url: StringIO('garbage')
+        self.assertRaises(LastfmResponseError, self.auth.user_data, 'RJ')
+        try:
+            self.auth.user_data('RJ')
+        except LastfmResponseError as e:
+            self.assertFalse(isinstance(e, LastfmAPIError))
+        self.assertEqual(self.urlopen.call_count, 1)
+
+    def test_disabled(self):
+        """Failures are not cached by default."""
+        from lastfm_auth.exceptions import LastfmAPIError
+        with self.settings(LASTFM_NEGATIVE_CACHE_TTL=0):
+            self.assertRaises(LastfmAPIError, self.auth.user_data, 'missing')
+            self.assertRaises(LastfmAPIError, self.auth.user_data, 'missing')
+        self.assertEqual(self.urlopen.call_count, 2)
+
+    def test_throttled(self):
+        """Rate limit errors are not cached."""
+        from lastfm_auth.exceptions import LastfmAPIError
+        self.urlopen.side_effect = lambda url: StringIO(
+            simplejson.dumps({'error': 29, 'message': 'Rate limit exceeded'}))
+        self.assertRaises(LastfmAPIError, self.auth.user_data, 'RJ')
+        self.assertRaises(LastfmAPIError, self.auth.user_data, 'RJ')
+        self.assertEqual(self.urlopen.call_count, 2)
+
+    def test_transient(self):
+        """Failed requests and temporary errors are not cached."""
+        from lastfm_auth.exceptions import LastfmUpstreamError, LastfmAPIError
+        self.urlopen.side_effect = URLError('Fake URL error')
+        self.assertRaises(LastfmUpstreamError, self.auth.user_data, 'RJ')
+        self.urlopen.side_effect = lambda url: StringIO(
+            simplejson.dumps({'error': 16, 'message': 'Temporary error'}))
+        self.assertRaises(LastfmAPIError, self.auth.user_data, 'RJ')
+        self.assertEqual(self.urlopen.call_count, 2)
+        self.assertEqual(self.metrics.count('lastfm_auth.negative_cache', result='store'), 0)
+
+    def test_error_kept(self):
+        """A transient failure doesn't replace a cached error of another class."""
+        from lastfm_auth.cache import profile_cache
+        from lastfm_auth.exceptions import LastfmUpstreamError, LastfmAPIError
+        cache = profile_cache()
+        cache.set_failure('missing', LastfmAPIError(6, 'No user with that name'))
+        cache.set_failure('missing', LastfmUpstreamError('timed out'))
+        error = cache.get_failure('missing')
+        self.assertTrue(isinstance(error, LastfmAPIError))
+        self.assertEqual((error.code, error.message), (6, 'No user with that name'))
+
+    def test_invalidate(self):
+        """invalidate_profile removes cached failures."""
+        from lastfm_auth.cache import invalidate_profile
+        from lastfm_auth.exceptions import LastfmAPIError
+        self.assertRaises(LastfmAPIError, self.auth.user_data, 'RJ')
+        invalidate_profile('RJ')
+        self.urlopen.side_effect = lambda url: StringIO(
+            simplejson.dumps({'user': lastfm_user_response()}))
+        self.assertEqual(self.auth.user_data('RJ'), lastfm_user_fields())
+
+
+class HttpCacheTestCase(FakeLastfmServerMixin, DjangoTestCase):
+    """Conditional user.getinfo requests with LASTFM_HTTP_CACHE_TTL."""
+
+    def setUp(self):
+        from lastfm_auth.backend import LastfmAuth
+        from lastfm_auth.metrics import MemoryMetrics
+        self.metrics = MemoryMetrics()
+        self.start_server(
+            {'LASTFM_HTTP_CACHE_TTL': 3600, 'LASTFM_METRICS': self.metrics},
+            users={'RJ': lastfm_user_response()})
+        self.auth = LastfmAuth()
+
+    def test_not_modified(self):
+        """Unchanged profiles are revalidated and counted as hits."""
+        for i in range(3):
+            self.assertEqual(self.auth.user_data('RJ'), lastfm_user_fields())
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertEqual(self.server.not_modified, 2)
+        self.assertEqual(self.metrics.count('lastfm_auth.http_cache', result='hit'), 2)
+        self.assertEqual(self.metrics.count('lastfm_auth.http_cache', result='miss'), 1)
+
+    def test_modified(self):
+        """Changed profiles are downloaded again."""
+        self.auth.user_data('RJ')
+        self.server.users['RJ'] = dict(lastfm_user_response(), realname='Cher')
+        self.assertEqual(self.auth.user_data('RJ')['realname'], 'Cher')
+        self.assertEqual(self.server.not_modified, 0)
+        self.assertEqual(self.auth.user_data('RJ')['realname'], 'Cher')
+        self.assertEqual(self.server.not_modified, 1)
+
+    def test_max_age(self):
+        """Profiles are used without a request until max-age has passed."""
+        self.server.max_age = 60
+        self.auth.user_data('RJ')
+        self.assertEqual(self.auth.user_data('RJ'), lastfm_user_fields())
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(self.metrics.count('lastfm_auth.http_cache', result='fresh'), 1)
+        with mock.patch('lastfm_auth.backend.time') as clock:
+            clock.time.return_value = time.time() + 61
+            self.auth.user_data('RJ')
+        self.assertEqual(self.server.not_modified, 1)
+
+    def test_fields(self):
+        """Responses stored with other fields are not used."""
+        self.auth.user_data('RJ')
+        with self.settings(LASTFM_USER_FIELDS=['country']):
+            self.assertEqual(self.auth.user_data('RJ')['country'], 'UK')
+        self.assertEqual(self.server.not_modified, 0)
+
+    def test_disabled(self):
+        """Requests are not conditional by default."""
+        with self.settings(LASTFM_HTTP_CACHE_TTL=0):
+            self.auth.user_data('RJ')
+            self.auth.user_data('RJ')
+        self.assertEqual(self.server.not_modified, 0)
+
+    def test_invalidate(self):
+        """invalidate_profile removes stored responses."""
+        from lastfm_auth.cache import invalidate_profile
+        self.auth.user_data('RJ')
+        invalidate_profile('RJ')
+        self.auth.user_data('RJ')
+        self.assertEqual(self.server.not_modified, 0)
+
+    def test_validators(self):
+        """Validators and max-age are read from the response headers."""
+        from mimetools import Message
+        from lastfm_auth.cache import response_validators
+
+        def headers(text):
+            return Message(StringIO(text))
+
+        self.assertEqual(response_validators(headers(
+            'ETag: "abc"\r\nCache-Control: public, max-age=30\r\n\r\n')),
+            {'etag': '"abc"', 'last_modified': None, 'max_age': 30})
+        self.assertEqual(response_validators(headers(
+            'Last-Modified: Wed, 20 Nov 2002 11:50:40 GMT\r\n\r\n')),
+            {'etag': None, 'last_modified': 'Wed, 20 Nov 2002 11:50:40 GMT', 'max_age': None})
+        self.assertEqual(response_validators(headers(
+            'Cache-Control: no-cache, max-age=30\r\n\r\n'))['max_age'], 0)
+        self.assertEqual(response_validators(headers('Cache-Control: no-store\r\n\r\n')), None)
+
+    def test_last_modified(self):
+        """The fake server answers If-Modified-Since."""
+        from lastfm_auth.backend import conditional_request
+        url = self.auth.user_data_url('RJ')
+        cached = {'last_modified': 'Wed, 20 Nov 2002 11:50:40 GMT', 'data': {}}
+        data, validators = conditional_request(url, 'user', None, cached)
+        self.assertEqual(data['name'], 'RJ')
+        cached = dict(validators, etag=None, data=data)
+        data, validators = conditional_request(url, 'user', None, cached)
+        self.assertEqual(self.server.not_modified, 1)
+        self.assertEqual(data['name'], 'RJ')
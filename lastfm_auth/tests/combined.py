@@ -0,0 +1,95 @@
+import threading
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.urlresolvers import reverse
+from django.test import TestCase as DjangoTestCase
+
+import mock
+
+from lastfm_auth.backend import LastfmAuth
+from lastfm_auth.cache import profile_cache
+from lastfm_auth.tests.backend import lastfm_user_response, COMPLETE_URL_NAME
+from lastfm_auth.testserver import FakeLastfmServerMixin
+
+
+LATENCY = 0.05
+
+
+class CombinedFetchTestCase(FakeLastfmServerMixin, DjangoTestCase):
+    """Complete login with the combined round-trip mode against a slow server."""
+
+    def setUp(self):
+        self.start_server(
+            {'LASTFM_COMBINED_FETCH': True}, latency=LATENCY,
+            sessions={'FAKEKEY': 'RJ'}, users={'RJ': lastfm_user_response()})
+        self.complete_url = reverse(COMPLETE_URL_NAME, kwargs={'backend': 'lastfm'})
+
+    def methods(self):
+        return [q['method'] for q in self.server.requests]
+
+    def age_profile(self, age):
+        """Make the cached profile of RJ `age` seconds old."""
+        key = profile_cache().key('RJ')
+        entry = cache.get(key)
+        entry['fetched'] -= age
+        cache.set(key, entry)
+
+    def test_first_login(self):
+        """Without known profile data both calls are made."""
+        self.client.get(self.complete_url, {'token': 'FAKEKEY'})
+        self.assertEqual(self.methods(), ['auth.getSession', 'user.getinfo'])
+        self.assertEqual(User.objects.latest('id').first_name, 'Richard')
+
+    def test_returning_login(self):
+        """Fresh profile data saves the user.getinfo round trip."""
+        self.client.get(self.complete_url, {'token': 'FAKEKEY'})
+        self.client.logout()
+        self.server.requests = []
+        self.client.get(self.complete_url, {'token': 'FAKEKEY'})
+        self.assertEqual(self.methods(), ['auth.getSession'])
+
+    def test_stale_profile_refresh(self):
+        """Aging profile data is used but refreshed in the background."""
+        self.client.get(self.complete_url, {'token': 'FAKEKEY'})
+        self.client.logout()
+        self.server.requests = []
+        self.age_profile(profile_cache().ttl - 1)
+        release = threading.Event()
+        refreshed = threading.Event()
+        refresh_user_data = LastfmAuth.refresh_user_data
+
+        def refresh(auth, username):
+            # The refresh only starts once the login has completed
+            release.wait(5)
+            try:
+                return refresh_user_data(auth, username)
+            finally:
+                refreshed.set()
+
+        with mock.patch.object(LastfmAuth, 'refresh_user_data', refresh):
+            response = self.client.get(self.complete_url, {'token': 'FAKEKEY'})
+            self.assertEqual(response.status_code, 302)
+            self.assertEqual(self.methods(), ['auth.getSession'])
+            release.set()
+            self.assertTrue(refreshed.wait(5))
+        self.assertEqual(self.methods(), ['auth.getSession', 'user.getinfo'])
+
+    def test_recent_profile(self):
+        """Profile data under half of its ttl is not refreshed."""
+        self.client.get(self.complete_url, {'token': 'FAKEKEY'})
+        self.client.logout()
+        self.server.requests = []
+        self.age_profile(profile_cache().ttl / 2 - 1)
+        with mock.patch.object(LastfmAuth, 'refresh_in_background') as refresh:
+            self.client.get(self.complete_url, {'token': 'FAKEKEY'})
+        self.assertFalse(refresh.called)
+        self.assertEqual(self.methods(), ['auth.getSession'])
+
+    def test_failed_session(self):
+        """A failed session exchange does not use any known data."""
+        self.client.get(self.complete_url, {'token': 'FAKEKEY'})
+        self.client.logout()
+        self.server.requests = []
+        self.client.get(self.complete_url, {'token': 'BADKEY'})
+        self.assertEqual(self.methods(), ['auth.getSession'])
@@ -0,0 +1,175 @@
+import os
+import tempfile
+from StringIO import StringIO
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.test import TestCase as DjangoTestCase
+from django.utils import simplejson
+
+import mock
+from social_auth.models import UserSocialAuth
+
+from lastfm_auth.models import LastfmProfile
+from lastfm_auth.tests.backend import lastfm_user_response
+
+
+class RefreshProfilesTestCase(DjangoTestCase):
+    """Bulk refresh of UserSocialAuth extra_data."""
+
+    def setUp(self):
+        self.fetch_patch = mock.patch('lastfm_auth.backend.LastfmAuth.fetch_user_data')
+        self.fetch_mock = self.fetch_patch.start()
+        self.fetch_mock.side_effect = self.fetch
+        self.profiles = {}
+        for i in range(5):
+            name = 'user%s' % i
+            user = User.objects.create_user(username=name, password='test', email='')
+            UserSocialAuth.objects.create(
+                user=user, provider='lastfm', uid=str(i),
+                extra_data={'id': str(i), 'name': name, 'access_token': 'KEY'}
+            )
+            self.profiles[name] = dict(lastfm_user_response(), id=str(i), name=name)
+
+    def tearDown(self):
+        self.fetch_patch.stop()
+
+    def fetch(self, username):
+        return self.profiles.get(username)
+
+    def refresh(self, **options):
+        options.setdefault('rate', 0)
+        options.setdefault('batch_size', 2)
+        call_command('refresh_lastfm_profiles', stdout=StringIO(), **options)
+
+    def test_unchanged(self):
+        """Rows with unchanged data are not updated."""
+        with self.settings(LASTFM_EXTRA_DATA=[]):
+            with mock.patch('django.db.models.query.QuerySet.update') as update:
+                self.refresh()
+        self.assertEqual(self.fetch_mock.call_count, 5)
+        self.assertFalse(update.called)
+
+    def test_changed(self):
+        """Changed extra data is written back and the access token kept."""
+        with self.settings(LASTFM_EXTRA_DATA=[('country', 'country')]):
+            self.refresh()
+        social = UserSocialAuth.objects.get(uid='3')
+        self.assertEqual(social.extra_data['country'], 'UK')
+        self.assertEqual(social.extra_data['access_token'], 'KEY')
+
+    def test_failed_lookup(self):
+        """Failed or mismatched lookups leave the row alone."""
+        self.profiles['user1'] = None
+        self.profiles['user2']['id'] = '100'
+        with self.settings(LASTFM_EXTRA_DATA=[('country', 'country')]):
+            self.refresh()
+        self.assertFalse('country' in UserSocialAuth.objects.get(uid='1').extra_data)
+        self.assertFalse('country' in UserSocialAuth.objects.get(uid='2').extra_data)
+        self.assertTrue('country' in UserSocialAuth.objects.get(uid='3').extra_data)
+
+    def test_checkpoint(self):
+        """Rows up to the checkpoint are skipped and progress is recorded."""
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            last = UserSocialAuth.objects.get(uid='2').pk
+            with open(path, 'w') as f:
+                f.write('%s' % last)
+            self.refresh(checkpoint=path)
+            self.assertEqual(self.fetch_mock.call_count, 2)
+            with open(path) as f:
+                self.assertEqual(int(f.read()), UserSocialAuth.objects.latest('pk').pk)
+        finally:
+            os.remove(path)
+
+
+class ImportAccountsTestCase(DjangoTestCase):
+    """Bulk creation of users linked to Last.fm accounts."""
+
+    def setUp(self):
+        self.paths = []
+
+    def tearDown(self):
+        for path in self.paths:
+            os.remove(path)
+
+    def write(self, content, suffix='.jsonl'):
+        fd, path = tempfile.mkstemp(suffix=suffix)
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+        self.paths.append(path)
+        return path
+
+    def jsonl(self, count, start=0):
+        return ''.join(
+            simplejson.dumps(dict(lastfm_user_response(), id=str(i), name='user%s' % i)) + '\n'
+            for i in range(start, start + count)
+        )
+
+    def load(self, path, **options):
+        options.setdefault('batch_size', 2)
+        output = StringIO()
+        call_command('import_lastfm_accounts', path, stdout=output, stderr=StringIO(), **options)
+        return output.getvalue()
+
+    def test_import(self):
+        """Users and linked accounts are created from the profiles."""
+        with self.settings(LASTFM_EXTRA_DATA=[('country', 'country')]):
+            output = self.load(self.write(self.jsonl(5)))
+        self.assertEqual(output, 'Created 5 accounts, skipped 0 existing and 0 invalid records.\n')
+        social = UserSocialAuth.objects.get(uid='3')
+        self.assertEqual(social.provider, 'lastfm')
+        self.assertEqual(social.extra_data, {
+            'id': '3', 'name': 'user3', 'access_token': '', 'country': 'UK'})
+        self.assertEqual(social.user.username, 'user3')
+        self.assertEqual(social.user.first_name, 'Richard')
+        self.assertEqual(social.user.last_name, 'Jones')
+        self.assertFalse(social.user.has_usable_password())
+
+    def test_rerun(self):
+        """Accounts which are already linked are skipped."""
+        self.load(self.write(self.jsonl(3)))
+        output = self.load(self.write(self.jsonl(3, start=1)))
+        self.assertEqual(output, 'Created 1 accounts, skipped 2 existing and 0 invalid records.\n')
+        self.assertEqual(UserSocialAuth.objects.count(), 4)
+        self.assertEqual(User.objects.count(), 4)
+
+    def test_username_taken(self):
+        """Usernames already in use get a unique suffix."""
+        User.objects.create_user(username='user1', password='test', email='')
+        self.load(self.write(self.jsonl(2)))
+        username = UserSocialAuth.objects.get(uid='1').user.username
+        self.assertTrue(username.startswith('user1'))
+        self.assertNotEqual(username, 'user1')
+        self.assertEqual(User.objects.count(), 3)
+
+    def test_invalid(self):
+        """Malformed lines and records without an id or name are skipped."""
+        content = self.jsonl(1) + 'not json\n{"name": "noid"}\n\n' + self.jsonl(1, start=1)
+        output = self.load(self.write(content))
+        self.assertEqual(output, 'Created 2 accounts, skipped 0 existing and 2 invalid records.\n')
+
+    def test_csv(self):
+        """Profiles can be read from a CSV file."""
+        path = self.write('id,name,realname,country\n7,csvuser,Jo Bloggs,UK\n8,other,,\n', '.csv')
+        self.load(path)
+        user = UserSocialAuth.objects.get(uid='7').user
+        self.assertEqual((user.username, user.first_name, user.last_name), ('csvuser', 'Jo', 'Bloggs'))
+        self.assertEqual(UserSocialAuth.objects.get(uid='8').user.username, 'other')
+
+    def test_profiles(self):
+        """LastfmProfile rows are created with LASTFM_PROFILES."""
+        with self.settings(LASTFM_PROFILES=True):
+            self.load(self.write(self.jsonl(3)))
+        profile = LastfmProfile.objects.get(lastfm_id='2')
+        self.assertEqual(profile.name, 'user2')
+        self.assertEqual(profile.playcount, 61798)
+        self.assertEqual(profile.social_auth, UserSocialAuth.objects.get(uid='2'))
+        self.assertEqual(profile.user, profile.social_auth.user)
+
+    def test_batch_queries(self):
+        """Each batch is inserted with a fixed number of queries."""
+        path = self.write(self.jsonl(6))
+        with self.assertNumQueries(10):
+            self.load(path, batch_size=3)
@@ -0,0 +1,122 @@
+from urlparse import urlparse, parse_qs
+
+from django.contrib.auth.models import User
+from django.core.urlresolvers import reverse
+from django.test import TestCase as DjangoTestCase
+
+import mock
+
+from lastfm_auth import keys
+from lastfm_auth.backend import LastfmAuth
+from lastfm_auth.exceptions import LastfmAPIError, LastfmUpstreamError
+from lastfm_auth.keys import KeyPool, RATE_LIMIT_EXCEEDED
+from lastfm_auth.tests.backend import lastfm_user_response, BEGIN_URL_NAME
+from lastfm_auth.testserver import FakeLastfmServerMixin
+
+
+KEYS = [('KEY1', 'SECRET1'), ('KEY2', 'SECRET2')]
+
+
+class KeyPoolTestCase(DjangoTestCase):
+    """Choosing between API keys."""
+
+    def setUp(self):
+        self.pool = KeyPool(KEYS, cooldown=60)
+
+    def request(self, error=None):
+        api_key = self.pool.choose()
+        try:
+            with self.pool.track(api_key):
+                if error is not None:
+                    raise error
+        except Exception:
+            pass
+        return api_key.key
+
+    def test_in_flight(self):
+        """Keys with fewer requests in flight are chosen."""
+        first = self.pool.choose()
+        with self.pool.track(first):
+            self.assertNotEqual(self.pool.choose(), first)
+
+    def test_spread(self):
+        """Sequential requests are spread over the keys."""
+        keys = [self.request() for i in range(4)]
+        self.assertEqual(sorted(keys), ['KEY1', 'KEY1', 'KEY2', 'KEY2'])
+
+    def test_throttled(self):
+        """Throttled keys are skipped during the cooldown."""
+        self.request(LastfmAPIError(RATE_LIMIT_EXCEEDED, 'Rate limit exceeded'))
+        self.assertEqual([self.request() for i in range(3)], ['KEY2'] * 3)
+
+    def test_other_errors(self):
+        """Other errors don't mark the key as throttled."""
+        self.request(LastfmUpstreamError('Timeout'))
+        self.assertEqual(self.request(), 'KEY2')
+        self.assertEqual(self.request(), 'KEY1')
+
+    def test_all_throttled(self):
+        """The key throttled longest ago is used when all keys are throttled."""
+        error = LastfmAPIError(RATE_LIMIT_EXCEEDED, 'Rate limit exceeded')
+        self.request(error)
+        self.request(error)
+        self.assertEqual(self.request(), 'KEY1')
+
+    def test_usage(self):
+        """Usage is reported per key."""
+        self.request(LastfmAPIError(RATE_LIMIT_EXCEEDED, 'Rate limit exceeded'))
+        self.request()
+        self.assertEqual(self.pool.usage(), [
+            {'key': 'KEY1', 'requests': 1, 'in_flight': 0, 'throttled': 1, 'available': False},
+            {'key': 'KEY2', 'requests': 1, 'in_flight': 0, 'throttled': 0, 'available': True},
+        ])
+
+
+class MultiKeyLoginTestCase(FakeLastfmServerMixin, DjangoTestCase):
+    """Logins and API calls with several API keys."""
+
+    def setUp(self):
+        self.start_server(
+            {'LASTFM_API_KEYS': KEYS},
+            sessions={'FAKEKEY': 'RJ'}, users={'RJ': lastfm_user_response()},
+            keys=dict(KEYS))
+        keys._pools.clear()
+        self.login_url = reverse(BEGIN_URL_NAME, kwargs={'backend': 'lastfm'})
+
+    def test_login(self):
+        """The token is exchanged with the key which started the login."""
+        for i in range(2):
+            response = self.client.get(self.login_url)
+            query = parse_qs(urlparse(response['Location']).query)
+            api_key = query['api_key'][0]
+            callback = urlparse(query['cb'][0])
+            self.assertEqual(parse_qs(callback.query)['api_key'], [api_key])
+            self.client.get(callback.path, {'api_key': api_key, 'token': 'FAKEKEY'})
+            self.assertEqual(self.server.requests[-2]['method'], 'auth.getSession')
+            self.assertEqual(self.server.requests[-2]['api_key'], api_key)
+            self.client.logout()
+        self.assertEqual(User.objects.count(), 1)
+
+    def test_single_key(self):
+        """The callback is unchanged with a single key."""
+        with self.settings(LASTFM_API_KEYS=None):
+            response = self.client.get(self.login_url)
+        query = parse_qs(urlparse(response['Location']).query)
+        self.assertEqual(urlparse(query['cb'][0]).query, '')
+
+    def test_throttled_key(self):
+        """Requests move to other keys once a key is throttled."""
+        self.server.rate_limit = 1
+        auth = LastfmAuth()
+        with mock.patch('lastfm_auth.testserver.time') as clock:
+            clock.time.return_value = 1000.0
+            auth.user_data('RJ')
+            auth.user_data('RJ')
+            try:
+                auth.user_data('RJ')
+            except LastfmAPIError:
+                pass
+        keys = [q['api_key'] for q in self.server.requests]
+        self.assertEqual(sorted(keys), ['KEY1', 'KEY1', 'KEY2'])
+        usage = auth.key_pool().usage()
+        self.assertEqual(sum(u['throttled'] for u in usage), 1)
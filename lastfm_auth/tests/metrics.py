@@ -0,0 +1,77 @@
+from StringIO import StringIO
+
+from django.core.cache import cache
+from django.core.urlresolvers import reverse
+from django.test import TestCase as DjangoTestCase
+from django.utils import simplejson
+
+import mock
+
+from lastfm_auth.tests.backend import lastfm_user_response, BEGIN_URL_NAME, COMPLETE_URL_NAME
+
+
+def fake_urlopen(url):
+    if 'auth.getSession' in url:
+        return StringIO(simplejson.dumps({'session': {'name': 'RJ', 'key': 'KEY'}}))
+    return StringIO(simplejson.dumps({'user': lastfm_user_response()}))
+
+
+class MetricsTestCase(DjangoTestCase):
+    """Instrumentation of the login flow."""
+
+    def setUp(self):
+        from lastfm_auth.metrics import MemoryMetrics
+        self.metrics = MemoryMetrics()
+        self.urlopen_patch = mock.patch('lastfm_auth.backend.urlopen')
+        self.urlopen = self.urlopen_patch.start()
+        self.urlopen.side_effect = fake_urlopen
+        cache.clear()
+
+    def tearDown(self):
+        self.urlopen_patch.stop()
+        cache.clear()
+
+    def test_no_sink(self):
+        """No sink is configured by default."""
+        from lastfm_auth.metrics import get_metrics
+        self.assertEqual(get_metrics(), None)
+
+    def test_login_stages(self):
+        """Each stage of a login is timed."""
+        with self.settings(LASTFM_METRICS=self.metrics):
+            self.client.get(reverse(BEGIN_URL_NAME, kwargs={'backend': 'lastfm'}))
+            complete_url = reverse(COMPLETE_URL_NAME, kwargs={'backend': 'lastfm'})
+            self.client.get(complete_url, {'token': 'FAKEKEY'})
+        for name in ('auth_url', 'access_token', 'user_data', 'authenticate', 'extra_data'):
+            self.assertEqual(self.metrics.observations('lastfm_auth.%s' % name, outcome='ok'), 1)
+        self.assertEqual(self.metrics.observations('lastfm_auth.upstream', call='user', outcome='ok'), 1)
+        self.assertEqual(self.metrics.observations('lastfm_auth.upstream.bytes', call='session'), 1)
+
+    def test_error_class(self):
+        """Failed stages record the error class."""
+        from lastfm_auth.backend import LastfmAuth
+        self.urlopen.side_effect = lambda url: StringIO('{"error": 6}')
+        with self.settings(LASTFM_METRICS=self.metrics):
+            self.assertRaises(Exception, LastfmAuth().user_data, 'RJ')
+        self.assertEqual(self.metrics.observations(
+            'lastfm_auth.upstream', call='user', outcome='LastfmAPIError'), 1)
+        self.assertEqual(self.metrics.observations(
+            'lastfm_auth.user_data', outcome='LastfmAPIError'), 1)
+
+    def test_cache_hits(self):
+        """Profile cache lookups are counted."""
+        from lastfm_auth.backend import LastfmAuth
+        with self.settings(LASTFM_METRICS=self.metrics, LASTFM_PROFILE_CACHE=True):
+            LastfmAuth().user_data('RJ')
+            LastfmAuth().user_data('RJ')
+        self.assertEqual(self.metrics.count('lastfm_auth.profile_cache', result='miss'), 1)
+        self.assertEqual(self.metrics.count('lastfm_auth.profile_cache', result='hit'), 1)
+
+    def test_statsd_names(self):
+        """Tags are appended to statsd metric names."""
+        from lastfm_auth.metrics import StatsdMetrics
+        metrics = StatsdMetrics('localhost', 8125, 'site')
+        metrics.sock = mock.Mock()
+        metrics.timing('lastfm_auth.upstream', 0.25, {'call': 'user', 'outcome': 'ok'})
+        data, address = metrics.sock.sendto.call_args[0]
+        self.assertEqual(data, 'site.lastfm_auth.upstream.user.ok:250|ms')
@@ -0,0 +1,63 @@
+from django.contrib.auth.models import User
+from django.test import TestCase as DjangoTestCase
+
+import mock
+from social_auth.models import UserSocialAuth
+
+from lastfm_auth.tests.backend import lastfm_user_response
+
+
+PIPELINE = (
+    'social_auth.backends.pipeline.social.social_auth_user',
+    'social_auth.backends.pipeline.user.get_username',
+    'social_auth.backends.pipeline.user.create_user',
+    'social_auth.backends.pipeline.social.associate_user',
+    'lastfm_auth.pipeline.load_extra_data',
+    'lastfm_auth.pipeline.update_user_details',
+)
+
+
+class SkipWritesPipelineTestCase(DjangoTestCase):
+    """Pipeline functions which skip unchanged writes."""
+
+    def setUp(self):
+        from lastfm_auth.metrics import MemoryMetrics
+        self.pipeline_patch = mock.patch('social_auth.backends.PIPELINE', PIPELINE)
+        self.pipeline_patch.start()
+        self.metrics = MemoryMetrics()
+
+    def tearDown(self):
+        self.pipeline_patch.stop()
+
+    def login(self, response=None):
+        from lastfm_auth.backend import LastfmBackend
+        response = response or dict(lastfm_user_response(), access_token='KEY')
+        with self.settings(LASTFM_METRICS=self.metrics):
+            return LastfmBackend().authenticate(response=response, lastfm=True)
+
+    def test_new_user(self):
+        """New users are saved with a fingerprint."""
+        user = self.login()
+        self.assertEqual(user.first_name, 'Richard')
+        social = UserSocialAuth.objects.get(provider='lastfm', uid='1000002')
+        self.assertTrue(social.extra_data['fingerprint'])
+        self.assertEqual(social.extra_data['access_token'], 'KEY')
+
+    def test_unchanged(self):
+        """Unchanged returning users are not written."""
+        self.login()
+        with mock.patch.object(User, 'save') as user_save:
+            with mock.patch('django.db.models.query.QuerySet.update') as update:
+                self.login()
+        self.assertFalse(user_save.called)
+        self.assertFalse(update.called)
+        self.assertEqual(self.metrics.count('lastfm_auth.writes_avoided', model='user'), 1)
+        self.assertEqual(self.metrics.count('lastfm_auth.writes_avoided', model='usersocialauth'), 1)
+
+    def test_changed(self):
+        """Changed data is still written."""
+        self.login()
+        self.login(dict(lastfm_user_response(), realname='Rich Jones', access_token='KEY'))
+        user = User.objects.get()
+        self.assertEqual(user.first_name, 'Rich')
+        self.assertEqual(self.metrics.count('lastfm_auth.writes_avoided', model='user'), 0)
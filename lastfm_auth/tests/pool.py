@@ -0,0 +1,204 @@
+import os
+import socket
+import subprocess
+import sys
+import threading
+from StringIO import StringIO
+from httplib import BadStatusLine, HTTPMessage
+from urllib2 import HTTPError
+
+from django.test import TestCase as DjangoTestCase
+from django.utils import simplejson
+
+import mock
+
+import lastfm_auth
+from lastfm_auth.tests.backend import lastfm_user_response
+
+
+class FakeResponse(object):
+    """Minimal stand-in for httplib.HTTPResponse."""
+
+    def __init__(self, body, status=200, reason='OK', will_close=False):
+        self.fp = StringIO(body)
+        self.status = status
+        self.reason = reason
+        self.will_close = will_close
+        self.msg = HTTPMessage(StringIO('Content-Length: %s\r\n\r\n' % len(body)))
+
+    def read(self, amt=None):
+        return self.fp.read() if amt is None else self.fp.read(amt)
+
+    def getheader(self, name, default=None):
+        return self.msg.getheader(name, default)
+
+
+class CountingConnection(object):
+    """
+    Test double for httplib connections which counts connections opened
+    and records the paths requested. Exceptions in the responses are raised
+    by getresponse.
+    """
+    lock = threading.Lock()
+    opened = 0
+    requests = []
+    responses = []
+
+    def __init__(self, host, port=None, timeout=None):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.sock = None
+        self.closed = False
+
+    @classmethod
+    def reset(cls, responses=None):
+        cls.opened = 0
+        cls.requests = []
+        cls.responses = list(responses or [])
+
+    def connect(self):
+        with self.lock:
+            CountingConnection.opened += 1
+
+    def request(self, method, path, body=None, headers=None):
+        with self.lock:
+            CountingConnection.requests.append((method, path))
+
+    def getresponse(self):
+        with self.lock:
+            response = FakeResponse('{}')
+            if CountingConnection.responses:
+                response = CountingConnection.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    def close(self):
+        self.closed = True
+
+
+class ConnectionPoolTestCase(DjangoTestCase):
+    """Keep-alive connection pool used for Last.fm API calls."""
+
+    def setUp(self):
+        from lastfm_auth.client import ConnectionPool
+        CountingConnection.reset()
+        self.pool = ConnectionPool(
+            'https', 'ws.audioscrobbler.com', size=2,
+            connection_class=CountingConnection
+        )
+
+    def test_reuse_connection(self):
+        """Sequential requests should share a single connection."""
+        self.pool.urlopen('https://ws.audioscrobbler.com/2.0/?method=a')
+        self.pool.urlopen('https://ws.audioscrobbler.com/2.0/?method=b')
+        self.assertEqual(CountingConnection.opened, 1)
+        self.assertEqual(CountingConnection.requests, [
+            ('GET', '/2.0/?method=a'), ('GET', '/2.0/?method=b'),
+        ])
+
+    def test_server_close(self):
+        """Connections the server asks to close are not reused."""
+        CountingConnection.reset([FakeResponse('{}', will_close=True)])
+        self.pool.urlopen('https://ws.audioscrobbler.com/2.0/')
+        self.pool.urlopen('https://ws.audioscrobbler.com/2.0/')
+        self.assertEqual(CountingConnection.opened, 2)
+
+    def test_dropped_connection(self):
+        """A reused connection closed by the server is replaced and the request sent again."""
+        self.pool.urlopen('https://ws.audioscrobbler.com/2.0/?method=a')
+        CountingConnection.reset([BadStatusLine('')])
+        response = self.pool.urlopen('https://ws.audioscrobbler.com/2.0/?method=b')
+        self.assertEqual(response.read(), '{}')
+        self.assertEqual(CountingConnection.opened, 1)
+        self.assertEqual(CountingConnection.requests, [
+            ('GET', '/2.0/?method=b'), ('GET', '/2.0/?method=b'),
+        ])
+
+    def test_timeout_not_resent(self):
+        """A reused connection which times out waiting for the response is not retried."""
+        self.pool.urlopen('https://ws.audioscrobbler.com/2.0/?method=a')
+        CountingConnection.reset([socket.timeout('timed out')])
+        self.assertRaises(socket.timeout, self.pool.urlopen,
+            'https://ws.audioscrobbler.com/2.0/?method=auth.getSession&token=T')
+        self.assertEqual(CountingConnection.requests, [
+            ('GET', '/2.0/?method=auth.getSession&token=T'),
+        ])
+        self.assertEqual(CountingConnection.opened, 0)
+        self.assertEqual(self.pool._idle.qsize(), 0)
+
+    def test_pool_size(self):
+        """Idle connections beyond the pool size are closed."""
+        conns = [self.pool._get_connection()[0] for i in range(3)]
+        for conn in conns:
+            self.pool._put_connection(conn)
+        self.assertEqual(CountingConnection.opened, 3)
+        self.assertEqual(self.pool._idle.qsize(), 2)
+        self.assertTrue(conns[-1].closed)
+
+    def test_error_status(self):
+        """Non-2xx responses raise HTTPError like urllib2.urlopen."""
+        CountingConnection.reset([FakeResponse('{}', status=503, reason='Unavailable')])
+        self.assertRaises(HTTPError, self.pool.urlopen, 'https://ws.audioscrobbler.com/2.0/')
+
+    def test_max_size(self):
+        """Responses over the max size are rejected."""
+        from lastfm_auth.client import ConnectionPool
+        from lastfm_auth.exceptions import LastfmResponseError
+        pool = ConnectionPool(
+            'https', 'ws.audioscrobbler.com', max_size=10,
+            connection_class=CountingConnection
+        )
+        CountingConnection.reset([FakeResponse('x' * 11)])
+        self.assertRaises(LastfmResponseError, pool.urlopen, 'https://ws.audioscrobbler.com/2.0/')
+        response = FakeResponse('x' * 11)
+        response.msg = HTTPMessage(StringIO(''))
+        CountingConnection.reset([response])
+        self.assertRaises(LastfmResponseError, pool.urlopen, 'https://ws.audioscrobbler.com/2.0/')
+        self.assertEqual(pool._idle.qsize(), 0)
+
+    def test_timeouts(self):
+        """Connect timeout is passed when opening connections."""
+        from lastfm_auth.client import ConnectionPool
+        pool = ConnectionPool(
+            'https', 'ws.audioscrobbler.com', connect_timeout=1.5,
+            connection_class=CountingConnection
+        )
+        conn, reused = pool._get_connection()
+        self.assertEqual(conn.timeout, 1.5)
+        self.assertFalse(reused)
+
+    def test_login_calls_share_connection(self):
+        """access_token and user_data should reuse the same connection."""
+        from lastfm_auth import backend, client
+        CountingConnection.reset([
+            FakeResponse(simplejson.dumps({'session': {'name': 'RJ', 'key': 'KEY'}})),
+            FakeResponse(simplejson.dumps({'user': lastfm_user_response()})),
+        ])
+        with mock.patch.object(client, '_pools', {}):
+            with mock.patch('httplib.HTTPSConnection', CountingConnection):
+                auth = backend.LastfmAuth(mock.MagicMock(), 'http://example.com')
+                username, access_token = auth.access_token('REQUESTTOKEN')
+                data = auth.user_data(username)
+        self.assertEqual(username, 'RJ')
+        self.assertEqual(data['id'], '1000002')
+        self.assertEqual(CountingConnection.opened, 1)
+
+
+class LazyImportTestCase(DjangoTestCase):
+    """The HTTP client is not loaded until the first API call."""
+
+    def test_backend_import(self):
+        """Importing the backend doesn't import lastfm_auth.client."""
+        script = (
+            "import sys, runtests\n"
+            "import lastfm_auth.backend\n"
+            "print 'lastfm_auth.client' in sys.modules\n"
+        )
+        root = os.path.dirname(os.path.dirname(os.path.abspath(lastfm_auth.__file__)))
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        process = subprocess.Popen([sys.executable, '-c', script], cwd=root, env=env,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        output, errors = process.communicate()
+        self.assertEqual(output.strip(), 'False', errors)
@@ -0,0 +1,106 @@
+from datetime import datetime
+from StringIO import StringIO
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+from django.test import TestCase as DjangoTestCase
+
+from social_auth.models import UserSocialAuth
+
+from lastfm_auth.models import LastfmProfile, profile_values
+from lastfm_auth.tests.backend import lastfm_user_response, COMPLETE_URL_NAME
+from lastfm_auth.testserver import FakeLastfmServerMixin
+
+
+REGISTERED = datetime(2002, 11, 20, 11, 50, 40)
+
+
+class LastfmProfileTestCase(FakeLastfmServerMixin, DjangoTestCase):
+    """LastfmProfile rows kept in sync at login."""
+
+    def setUp(self):
+        self.start_server(
+            {'LASTFM_PROFILES': True},
+            sessions={'FAKEKEY': 'RJ'}, users={'RJ': lastfm_user_response()})
+        self.complete_url = reverse(COMPLETE_URL_NAME, kwargs={'backend': 'lastfm'})
+
+    def login(self):
+        self.client.get(self.complete_url, {'token': 'FAKEKEY'})
+        self.client.logout()
+
+    def test_profile_values(self):
+        """Values are converted from user.getinfo responses."""
+        self.assertEqual(profile_values(lastfm_user_response()), {
+            'lastfm_id': u'1000002', 'name': 'RJ', 'country': 'UK',
+            'playcount': 61798, 'registered': REGISTERED,
+        })
+        self.assertEqual(profile_values({'id': 1, 'playcount': 'x', 'registered': 1037793040}),
+            {'lastfm_id': u'1', 'playcount': None, 'registered': REGISTERED})
+        self.assertEqual(profile_values({}), {})
+
+    def test_login(self):
+        """A profile is created at the first login."""
+        self.login()
+        profile = LastfmProfile.objects.get(name='RJ')
+        self.assertEqual(profile.user, User.objects.get())
+        self.assertEqual(profile.social_auth, UserSocialAuth.objects.get())
+        self.assertEqual(profile.lastfm_id, '1000002')
+        self.assertEqual(profile.country, 'UK')
+        self.assertEqual(profile.playcount, 61798)
+        self.assertEqual(profile.registered, REGISTERED)
+
+    def test_update(self):
+        """Changed values are updated at later logins."""
+        self.login()
+        self.server.users['RJ'] = dict(lastfm_user_response(), playcount=70000, country='US')
+        self.login()
+        profile = LastfmProfile.objects.get()
+        self.assertEqual((profile.playcount, profile.country), (70000, 'US'))
+        self.assertEqual(LastfmProfile.objects.filter(country='UK').count(), 0)
+
+    def test_unchanged(self):
+        """Unchanged profiles are not written."""
+        self.login()
+        social_user = UserSocialAuth.objects.get()
+        with self.assertNumQueries(1):
+            LastfmProfile.objects.sync(social_user, lastfm_user_response())
+
+    def test_disabled(self):
+        """No profiles are kept without LASTFM_PROFILES."""
+        with self.settings(LASTFM_PROFILES=False):
+            self.login()
+        self.assertEqual(LastfmProfile.objects.count(), 0)
+
+
+class BackfillProfilesTestCase(DjangoTestCase):
+    """Creating profiles for existing accounts."""
+
+    def setUp(self):
+        for i in range(5):
+            name = 'user%s' % i
+            user = User.objects.create_user(username=name, password='test', email='')
+            UserSocialAuth.objects.create(
+                user=user, provider='lastfm', uid=str(i),
+                extra_data={'id': str(i), 'name': name, 'country': 'UK', 'access_token': 'KEY'}
+            )
+
+    def backfill(self):
+        output = StringIO()
+        call_command('backfill_lastfm_profiles', batch_size=2, stdout=output)
+        return output.getvalue()
+
+    def test_backfill(self):
+        """Profiles are created from extra_data."""
+        self.assertEqual(self.backfill(), 'Created 5 profiles.\n')
+        profiles = LastfmProfile.objects.order_by('lastfm_id')
+        self.assertEqual([p.name for p in profiles], ['user%s' % i for i in range(5)])
+        self.assertEqual([p.user.username for p in profiles], ['user%s' % i for i in range(5)])
+        self.assertEqual(LastfmProfile.objects.filter(country='UK').count(), 5)
+
+    def test_idempotent(self):
+        """Existing profiles are skipped."""
+        LastfmProfile.objects.sync(UserSocialAuth.objects.get(uid='3'), {'name': 'user3'})
+        self.assertEqual(self.backfill(), 'Created 4 profiles.\n')
+        self.assertEqual(self.backfill(), 'Created 0 profiles.\n')
+        self.assertEqual(LastfmProfile.objects.count(), 5)
@@ -0,0 +1,240 @@
+import threading
+from StringIO import StringIO
+
+from django.core.cache import cache
+from django.test import TestCase as DjangoTestCase
+from django.utils import simplejson
+
+import mock
+
+from lastfm_auth.tests.backend import lastfm_user_response, lastfm_user_fields
+
+
+class TokenBucketTestCase(DjangoTestCase):
+    """In-process token bucket."""
+
+    def test_burst(self):
+        """Up to burst tokens are available right away."""
+        from lastfm_auth.ratelimit import TokenBucket
+        bucket = TokenBucket(rate=1, burst=3)
+        self.assertEqual([bucket.take() for i in range(3)], [0, 0, 0])
+        self.assertTrue(bucket.take() > 0)
+
+    def test_acquire_timeout(self):
+        """Acquire gives up when no token is available within the timeout."""
+        from lastfm_auth.ratelimit import TokenBucket
+        bucket = TokenBucket(rate=1, burst=1)
+        self.assertTrue(bucket.acquire(0))
+        self.assertFalse(bucket.acquire(0.1))
+
+    def test_refill(self):
+        """Tokens are refilled at the configured rate."""
+        from lastfm_auth.ratelimit import TokenBucket
+        bucket = TokenBucket(rate=50, burst=1)
+        self.assertTrue(bucket.acquire(0))
+        self.assertTrue(bucket.acquire(0.1))
+
+    def test_abstract(self):
+        """Limiters must implement take."""
+        from lastfm_auth.ratelimit import Limiter
+        self.assertRaises(TypeError, Limiter)
+
+
+class CacheRateLimiterTestCase(DjangoTestCase):
+    """Rate limiter shared through the Django cache."""
+
+    def setUp(self):
+        cache.clear()
+
+    def test_window(self):
+        """Only rate slots are given out per window."""
+        from lastfm_auth.ratelimit import CacheRateLimiter
+        limiter = CacheRateLimiter(2, cache)
+        with mock.patch('lastfm_auth.ratelimit.time') as clock:
+            clock.time.return_value = 1000.25
+            self.assertEqual([limiter.take() for i in range(2)], [0, 0])
+            self.assertEqual(limiter.take(), 0.75)
+            clock.time.return_value = 1001.0
+            self.assertEqual(limiter.take(), 0)
+
+    def test_throttle(self):
+        """Calls past the limit raise RateLimitExceeded."""
+        from lastfm_auth.ratelimit import throttle, RateLimitExceeded
+        settings = {
+            'LASTFM_RATE_LIMIT': 1, 'LASTFM_RATE_LIMIT_CACHE': 'default',
+            'LASTFM_RATE_LIMIT_TIMEOUT': 0,
+        }
+        with self.settings(**settings):
+            # Keep both calls in the same one second window
+            with mock.patch('lastfm_auth.ratelimit.time') as clock:
+                clock.time.return_value = 1000.25
+                throttle()
+                self.assertRaises(RateLimitExceeded, throttle)
+
+    def test_throttled_access_token(self):
+        """A throttled auth.getSession call fails the token exchange."""
+        from lastfm_auth.backend import LastfmAuth
+        from lastfm_auth.exceptions import RateLimitExceeded
+        with self.settings(LASTFM_RATE_LIMIT=1, LASTFM_RATE_LIMIT_TIMEOUT=0):
+            with mock.patch('lastfm_auth.backend.connection_pool') as pool:
+                pool.return_value.urlopen.return_value = StringIO(
+                    simplejson.dumps({'session': {'name': 'RJ', 'key': 'KEY'}}))
+                auth = LastfmAuth()
+                self.assertEqual(auth.access_token('TOKEN1'), ('RJ', 'KEY'))
+                self.assertRaises(RateLimitExceeded, auth.access_token, 'TOKEN2')
+
+
+class WaitCounter(object):
+    """Stand-in for an Event which signals once `expected` threads wait on it."""
+
+    def __init__(self, expected):
+        self.expected = expected
+        self.waiting = 0
+        self.event = threading.Event()
+        self.all_waiting = threading.Event()
+        self.lock = threading.Lock()
+
+    def wait(self, timeout=None):
+        with self.lock:
+            self.waiting += 1
+            if self.waiting >= self.expected:
+                self.all_waiting.set()
+        return self.event.wait(timeout)
+
+    def set(self):
+        self.event.set()
+
+
+class SingleFlightTestCase(DjangoTestCase):
+    """Coalescing of concurrent calls."""
+
+    def test_coalesce_user_data(self):
+        """Concurrent user_data calls for the same username share one request."""
+        from lastfm_auth.backend import LastfmAuth, _user_data_flight
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow_urlopen(url):
+            started.set()
+            release.wait(5)
+            return StringIO(simplejson.dumps({'user': lastfm_user_response()}))
+
+        results = []
+        with mock.patch('lastfm_auth.backend.urlopen') as urlopen:
+            urlopen.side_effect = slow_urlopen
+            threads = [
+                threading.Thread(target=lambda: results.append(LastfmAuth().user_data('RJ')))
+                for i in range(3)
+            ]
+            threads[0].start()
+            self.assertTrue(started.wait(5))
+            # The followers wait on the call of the first thread
+            done = WaitCounter(expected=2)
+            _user_data_flight._calls['RJ'].done = done
+            for thread in threads[1:]:
+                thread.start()
+            self.assertTrue(done.all_waiting.wait(5))
+            release.set()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(urlopen.call_count, 1)
+        self.assertEqual(results, [lastfm_user_fields()] * 3)
+
+    def test_errors_shared(self):
+        """Errors are raised to the caller."""
+        from lastfm_auth.ratelimit import SingleFlight
+        flight = SingleFlight()
+
+        def fail():
+            raise ValueError('Failed')
+
+        self.assertRaises(ValueError, flight.do, 'key', fail)
+        self.assertEqual(flight.do('key', lambda: 1), 1)
+
+
+class InFlightLimiterTestCase(DjangoTestCase):
+    """Limit on the number of upstream calls in progress."""
+
+    def setUp(self):
+        self.settings_override = self.settings(
+            LASTFM_MAX_IN_FLIGHT=1, LASTFM_IN_FLIGHT_TIMEOUT=0)
+        self.settings_override.enable()
+
+    def tearDown(self):
+        self.settings_override.disable()
+
+    def test_limit(self):
+        """Calls past the limit are rejected and counted."""
+        from lastfm_auth.ratelimit import InFlightLimiter
+        limiter = InFlightLimiter(2)
+        self.assertTrue(limiter.acquire())
+        self.assertTrue(limiter.acquire())
+        self.assertFalse(limiter.acquire())
+        limiter.release()
+        self.assertTrue(limiter.acquire(0))
+        self.assertEqual(limiter.stats(), {
+            'limit': 2, 'in_flight': 2, 'waiting': 0, 'queued': 0, 'rejected': 1})
+
+    def test_queue(self):
+        """Calls wait for a slot to be released up to the timeout."""
+        from lastfm_auth.ratelimit import InFlightLimiter
+        limiter = InFlightLimiter(1)
+        limiter.acquire()
+        timer = threading.Timer(0.05, limiter.release)
+        timer.start()
+        self.assertTrue(limiter.acquire(1))
+        timer.join()
+        self.assertFalse(limiter.acquire(0.05))
+        stats = limiter.stats()
+        self.assertEqual((stats['queued'], stats['rejected'], stats['waiting']), (2, 1, 0))
+
+    def test_disabled(self):
+        """There is no limit by default."""
+        from lastfm_auth.ratelimit import in_flight_limiter
+        with self.settings(LASTFM_MAX_IN_FLIGHT=None):
+            self.assertEqual(in_flight_limiter(), None)
+        self.assertEqual(in_flight_limiter().limit, 1)
+
+    def test_released(self):
+        """Slots are released when the call fails."""
+        from lastfm_auth.backend import LastfmAuth
+        from lastfm_auth.exceptions import LastfmUpstreamError
+        from lastfm_auth.ratelimit import in_flight_limiter
+        with mock.patch('lastfm_auth.backend.connection_pool') as pool:
+            pool.return_value.urlopen.side_effect = IOError('Timed out')
+            self.assertRaises(LastfmUpstreamError, LastfmAuth().access_token, 'TOKEN')
+        self.assertEqual(in_flight_limiter().stats()['in_flight'], 0)
+
+    def test_throttle_outside_slot(self):
+        """Waiting for the rate limit doesn't hold a slot."""
+        from lastfm_auth.backend import LastfmAuth
+        from lastfm_auth.ratelimit import in_flight_limiter
+        in_flight = []
+
+        def throttle():
+            in_flight.append(in_flight_limiter().stats()['in_flight'])
+
+        with mock.patch('lastfm_auth.backend.throttle', throttle):
+            with mock.patch('lastfm_auth.backend.connection_pool') as pool:
+                pool.return_value.urlopen.side_effect = lambda url: (
+                    in_flight.append(in_flight_limiter().stats()['in_flight']) or
+                    StringIO(simplejson.dumps({'session': {'name': 'RJ', 'key': 'KEY'}})))
+                LastfmAuth().access_token('TOKEN')
+        self.assertEqual(in_flight, [0, 1])
+
+    def test_overloaded_login(self):
+        """Logins are sent to the login error url when no slot is free."""
+        from django.core.urlresolvers import reverse
+        from lastfm_auth.ratelimit import in_flight_limiter
+        from lastfm_auth.tests.backend import COMPLETE_URL_NAME, LOGIN_ERROR_URL
+        limiter = in_flight_limiter()
+        limiter.acquire()
+        try:
+            with mock.patch('lastfm_auth.backend.connection_pool') as pool:
+                url = reverse(COMPLETE_URL_NAME, kwargs={'backend': 'lastfm'})
+                response = self.client.get(url, {'token': 'FAKEKEY'})
+                self.assertFalse(pool.called)
+        finally:
+            limiter.release()
+        self.assertRedirects(response, LOGIN_ERROR_URL)
+        self.assertEqual(limiter.stats()['rejected'], 1)
@@ -0,0 +1,117 @@
+import threading
+import time
+from urlparse import urlparse, parse_qs, parse_qsl
+
+from django.core.urlresolvers import reverse
+from django.test import TestCase as DjangoTestCase
+
+import mock
+
+from lastfm_auth.backend import LastfmAuth
+from lastfm_auth.cache import token_cache
+from lastfm_auth.exceptions import LastfmAPIError, LastfmTokenUsed
+from lastfm_auth.tests.backend import lastfm_user_response, BEGIN_URL_NAME, \
+    COMPLETE_URL_NAME, NEW_USER_REDIRECT
+from lastfm_auth.testserver import FakeLastfmServerMixin
+
+
+def browser(session_key):
+    """A request from an anonymous browser with the given session key."""
+    request = mock.MagicMock()
+    request.session.session_key = session_key
+    request.user.is_authenticated.return_value = False
+    return request
+
+
+class TokenReplayTestCase(FakeLastfmServerMixin, DjangoTestCase):
+    """Duplicate callbacks with the same request token."""
+
+    def setUp(self):
+        self.start_server(
+            {'LASTFM_TOKEN_REPLAY_TTL': 60, 'LASTFM_TOKEN_REPLAY_WAIT': 1},
+            sessions={'FAKEKEY': 'RJ'}, users={'RJ': lastfm_user_response()},
+            single_use=True)
+        self.complete_url = reverse(COMPLETE_URL_NAME, kwargs={'backend': 'lastfm'})
+
+    def exchanges(self):
+        return [q for q in self.server.requests if q['method'] == 'auth.getSession']
+
+    def test_same_session(self):
+        """The same browser session gets the session of the first exchange."""
+        first = LastfmAuth(browser('abc')).exchange_token('FAKEKEY')
+        second = LastfmAuth(browser('abc')).exchange_token('FAKEKEY')
+        self.assertEqual(first, ('RJ', 'SESSIONKEY'))
+        self.assertEqual(second, first)
+        self.assertEqual(len(self.exchanges()), 1)
+
+    def test_other_session(self):
+        """Other browser sessions fail without calling Last.fm."""
+        LastfmAuth(browser('abc')).exchange_token('FAKEKEY')
+        auth = LastfmAuth(browser('xyz'))
+        self.assertRaises(LastfmTokenUsed, auth.exchange_token, 'FAKEKEY')
+        auth = LastfmAuth(browser(None))
+        self.assertRaises(LastfmTokenUsed, auth.exchange_token, 'FAKEKEY')
+        self.assertEqual(len(self.exchanges()), 1)
+
+    def test_in_progress(self):
+        """A duplicate waits for the exchange in progress."""
+        tokens = token_cache()
+        owner = LastfmAuth(browser('abc')).session_owner()
+        tokens.claim('FAKEKEY', owner)
+
+        polling = threading.Event()
+
+        def poll(seconds):
+            polling.set()
+            time.sleep(seconds)
+
+        def finish():
+            # The exchange completes once the duplicate is waiting on it
+            polling.wait(5)
+            tokens.set('FAKEKEY', owner, ('RJ', 'SESSIONKEY'))
+
+        thread = threading.Thread(target=finish)
+        thread.start()
+        with mock.patch('lastfm_auth.cache.time') as clock:
+            clock.time.side_effect = time.time
+            clock.sleep.side_effect = poll
+            session = LastfmAuth(browser('abc')).exchange_token('FAKEKEY')
+        thread.join()
+        self.assertTrue(polling.is_set())
+        self.assertEqual(session, ('RJ', 'SESSIONKEY'))
+        self.assertEqual(self.exchanges(), [])
+
+    def test_failed_exchange(self):
+        """Tokens which could not be exchanged are not remembered."""
+        auth = LastfmAuth(browser('abc'))
+        self.assertRaises(LastfmAPIError, auth.exchange_token, 'OTHERKEY')
+        self.assertRaises(LastfmAPIError, auth.exchange_token, 'OTHERKEY')
+        self.assertEqual(len(self.exchanges()), 2)
+
+    def test_logged_in(self):
+        """A duplicate callback after the login completed is redirected as a success."""
+        response = self.client.get(reverse(BEGIN_URL_NAME, kwargs={'backend': 'lastfm'}),
+                                   {'next': '/next/'})
+        callback = urlparse(parse_qs(urlparse(response['Location']).query)['cb'][0])
+        data = dict(parse_qsl(callback.query), token='FAKEKEY')
+        response = self.client.get(callback.path, data)
+        self.assertRedirects(response, NEW_USER_REDIRECT)
+        response = self.client.get(callback.path, data)
+        self.assertEqual(response['Location'], 'http://testserver/next/')
+        self.assertEqual(len(self.exchanges()), 1)
+
+    def test_other_browser(self):
+        """A duplicate callback from another browser goes to the error page."""
+        self.client.get(self.complete_url, {'token': 'FAKEKEY'})
+        self.client.logout()
+        response = self.client.get(self.complete_url, {'token': 'FAKEKEY'})
+        self.assertRedirects(response, '/error/')
+        self.assertEqual(len(self.exchanges()), 1)
+
+    def test_disabled(self):
+        """Without LASTFM_TOKEN_REPLAY_TTL every callback calls Last.fm."""
+        with self.settings(LASTFM_TOKEN_REPLAY_TTL=None):
+            auth = LastfmAuth(browser('abc'))
+            auth.exchange_token('FAKEKEY')
+            self.assertRaises(LastfmAPIError, auth.exchange_token, 'FAKEKEY')
+        self.assertEqual(len(self.exchanges()), 2)
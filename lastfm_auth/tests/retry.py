@@ -0,0 +1,162 @@
+import threading
+
+from django.test import TestCase as DjangoTestCase
+
+import mock
+
+from lastfm_auth.backend import LastfmAuth
+from lastfm_auth.breaker import circuit_breaker
+from lastfm_auth.exceptions import LastfmAPIError, LastfmUpstreamError
+from lastfm_auth.retry import HedgeBudget, with_retries, hedged
+from lastfm_auth.tests.backend import lastfm_user_response
+from lastfm_auth.testserver import FakeLastfmServerMixin
+
+
+class Flaky(object):
+    """Callable raising the given errors before returning a value."""
+
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return 'ok'
+
+
+class RetryTestCase(DjangoTestCase):
+    """Retrying failed idempotent calls."""
+
+    def setUp(self):
+        self.sleep_patch = mock.patch('lastfm_auth.retry.time.sleep')
+        self.sleep = self.sleep_patch.start()
+
+    def tearDown(self):
+        self.sleep_patch.stop()
+
+    def test_disabled(self):
+        """Nothing is retried by default."""
+        func = Flaky(LastfmUpstreamError())
+        self.assertRaises(LastfmUpstreamError, with_retries, func)
+        self.assertEqual(func.calls, 1)
+
+    def test_retries(self):
+        """Upstream errors and temporary API errors are retried with backoff."""
+        func = Flaky(LastfmUpstreamError(), LastfmAPIError(16, 'Temporary error'))
+        with self.settings(LASTFM_RETRIES=2, LASTFM_RETRY_BACKOFF=0.1):
+            self.assertEqual(with_retries(func), 'ok')
+        self.assertEqual(func.calls, 3)
+        delays = [call[0][0] for call in self.sleep.call_args_list]
+        self.assertEqual(len(delays), 2)
+        self.assertTrue(0 <= delays[0] <= 0.1, delays)
+        self.assertTrue(0 <= delays[1] <= 0.2, delays)
+
+    def test_limit(self):
+        """The last error is raised once the retries are used up."""
+        func = Flaky(LastfmUpstreamError(), LastfmUpstreamError(), LastfmUpstreamError())
+        with self.settings(LASTFM_RETRIES=2):
+            self.assertRaises(LastfmUpstreamError, with_retries, func)
+        self.assertEqual(func.calls, 3)
+
+    def test_not_retryable(self):
+        """Errors which would happen again are not retried."""
+        func = Flaky(LastfmAPIError(6, 'No user with that name'))
+        with self.settings(LASTFM_RETRIES=2):
+            self.assertRaises(LastfmAPIError, with_retries, func)
+        self.assertEqual(func.calls, 1)
+
+
+class HedgeTestCase(DjangoTestCase):
+    """Hedging slow idempotent calls."""
+
+    def setUp(self):
+        self.settings_override = self.settings(LASTFM_HEDGE_DELAY=0.05)
+        self.settings_override.enable()
+        self.calls = 0
+        self.lock = threading.Lock()
+        self.release = threading.Event()
+
+    def tearDown(self):
+        self.release.set()
+        self.settings_override.disable()
+
+    def slow_first(self):
+        with self.lock:
+            self.calls += 1
+            call = self.calls
+        if call == 1:
+            # The first call only answers once the test releases it
+            self.release.wait(5)
+            return 'slow'
+        return 'fast'
+
+    def release_on_decision(self):
+        """Release the first call once hedged decides whether to hedge it."""
+        def breaker():
+            self.release.set()
+            return circuit_breaker()
+        return mock.patch('lastfm_auth.retry.circuit_breaker', breaker)
+
+    def test_hedge(self):
+        """A second call is made after the delay and the first answer is used."""
+        self.assertEqual(hedged(self.slow_first), 'fast')
+        self.assertEqual(self.calls, 2)
+
+    def test_fast(self):
+        """Calls answering within the delay are not hedged."""
+        self.calls = 1
+        with self.settings(LASTFM_HEDGE_DELAY=5):
+            self.assertEqual(hedged(self.slow_first), 'fast')
+        self.assertEqual(self.calls, 2)
+
+    def test_budget(self):
+        """No hedges are made once the budget is used up."""
+        with self.settings(LASTFM_HEDGE_BURST=0):
+            with self.release_on_decision():
+                self.assertEqual(hedged(self.slow_first), 'slow')
+        self.assertEqual(self.calls, 1)
+
+    def test_failures(self):
+        """No hedges are made while the circuit breaker sees failures."""
+        circuit_breaker().failure()
+        try:
+            with self.release_on_decision():
+                self.assertEqual(hedged(self.slow_first), 'slow')
+        finally:
+            circuit_breaker().success()
+        self.assertEqual(self.calls, 1)
+
+    def test_error(self):
+        """Errors are raised when no call succeeds."""
+        self.assertRaises(LastfmUpstreamError, hedged, Flaky(LastfmUpstreamError()))
+
+    def test_hedge_budget(self):
+        """Each call adds a fraction of a hedge to the budget."""
+        budget = HedgeBudget(ratio=0.5, burst=1)
+        self.assertTrue(budget.withdraw())
+        self.assertFalse(budget.withdraw())
+        budget.deposit()
+        self.assertFalse(budget.withdraw())
+        budget.deposit()
+        self.assertTrue(budget.withdraw())
+
+
+class UpstreamRetryTestCase(FakeLastfmServerMixin, DjangoTestCase):
+    """Retries of calls to the fake Last.fm server."""
+
+    def setUp(self):
+        self.start_server(
+            {'LASTFM_RETRIES': 2, 'LASTFM_RETRY_BACKOFF': 0, 'LASTFM_CIRCUIT_FAILURES': 0},
+            sessions={'TOKEN': 'RJ'}, users={'RJ': lastfm_user_response()}, error_rate=1)
+
+    def test_user_data(self):
+        """user.getinfo is retried."""
+        self.assertRaises(LastfmAPIError, LastfmAuth().user_data, 'RJ')
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_access_token(self):
+        """auth.getSession is never retried."""
+        self.assertRaises(LastfmAPIError, LastfmAuth().access_token, 'TOKEN')
+        self.assertEqual(len(self.server.requests), 1)
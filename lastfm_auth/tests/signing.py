@@ -0,0 +1,55 @@
+from hashlib import md5
+from urlparse import urlparse, parse_qs
+
+from django.test import TestCase as DjangoTestCase
+
+from lastfm_auth.signing import Signer, sign_params, get_signer
+
+
+class SignerTestCase(DjangoTestCase):
+    """Signing and url building for API requests."""
+
+    def setUp(self):
+        self.signer = Signer('KEY', 'SECRET', 'https://ws.audioscrobbler.com/2.0/')
+
+    def test_session_signature(self):
+        """auth.getSession is signed as described by the Last.fm auth spec."""
+        expected = md5('api_keyKEYmethodauth.getSessiontokenTOKENSECRET').hexdigest()
+        self.assertEqual(self.signer.sign('auth.getSession', {'token': 'TOKEN'}), expected)
+
+    def test_sorted_params(self):
+        """Parameters sorting before method are signed in order."""
+        params = {'artist': 'Cher', 'sk': 'SESSION', 'format': 'json'}
+        expected = md5('api_keyKEYartistChermethodtrack.lovesk' 'SESSIONSECRET').hexdigest()
+        self.assertEqual(self.signer.sign('track.love', params), expected)
+        full = dict(params, api_key='KEY', method='track.love')
+        self.assertEqual(sign_params(full, 'SECRET'), expected)
+
+    def test_unicode(self):
+        """Unicode values are signed and encoded as utf-8."""
+        params = {'user': u'Bj\xf6rk'}
+        url = self.signer.url('user.getinfo', params, signed=True)
+        query = parse_qs(urlparse(url).query)
+        self.assertEqual(query['user'][0].decode('utf-8'), u'Bj\xf6rk')
+        full = dict(params, api_key='KEY', method='user.getinfo')
+        self.assertEqual(query['api_sig'][0], sign_params(full, 'SECRET'))
+
+    def test_url(self):
+        """Urls include the static and request parameters."""
+        url = self.signer.url('auth.getSession', {'token': 'TOKEN'}, signed=True)
+        scheme, netloc, path, params, query, fragment = urlparse(url)
+        self.assertEqual('%s://%s%s' % (scheme, netloc, path), 'https://ws.audioscrobbler.com/2.0/')
+        query = parse_qs(query)
+        self.assertEqual(query['api_key'][0], 'KEY')
+        self.assertEqual(query['method'][0], 'auth.getSession')
+        self.assertEqual(query['format'][0], 'json')
+        self.assertEqual(query['token'][0], 'TOKEN')
+        self.assertEqual(query['api_sig'][0], self.signer.sign('auth.getSession', {'token': 'TOKEN'}))
+
+    def test_shared_signer(self):
+        """Signers are reused until the settings change."""
+        from lastfm_auth.backend import LastfmAuth
+        self.assertTrue(LastfmAuth.signer() is LastfmAuth.signer())
+        with self.settings(LASTFM_SECRET='OTHER'):
+            self.assertEqual(LastfmAuth.signer().secret, 'OTHER')
+        self.assertTrue(get_signer('KEY', 'SECRET', 'url') is get_signer('KEY', 'SECRET', 'url'))
@@ -0,0 +1,132 @@
+import threading
+
+from django.contrib.auth.models import User
+from django.core.urlresolvers import reverse
+from django.test import TestCase as DjangoTestCase
+
+from social_auth.models import UserSocialAuth
+
+from lastfm_auth.cache import profile_cache
+from lastfm_auth.tasks import Executor, ThreadExecutor, enrich_profile
+from lastfm_auth.tests.backend import lastfm_user_response, COMPLETE_URL_NAME
+from lastfm_auth.testserver import FakeLastfmServerMixin
+
+
+class RecordingExecutor(Executor):
+    """Keep submitted tasks to be run by the test."""
+
+    def __init__(self):
+        self.tasks = []
+
+    def submit(self, func, *args):
+        self.tasks.append((func, args))
+
+    def run(self):
+        tasks, self.tasks = self.tasks, []
+        for func, args in tasks:
+            func(*args)
+
+
+class DeferredProfileTestCase(FakeLastfmServerMixin, DjangoTestCase):
+    """Complete returning logins without waiting on user.getinfo."""
+
+    def setUp(self):
+        self.executor = RecordingExecutor()
+        self.start_server(
+            {'LASTFM_DEFER_PROFILE': True, 'LASTFM_EXECUTOR': self.executor,
+             'LASTFM_EXTRA_DATA': [('country', 'country')]},
+            sessions={'FAKEKEY': 'RJ'}, users={'RJ': lastfm_user_response()})
+        self.complete_url = reverse(COMPLETE_URL_NAME, kwargs={'backend': 'lastfm'})
+
+    def methods(self):
+        return [q['method'] for q in self.server.requests]
+
+    def login(self):
+        self.client.get(self.complete_url, {'token': 'FAKEKEY'})
+        self.client.logout()
+
+    def test_first_login(self):
+        """Without a known user id the profile is fetched during the login."""
+        self.login()
+        self.assertEqual(self.methods(), ['auth.getSession', 'user.getinfo'])
+        self.assertEqual(self.executor.tasks, [])
+        self.assertEqual(profile_cache().get_identity('RJ'), '1000002')
+        self.assertEqual(User.objects.get().first_name, 'Richard')
+
+    def test_returning_login(self):
+        """Returning users log in with the session data only."""
+        self.login()
+        self.server.users['RJ'] = dict(lastfm_user_response(),
+            realname='Rick Jones', country='US')
+        self.server.requests = []
+        self.login()
+        self.assertEqual(self.methods(), ['auth.getSession'])
+        self.assertEqual(self.executor.tasks, [(enrich_profile, ('1000002', 'RJ'))])
+        user = User.objects.get()
+        self.assertEqual(user.first_name, 'Richard')
+        access_token = UserSocialAuth.objects.get().extra_data['access_token']
+        # The profile is stored once the deferred task has run
+        self.executor.run()
+        self.assertEqual(self.methods(), ['auth.getSession', 'user.getinfo'])
+        user = User.objects.get()
+        self.assertEqual((user.first_name, user.last_name), ('Rick', 'Jones'))
+        extra_data = UserSocialAuth.objects.get().extra_data
+        self.assertEqual(extra_data['country'], 'US')
+        self.assertEqual(extra_data['access_token'], access_token)
+
+    def test_changed_id(self):
+        """The remembered id is dropped when the username moves to another account."""
+        self.login()
+        self.server.users['RJ'] = dict(lastfm_user_response(), id='2000000')
+        self.login()
+        self.executor.run()
+        self.assertEqual(profile_cache().get_identity('RJ'), None)
+        self.assertEqual(UserSocialAuth.objects.get().uid, '1000002')
+        self.assertEqual(UserSocialAuth.objects.get().extra_data['id'], '1000002')
+
+    def test_disabled(self):
+        """Without LASTFM_DEFER_PROFILE every login fetches the profile."""
+        with self.settings(LASTFM_DEFER_PROFILE=False):
+            self.login()
+            self.login()
+        self.assertEqual(self.methods(), ['auth.getSession', 'user.getinfo'] * 2)
+        self.assertEqual(profile_cache().get_identity('RJ'), None)
+
+
+class ThreadExecutorTestCase(DjangoTestCase):
+    """Deferred tasks run on worker threads."""
+
+    def test_submit(self):
+        """Submitted tasks run and failures don't stop the workers."""
+        results = []
+
+        def fail():
+            raise ValueError()
+
+        executor = ThreadExecutor(workers=2)
+        executor.submit(fail)
+        for i in range(5):
+            executor.submit(results.append, i)
+        executor.join()
+        self.assertEqual(sorted(results), range(5))
+        self.assertEqual(len(executor._threads), 2)
+
+    def test_full_queue(self):
+        """Tasks past the queue size are dropped."""
+        results = []
+        started = threading.Event()
+        release = threading.Event()
+
+        def block():
+            started.set()
+            release.wait(5)
+
+        executor = ThreadExecutor(workers=1, queue_size=1)
+        executor.submit(block)
+        # The queue is empty once the worker runs the first task
+        self.assertTrue(started.wait(5))
+        executor.submit(results.append, 1)
+        executor.submit(results.append, 2)
+        release.set()
+        executor.join()
+        self.assertEqual(results, [1])
@@ -0,0 +1,98 @@
+import threading
+
+from django.contrib.auth.models import User
+from django.core.urlresolvers import reverse
+from django.test import TestCase as DjangoTestCase
+
+import mock
+
+from lastfm_auth.backend import LastfmAuth
+from lastfm_auth.exceptions import LastfmAPIError, LastfmResponseError
+from lastfm_auth.signing import sign_params
+from lastfm_auth.testserver import FakeLastfmServerMixin
+from lastfm_auth.tests.backend import lastfm_user_response, COMPLETE_URL_NAME, NEW_USER_REDIRECT
+
+
+class FakeServerTestCase(FakeLastfmServerMixin, DjangoTestCase):
+    """Full request path against the fake Last.fm server."""
+
+    def start(self, **kwargs):
+        kwargs.setdefault('sessions', {'TOKEN': 'RJ'})
+        kwargs.setdefault('users', {'RJ': lastfm_user_response()})
+        self.start_server({'LASTFM_CIRCUIT_FAILURES': 0}, **kwargs)
+
+    def test_signature(self):
+        """The fake server signs requests the same way as method_signature."""
+        self.start()
+        auth = LastfmAuth()
+        params = {'api_key': auth.api_key(), 'method': 'auth.getSession', 'token': 'TOKEN'}
+        self.assertEqual(
+            sign_params(params, auth.secret_key()),
+            auth.method_signature('auth.getSession', 'TOKEN')
+        )
+
+    def test_login(self):
+        """Complete a login through the full request path."""
+        self.start()
+        complete_url = reverse(COMPLETE_URL_NAME, kwargs={'backend': 'lastfm'})
+        response = self.client.get(complete_url, {'token': 'TOKEN'})
+        self.assertRedirects(response, NEW_USER_REDIRECT)
+        self.assertEqual(User.objects.latest('id').first_name, 'Richard')
+
+    def test_bad_signature(self):
+        """Requests signed with the wrong secret are rejected."""
+        self.start(secret='OTHER')
+        try:
+            LastfmAuth().access_token('TOKEN')
+        except LastfmAPIError as e:
+            self.assertEqual(e.code, 13)
+        else:
+            self.fail('LastfmAPIError not raised')
+
+    def test_throttling(self):
+        """Requests past the rate limit get error 29."""
+        self.start(rate_limit=1)
+        auth = LastfmAuth()
+        # Keep both requests in the same one second window
+        with mock.patch('lastfm_auth.testserver.time') as clock:
+            clock.time.return_value = 1000.0
+            auth.user_data('RJ')
+            try:
+                auth.user_data('RJ')
+            except LastfmAPIError as e:
+                self.assertEqual(e.code, 29)
+            else:
+                self.fail('LastfmAPIError not raised')
+
+    def test_malformed_json(self):
+        """Truncated JSON is reported as a response error."""
+        self.start(malformed_rate=1)
+        self.assertRaises(LastfmResponseError, LastfmAuth().user_data, 'RJ')
+
+    def test_single_use_tokens(self):
+        """Single use tokens can only be exchanged once."""
+        self.start(single_use=True)
+        auth = LastfmAuth()
+        self.assertEqual(auth.access_token('TOKEN'), ('RJ', 'SESSIONKEY'))
+        self.assertRaises(LastfmAPIError, auth.access_token, 'TOKEN')
+
+    def test_concurrent(self):
+        """Concurrent logins exercise the pool and coalescing."""
+        sessions = dict(('TOKEN%s' % i, 'RJ') for i in range(20))
+        self.start(sessions=sessions, latency=0.01)
+        results = []
+
+        def login(token):
+            auth = LastfmAuth()
+            username, key = auth.access_token(token)
+            results.append(auth.user_data(username)['id'])
+
+        threads = [threading.Thread(target=login, args=(token, )) for token in sessions]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, ['1000002'] * 20)
+        methods = [query['method'] for query in self.server.requests]
+        self.assertEqual(methods.count('auth.getSession'), 20)
+        self.assertTrue(1 <= methods.count('user.getinfo') <= 20)
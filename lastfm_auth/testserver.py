@@ -0,0 +1,243 @@
+"""
+In-process fake of the Last.fm API for integration and load testing.
+
+FakeLastfmServer implements auth.getSession and user.getinfo, checks api_key
+and api_sig against one or more key and secret pairs and can inject latency, errors, throttling and malformed JSON.
+user.getinfo responses carry ETag, Last-Modified and Cache-Control headers and
+conditional requests are answered with 304 Not Modified.
+Point LASTFM_API_SERVER at its url to exercise the full request path offline:
+
+    server = FakeLastfmServer(sessions={'TOKEN': 'RJ'}, users={'RJ': {...}})
+    server.start()
+    settings.LASTFM_API_SERVER = server.url
+    ...
+    server.stop()
+
+Test cases can use FakeLastfmServerMixin to do this for each test:
+
+    class LoginTestCase(FakeLastfmServerMixin, TestCase):
+
+        def setUp(self):
+            self.start_server({'LASTFM_PROFILES': True}, users={'RJ': {...}})
+"""
+
+import random
+import threading
+import time
+from email.utils import formatdate, parsedate_tz, mktime_tz
+from hashlib import md5
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from urlparse import urlparse, parse_qs
+
+from django.conf import settings
+from django.core.cache import cache
+from django.test.utils import override_settings
+from django.utils import simplejson
+
+from lastfm_auth.backend import close_pools
+from lastfm_auth.signing import sign_params
+
+
+# Last.fm API error codes
+INVALID_METHOD = 3
+INVALID_TOKEN = 4
+INVALID_PARAMETERS = 6
+INVALID_API_KEY = 10
+INVALID_SIGNATURE = 13
+UNAUTHORIZED_TOKEN = 14
+TEMPORARY_ERROR = 16
+RATE_LIMIT_EXCEEDED = 29
+
+
+class LastfmRequestHandler(BaseHTTPRequestHandler):
+    """Answer auth.getSession and user.getinfo with canned data."""
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        server = self.server
+        query = dict((k, v[0]) for k, v in parse_qs(urlparse(self.path).query).items())
+        server.record(query)
+        if server.latency:
+            time.sleep(server.latency)
+        api_key = query.get('api_key')
+        if server.throttled(api_key):
+            return self.send_error_code(RATE_LIMIT_EXCEEDED, 'Rate limit exceeded', 429)
+        if server.error_rate and random.random() < server.error_rate:
+            return self.send_error_code(TEMPORARY_ERROR, 'Temporary error', 503)
+        if api_key not in server.keys:
+            return self.send_error_code(INVALID_API_KEY, 'Invalid API key', 403)
+        method = query.get('method', '')
+        if method == 'auth.getSession':
+            if query.get('api_sig') != sign_params(query, server.keys[api_key]):
+                return self.send_error_code(INVALID_SIGNATURE, 'Invalid method signature', 403)
+            name = server.exchange(query.get('token'))
+            if name is None:
+                return self.send_error_code(INVALID_TOKEN, 'Invalid token', 403)
+            data = {'session': {'name': name, 'key': 'SESSIONKEY', 'subscriber': 0}}
+        elif method == 'user.getinfo':
+            user = server.users.get(query.get('user'))
+            if user is None:
+                return self.send_error_code(INVALID_PARAMETERS, 'No user with that name', 400)
+            return self.send_cacheable(simplejson.dumps({'user': user}))
+        else:
+            return self.send_error_code(INVALID_METHOD, 'Invalid method', 400)
+        self.send_body(self.malformed(simplejson.dumps(data)))
+
+    def send_cacheable(self, body):
+        """Send a body with validators, or 304 when the request's validators still match."""
+        server = self.server
+        headers = {
+            'ETag': '"%s"' % md5(body).hexdigest(),
+            'Last-Modified': formatdate(server.last_modified, usegmt=True),
+        }
+        if server.max_age is not None:
+            headers['Cache-Control'] = 'max-age=%s' % server.max_age
+        etag = self.headers.getheader('if-none-match')
+        since = self.headers.getheader('if-modified-since')
+        if etag is not None:
+            not_modified = etag == headers['ETag']
+        elif since is not None:
+            parsed = parsedate_tz(since)
+            not_modified = parsed is not None and mktime_tz(parsed) >= int(server.last_modified)
+        else:
+            not_modified = False
+        if not_modified:
+            with server.lock:
+                server.not_modified += 1
+            self.send_response(304)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+            return
+        self.send_body(self.malformed(body), headers=headers)
+
+    def send_error_code(self, code, message, status):
+        self.send_body(simplejson.dumps({'error': code, 'message': message}), status)
+
+    def malformed(self, body):
+        """Return the body, truncated for a fraction of responses."""
+        if self.server.malformed_rate and random.random() < self.server.malformed_rate:
+            return body[:len(body) // 2]
+        return body
+
+    def send_body(self, body, status=200, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeLastfmServer(ThreadingMixIn, HTTPServer):
+    """
+    Threaded fake Last.fm API on a free local port.
+
+        sessions        Map of request token to Last.fm username
+        users           Map of username to user.getinfo data
+        latency         Seconds to wait before answering each request
+        error_rate      Fraction of requests answered with a 503
+        malformed_rate  Fraction of responses with truncated JSON
+        rate_limit      Requests allowed per second and API key before answering error 29
+        single_use      Whether tokens can only be exchanged once
+        keys            Map of API key to secret, by default LASTFM_API_KEY and LASTFM_SECRET
+        max_age         Cache-Control max-age of user.getinfo responses, None for no header
+        last_modified   Last-Modified time of user.getinfo responses, by default the start time
+    """
+    daemon_threads = True
+
+    def __init__(self, sessions=None, users=None, latency=0, error_rate=0,
+                 malformed_rate=0, rate_limit=None, single_use=False,
+                 api_key=None, secret=None, keys=None, max_age=None, last_modified=None):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), LastfmRequestHandler)
+        self.sessions = sessions or {}
+        self.users = users or {}
+        self.latency = latency
+        self.error_rate = error_rate
+        self.malformed_rate = malformed_rate
+        self.rate_limit = rate_limit
+        self.single_use = single_use
+        self.api_key = api_key or getattr(settings, 'LASTFM_API_KEY', '')
+        self.secret = secret or getattr(settings, 'LASTFM_SECRET', '')
+        self.keys = keys or {self.api_key: self.secret}
+        self.max_age = max_age
+        self.last_modified = last_modified or time.time()
+        self.requests = []
+        self.not_modified = 0
+        self.lock = threading.Lock()
+        self._windows = {}
+
+    def record(self, query):
+        with self.lock:
+            self.requests.append(query)
+
+    def exchange(self, token):
+        """Return the username for a request token."""
+        with self.lock:
+            if self.single_use:
+                return self.sessions.pop(token, None)
+            return self.sessions.get(token)
+
+    def throttled(self, api_key):
+        """Count the request against the key's rate limit. Return whether it is exceeded."""
+        if not self.rate_limit:
+            return False
+        with self.lock:
+            window = int(time.time())
+            start, count = self._windows.get(api_key, (None, 0))
+            if start != window:
+                count = 0
+            count += 1
+            self._windows[api_key] = (window, count)
+            return count > self.rate_limit
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%s/2.0/' % self.server_address[1]
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+class FakeLastfmServerMixin(object):
+    """
+    Mixin for test cases which call a FakeLastfmServer.
+
+    start_server starts the server as self.server and points LASTFM_API_SERVER
+    at it along with any other given settings. When the test ends the settings
+    are restored, pooled connections closed and the server stopped. The default
+    cache is cleared before and after each test.
+    """
+
+    def start_server(self, overrides=None, **kwargs):
+        """Start a FakeLastfmServer with the given arguments for this test."""
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.server = FakeLastfmServer(**kwargs)
+        self.server.start()
+        self.addCleanup(self.server.stop)
+        self.addCleanup(close_pools)
+        settings_override = override_settings(
+            LASTFM_API_SERVER=self.server.url, **(overrides or {}))
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        return self.server
@@ -0,0 +1,101 @@
+"""
+Helpers shared by the backend and management commands.
+"""
+
+import sys
+import threading
+from Queue import Queue, Empty, Full
+
+
+_DONE = object()
+# Seconds between checks for an abandoned imap_unordered by blocked threads
+POLL_INTERVAL = 0.05
+
+
+def _put(queue, item, stop):
+    """Put the item on the queue unless stop is set first. Return whether it was put."""
+    while not stop.is_set():
+        try:
+            queue.put(item, timeout=POLL_INTERVAL)
+            return True
+        except Full:
+            pass
+    return False
+
+
+def _get(queue, stop):
+    """Return the next item of the queue or _DONE once stop is set."""
+    while not stop.is_set():
+        try:
+            return queue.get(timeout=POLL_INTERVAL)
+        except Empty:
+            pass
+    return _DONE
+
+
+def imap_unordered(func, items, workers=4):
+    """
+    Call func for each item using a bounded pool of worker threads.
+
+    Yields (item, result, exc_info) tuples as calls complete. exc_info is None
+    unless the call raised. Only a bounded number of items is pulled from
+    `items` ahead of the results being consumed so iterables of any size can
+    be used. When the caller stops iterating early the threads finish their
+    current call and exit. An error raised by `items` is raised again once
+    the calls already started have been yielded.
+    """
+    workers = max(1, workers)
+    tasks = Queue(maxsize=workers)
+    results = Queue(maxsize=workers * 2)
+    stop = threading.Event()
+    feed_errors = []
+
+    def work():
+        while True:
+            item = _get(tasks, stop)
+            if item is _DONE:
+                _put(results, _DONE, stop)
+                break
+            try:
+                result = (item, func(item), None)
+            except Exception:
+                result = (item, None, sys.exc_info())
+            if not _put(results, result, stop):
+                break
+
+    def feed():
+        try:
+            for item in items:
+                if not _put(tasks, item, stop):
+                    return
+        except Exception:
+            feed_errors.append(sys.exc_info())
+        finally:
+            for i in range(workers):
+                if not _put(tasks, _DONE, stop):
+                    break
+
+    threads = [threading.Thread(target=work) for i in range(workers)]
+    threads.append(threading.Thread(target=feed))
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    running = workers
+    try:
+        while running:
+            result = results.get()
+            if result is _DONE:
+                running -= 1
+            else:
+                yield result
+        if feed_errors:
+            exc_info = feed_errors[0]
+            raise exc_info[0], exc_info[1], exc_info[2]
+    finally:
+        # Release threads blocked on the queues if the caller stopped early
+        stop.set()
+        while True:
+            try:
+                results.get_nowait()
+            except Empty:
+                break
@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+"""
+Benchmark the Last.fm login flow.
+
+Each login requests the begin and complete urls through the Django test client
+with Last.fm replaced by a local fake server. Results can be saved as JSON and
+compared with a previous run to spot regressions between releases:
+
+    python runbenchmarks.py --logins=500 --latency=0.01 --output=new.json --compare=old.json
+
+Allocations are counted as the net number of objects tracked by the garbage
+collector created during each login.
+
+The decoding of Last.fm responses can be benchmarked on its own with:
+
+    python runbenchmarks.py --decode --iterations=10000
+
+and the signing of requests with:
+
+    python runbenchmarks.py --sign --iterations=10000
+
+Cold start time of importing lastfm_auth and loading the social_auth BACKENDS
+registry is measured in fresh interpreters with:
+
+    python runbenchmarks.py --imports --starts=20
+"""
+import gc
+import os
+import subprocess
+import sys
+import time
+from hashlib import md5
+from optparse import OptionParser
+from urllib import urlencode
+from urlparse import urlparse, parse_qs
+
+import runtests # Configures the test settings
+
+from django.conf import settings
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test.client import Client
+from django.test.utils import setup_test_environment, teardown_test_environment
+from django.utils import simplejson
+
+import lastfm_auth
+from lastfm_auth import backend
+from lastfm_auth.tests.backend import lastfm_user_response, BEGIN_URL_NAME
+from lastfm_auth.testserver import FakeLastfmServer
+
+
+def percentile(values, percent):
+    """Return the nearest-rank percentile of sorted values."""
+    if not values:
+        return 0
+    index = max(0, int(round(percent / 100.0 * len(values))) - 1)
+    return values[index]
+
+
+def login(client, begin_url, token):
+    """Run a single begin and complete request. Return whether login succeeded."""
+    response = client.get(begin_url)
+    callback = parse_qs(urlparse(response['Location']).query)['cb'][0]
+    response = client.get(urlparse(callback).path, {'token': token})
+    client.logout()
+    return response.status_code == 302 and '/error/' not in response['Location']
+
+
+def run(options):
+    """Run the benchmark and return the results."""
+    sessions = {}
+    users = {}
+    for i in range(options.users):
+        name = 'user%s' % i
+        users[name] = dict(lastfm_user_response(), id=str(1000000 + i), name=name)
+    for i in range(options.logins):
+        sessions['TOKEN%s' % i] = 'user%s' % (i % options.users)
+    server = FakeLastfmServer(
+        latency=options.latency, sessions=sessions, users=users,
+        error_rate=options.error_rate
+    )
+    server.start()
+    settings.LASTFM_API_SERVER = server.url
+    client = Client()
+    begin_url = reverse(BEGIN_URL_NAME, kwargs={'backend': 'lastfm'})
+    timings = []
+    allocations = 0
+    errors = 0
+    try:
+        for i in range(options.logins):
+            gc.collect()
+            gc.disable()
+            before = gc.get_count()[0]
+            start = time.time()
+            if not login(client, begin_url, 'TOKEN%s' % i):
+                errors += 1
+            timings.append(time.time() - start)
+            allocations += gc.get_count()[0] - before
+            gc.enable()
+    finally:
+        gc.enable()
+        backend.close_pools()
+        server.stop()
+    total = sum(timings)
+    timings.sort()
+    return {
+        'version': lastfm_auth.__version__,
+        'config': {
+            'logins': options.logins, 'users': options.users,
+            'latency': options.latency, 'error_rate': options.error_rate,
+        },
+        'errors': errors,
+        'throughput': options.logins / total if total else 0,
+        'mean': total / len(timings) if timings else 0,
+        'p50': percentile(timings, 50),
+        'p95': percentile(timings, 95),
+        'p99': percentile(timings, 99),
+        'allocations_per_login': allocations / float(options.logins or 1),
+    }
+
+
+def decode_benchmark(iterations):
+    """Compare decoding a full user.getinfo response with the backend decoder."""
+    body = simplejson.dumps({'user': lastfm_user_response()})
+    fields = backend.LastfmAuth.user_fields()
+    paths = (
+        ('full', lambda: simplejson.loads(body)['user']),
+        ('backend', lambda: backend.decode_response(body, 'user', fields)),
+    )
+    print 'Decoding %s byte user.getinfo response %s times' % (len(body), iterations)
+    for name, decode in paths:
+        start = time.time()
+        for i in range(iterations):
+            decode()
+        elapsed = time.time() - start
+        gc.collect()
+        gc.disable()
+        before = gc.get_count()[0]
+        kept = [decode() for i in range(100)]
+        retained = (gc.get_count()[0] - before) / 100.0
+        gc.enable()
+        print '%s: %.2f us/decode, %s fields, %.1f objects retained' % (
+            name, elapsed / iterations * 1000000, len(kept[0]), retained)
+
+
+def sign_benchmark(iterations):
+    """Compare building a signed auth.getSession url with the previous approach."""
+    auth = backend.LastfmAuth()
+
+    def formatted():
+        # The url building used before signing was moved to lastfm_auth.signing
+        data = {'key': auth.api_key(), 'secret': auth.secret_key(),
+                'method': 'auth.getSession', 'token': 'TOKEN'}
+        signature = md5('api_key%(key)smethod%(method)stoken%(token)s%(secret)s' % data).hexdigest()
+        query = urlencode({'method': 'auth.getSession', 'api_key': auth.api_key(),
+                           'token': 'TOKEN', 'api_sig': signature, 'format': 'json'})
+        return '%s?%s' % (backend.LASTFM_API_SERVER, query)
+
+    paths = (
+        ('formatted', formatted),
+        ('signer', lambda: auth.access_token_url('TOKEN')),
+    )
+    print 'Building signed auth.getSession urls %s times' % iterations
+    for name, build in paths:
+        start = time.time()
+        for i in range(iterations):
+            build()
+        elapsed = time.time() - start
+        print '%s: %.0f urls/s' % (name, iterations / elapsed)
+
+
+IMPORT_SCRIPT = """
+import sys
+import time
+import runtests
+start = time.time()
+import lastfm_auth
+package = time.time()
+modules = len(sys.modules)
+import lastfm_auth.backend
+backend = time.time()
+from social_auth.backends import get_backends
+get_backends()
+registry = time.time()
+print '%f %f %f %d %d' % (package - start, backend - package, registry - backend,
+    len(sys.modules) - modules, 'lastfm_auth.client' in sys.modules)
+"""
+
+
+def import_benchmark(starts):
+    """Time importing lastfm_auth and the backend registry in fresh interpreters."""
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    timings = []
+    for i in range(starts):
+        output = subprocess.Popen([sys.executable, '-c', IMPORT_SCRIPT], cwd=here,
+            env=env, stdout=subprocess.PIPE, stderr=open(os.devnull, 'w')).communicate()[0]
+        timings.append(output.split())
+    print 'Cold start over %s interpreters (median)' % starts
+    for index, name in enumerate(('import lastfm_auth', 'import lastfm_auth.backend',
+                                  'social_auth get_backends()')):
+        values = sorted(float(timing[index]) * 1000 for timing in timings)
+        print '%s: %.1fms' % (name, values[len(values) // 2])
+    print 'modules loaded by lastfm_auth.backend: %s' % timings[-1][3]
+    print 'HTTP client loaded: %s' % (timings[-1][4] == '1')
+
+
+def report(results, previous=None):
+    """Print results with the change from a previous run."""
+    print 'lastfm_auth %(version)s' % results
+    print '%(logins)s logins, %(users)s users, %(latency)ss latency, %(error_rate)s error rate' % results['config']
+    print 'errors: %s' % results['errors']
+    for name, unit in (('throughput', 'logins/s'), ('mean', 's'), ('p50', 's'),
+                       ('p95', 's'), ('p99', 's'), ('allocations_per_login', '')):
+        line = '%s: %.4f %s' % (name, results[name], unit)
+        if previous and previous.get(name):
+            change = (results[name] - previous[name]) / previous[name] * 100
+            line += ' (%+.1f%% vs %s)' % (change, previous.get('version', '?'))
+        print line
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--logins', type='int', default=200, help='Number of logins.')
+    parser.add_option('--users', type='int', default=50, help='Number of distinct Last.fm users.')
+    parser.add_option('--latency', type='float', default=0.0, help='Fake Last.fm latency in seconds.')
+    parser.add_option('--error-rate', type='float', default=0.0, dest='error_rate',
+        help='Fraction of Last.fm requests which fail.')
+    parser.add_option('--output', default=None, help='Write results as JSON to this file.')
+    parser.add_option('--compare', default=None, help='JSON results of a previous run.')
+    parser.add_option('--decode', action='store_true', default=False,
+        help='Benchmark decoding of Last.fm responses only.')
+    parser.add_option('--sign', action='store_true', default=False,
+        help='Benchmark signing of Last.fm requests only.')
+    parser.add_option('--iterations', type='int', default=10000,
+        help='Number of iterations for --decode and --sign.')
+    parser.add_option('--imports', action='store_true', default=False,
+        help='Benchmark import time in fresh interpreters only.')
+    parser.add_option('--starts', type='int', default=10,
+        help='Number of interpreters for --imports.')
+    options, args = parser.parse_args()
+    if options.imports:
+        return import_benchmark(options.starts)
+    if options.decode:
+        return decode_benchmark(options.iterations)
+    if options.sign:
+        return sign_benchmark(options.iterations)
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0)
+    try:
+        results = run(options)
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+    previous = None
+    if options.compare and os.path.exists(options.compare):
+        with open(options.compare) as f:
+            previous = simplejson.load(f)
+    report(results, previous)
+    if options.output:
+        with open(options.output, 'w') as f:
+            simplejson.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()